@@ -9,6 +9,8 @@ from .interface.jtag_pinout import JTAGPinoutApplet
 from .interface.jtag_probe import JTAGProbeApplet
 from .interface.jtag_openocd import JTAGOpenOCDApplet
 from .interface.jtag_svf import JTAGSVFApplet
+from .interface.jtag_vpi import JTAGVPIApplet
+from .interface.jtag_xvc import JTAGXVCApplet
 from .interface.ps2_host import PS2HostApplet
 from .interface.sbw_probe import SpyBiWireProbeApplet
 
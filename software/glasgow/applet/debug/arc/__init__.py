@@ -15,6 +15,13 @@
 #   on the rising edge of TCK when TMS is low. This state is employed to initiate a read/write
 #   access or place the JTAG module in the idle state. The read/write access defined by the
 #   address, data and command registers only occurs once on entry to Run-Test/Idle.
+#
+# The Address register is incremented by 4 after every memory transaction, so a block of memory
+# can be transferred by setting the address and the command once, and then repeatedly entering
+# Run-Test/Idle and scanning the Data register. None of these scans depend on the captured data,
+# so the entire block is queued as deferred scans. The Status register is also captured after
+# every transaction and checked afterwards; words whose transaction was not complete at that time
+# are transferred again individually.
 
 import logging
 import argparse
@@ -48,7 +55,20 @@ class ARCDebugInterface:
         device = devices[idcode.mfg_id, idcode.part_id & 0b111111]
         return idcode, device
 
-    async def _wait_txn(self):
+    def _check_status(self, status_bits):
+        status = DR_STATUS.from_bits(status_bits)
+        self._log("status %s", status.bits_repr())
+        if status.FL:
+            raise ARCDebugError("transaction failed: %s" % status.bits_repr())
+        return status
+
+    async def _wait_txn(self, *, defer=False):
+        if defer:
+            # Capture the status once, and check it after collection.
+            await self.lower.write_ir(IR_STATUS)
+            status_bits = await self.lower.read_dr(4, defer=True)
+            return status_bits.map(self._check_status)
+
         await self.lower.write_ir(IR_STATUS)
         status = DR_STATUS()
         while not status.RD:
@@ -58,7 +78,10 @@ class ARCDebugInterface:
             if status.FL:
                 raise ARCDebugError("transaction failed: %s" % status.bits_repr())
 
-    async def read(self, address, space):
+    async def collect(self):
+        await self.lower.collect()
+
+    async def read(self, address, space, *, defer=False):
         if space == "memory":
             dr_txn_command = DR_TXN_COMMAND_READ_MEMORY
         elif space == "core":
@@ -75,6 +98,16 @@ class ARCDebugInterface:
         await self.lower.write_ir(IR_TXN_COMMAND)
         await self.lower.write_dr(dr_txn_command)
         await self.lower.run_test_idle(1)
+        if defer:
+            status = await self._wait_txn(defer=True)
+            await self.lower.write_ir(IR_DATA)
+            dr_data_bits = await self.lower.read_dr(32, defer=True)
+            def check(dr_data_bits):
+                if not status.result().RD:
+                    raise ARCDebugError("transaction not complete")
+                return DR_DATA.from_bits(dr_data_bits).Data
+            return dr_data_bits.map(check)
+
         await self._wait_txn()
         await self.lower.write_ir(IR_DATA)
         dr_data_bits = await self.lower.read_dr(32)
@@ -82,7 +115,7 @@ class ARCDebugInterface:
         self._log("read data=%08x", dr_data.Data)
         return dr_data.Data
 
-    async def write(self, address, data, space):
+    async def write(self, address, data, space, *, defer=False):
         if space == "memory":
             dr_txn_command = DR_TXN_COMMAND_WRITE_MEMORY
         elif space == "core":
@@ -102,8 +135,67 @@ class ARCDebugInterface:
         await self.lower.write_ir(IR_TXN_COMMAND)
         await self.lower.write_dr(dr_txn_command)
         await self.lower.run_test_idle(1)
+        if defer:
+            status = await self._wait_txn(defer=True)
+            def check(status):
+                if not status.RD:
+                    raise ARCDebugError("transaction not complete")
+            return status.map(check)
         await self._wait_txn()
 
+    async def read_block(self, address, count):
+        """
+        Read ``count`` words of memory starting at ``address`` using address auto-increment.
+        """
+        self._log("read memory block address=%08x count=%d", address, count)
+        await self.lower.write_ir(IR_ADDRESS)
+        await self.lower.write_dr(DR_ADDRESS(Address=address).to_bits())
+        await self.lower.write_ir(IR_TXN_COMMAND)
+        await self.lower.write_dr(DR_TXN_COMMAND_READ_MEMORY)
+        results = []
+        for _ in range(count):
+            await self.lower.run_test_idle(1)
+            await self.lower.write_ir(IR_STATUS)
+            status_bits = await self.lower.read_dr(4, defer=True)
+            await self.lower.write_ir(IR_DATA)
+            dr_data_bits = await self.lower.read_dr(32, defer=True)
+            results.append((status_bits, dr_data_bits))
+        await self.lower.collect()
+
+        words = []
+        for offset, (status_bits, dr_data_bits) in enumerate(results):
+            status = self._check_status(status_bits.result())
+            if status.RD:
+                words.append(DR_DATA.from_bits(dr_data_bits.result()).Data)
+            else:
+                self._log("read memory block offset=%d not complete, retrying", offset)
+                words.append(await self.read(address + offset * 4, space="memory"))
+        return words
+
+    async def write_block(self, address, words):
+        """
+        Write ``words`` to memory starting at ``address`` using address auto-increment.
+        """
+        self._log("write memory block address=%08x count=%d", address, len(words))
+        await self.lower.write_ir(IR_ADDRESS)
+        await self.lower.write_dr(DR_ADDRESS(Address=address).to_bits())
+        await self.lower.write_ir(IR_TXN_COMMAND)
+        await self.lower.write_dr(DR_TXN_COMMAND_WRITE_MEMORY)
+        results = []
+        for word in words:
+            await self.lower.write_ir(IR_DATA)
+            await self.lower.write_dr(DR_DATA(Data=word).to_bits())
+            await self.lower.run_test_idle(1)
+            await self.lower.write_ir(IR_STATUS)
+            results.append(await self.lower.read_dr(4, defer=True))
+        await self.lower.collect()
+
+        for offset, (word, status_bits) in enumerate(zip(words, results)):
+            status = self._check_status(status_bits.result())
+            if not status.RD:
+                self._log("write memory block offset=%d not complete, retrying", offset)
+                await self.write(address + offset * 4, word, space="memory")
+
     async def set_halted(self, halted):
         await self.write(AUX_STATUS32_addr, AUX_STATUS32(halted=halted).to_int(), space="aux")
 
@@ -128,7 +220,7 @@ class DebugARCApplet(JTAGProbeApplet, name="debug-arc"):
         super().add_run_tap_arguments(parser, access)
 
     async def run(self, device, args):
-        tap_iface = await self.run_tap(DebugARCApplet, device, args, reset=True)
+        tap_iface = await self.run_tap(DebugARCApplet, device, args)
         return ARCDebugInterface(tap_iface, self.logger)
 
     async def interact(self, device, args, arc_iface):
@@ -2,10 +2,33 @@
 # Document Number: IHI0031C
 # Accession: G00027
 
+# Queued transactions
+# -------------------
+#
+# Every SWD transaction has a reply from the target (an ACK, and for reads, data), and waiting for
+# each of them costs a USB round trip. To avoid this, the subtarget always replies with the same
+# amount of bytes for a given request (an ACK byte for writes, and an ACK byte and four data bytes
+# for reads, even if the ACK was not OK), so many transactions can be sent at once and all
+# replies read back together.
+#
+# The ACKs are checked afterwards. This relies on overrun detection being enabled in the DP:
+# once a transaction receives a WAIT or FAULT response, every following transaction receives
+# a FAULT response and has no effect, so after clearing the overrun condition, the transactions
+# can be simply issued again starting with the first one that did not succeed.
+#
+# MEM-AP transfers
+# ----------------
+#
+# Memory is accessed through the DRW register of a MEM-AP with TAR auto-increment. Auto-increment
+# is only guaranteed to work within a 1 KiB block, so TAR is rewritten at every 1 KiB boundary.
+# AP reads are posted, i.e. each read of DRW returns the result of the previous one, and the last
+# result is read from the DP RDBUFF register.
+
 import logging
 import asyncio
 import struct
 import math
+import argparse
 from nmigen.compat import *
 
 from ....gateware.pads import *
@@ -252,6 +275,9 @@ class SWDSubtarget(Module):
                         self.bus.ack.eq(1),
                         NextState("CLOCK-IDLE")
                     )
+                ).Elif(cmd & 0b10,
+                    # Always reply to reads with the same amount of bytes; see above.
+                    NextState("FIFO-WRITE-DATA-1")
                 ).Else(
                     NextState("CLOCK-IDLE")
                 )
@@ -279,6 +305,40 @@ class SWDSubtarget(Module):
             )
 
 
+ACK_OK    = 0b001
+ACK_WAIT  = 0b010
+ACK_FAULT = 0b100
+
+DP_IDCODE = 0 # read
+DP_ABORT  = 0 # write
+DP_CTRL   = 1
+DP_SELECT = 2
+DP_RDBUFF = 3
+
+DP_ABORT_STKCMPCLR  = 1 << 1
+DP_ABORT_STKERRCLR  = 1 << 2
+DP_ABORT_WDERRCLR   = 1 << 3
+DP_ABORT_ORUNERRCLR = 1 << 4
+
+DP_CTRL_ORUNDETECT   = 1 << 0
+DP_CTRL_CDBGPWRUPREQ = 1 << 28
+DP_CTRL_CDBGPWRUPACK = 1 << 29
+DP_CTRL_CSYSPWRUPREQ = 1 << 30
+DP_CTRL_CSYSPWRUPACK = 1 << 31
+
+AP_CSW = 0x00
+AP_TAR = 0x04
+AP_DRW = 0x0c
+AP_IDR = 0xfc
+
+AP_CSW_SIZE_32     = 0b010
+AP_CSW_ADDRINC_SGL = 0b01 << 4
+
+
+class SWDError(GlasgowAppletError):
+    pass
+
+
 class SWDInterface:
     def __init__(self, interface, logger):
         self.lower   = interface
@@ -313,13 +373,12 @@ class SWDInterface:
     async def _read(self, ap, address):
         self._log("read %s[%d]", "AP" if ap else "DP", address)
         await self.lower.write([ap | (1 << 1) | ((address & 0x3) << 2) | 0x80])
-        ack, = await self.lower.read(1)
+        ack, data = struct.unpack("<BL", await self.lower.read(5))
 
         if ack != 0b001:
             self._log("nak=%s", "{:03b}".format(ack))
             return None
         else:
-            data, = struct.unpack("<L", await self.lower.read(4))
             self._log("ack data=%08x", data)
             return data
 
@@ -348,6 +407,174 @@ class SWDInterface:
     async def write_dp(self, address, data):
         return await self._write(ap=False, address=address, data=data)
 
+    async def transact(self, transactions):
+        """
+        Perform a sequence of transactions, each of which is either ``(ap, address)`` for a read
+        or ``(ap, address, data)`` for a write, with as few USB round trips as possible.
+
+        Transactions that receive a WAIT response are issued again; any other response raises
+        an ``SWDError``. Requires overrun detection to be enabled (see ``power_up``).
+
+        Returns a list with the read data for reads and ``None`` for writes.
+        """
+        results = []
+        retries = 0
+        while len(results) < len(transactions):
+            pending = transactions[len(results):]
+            request = bytearray()
+            reply_length = 0
+            for transaction in pending:
+                ap, address, *data = transaction
+                if data:
+                    request.append(ap | ((address & 0x3) << 2) | 0x80)
+                    request += struct.pack("<L", *data)
+                    reply_length += 1
+                else:
+                    request.append(ap | (1 << 1) | ((address & 0x3) << 2) | 0x80)
+                    reply_length += 5
+            self._log("transact count=%d", len(pending))
+            await self.lower.write(request)
+            reply = await self.lower.read(reply_length)
+
+            offset = 0
+            for transaction in pending:
+                ap, address, *data = transaction
+                ack = reply[offset]
+                if ack != ACK_OK:
+                    break
+                if data:
+                    results.append(None)
+                    offset += 1
+                else:
+                    results.append(int.from_bytes(reply[offset + 1:offset + 5], "little"))
+                    offset += 5
+            else:
+                break
+
+            self._log("transact nak=%s at %s[%d]",
+                      "{:03b}".format(ack), "AP" if ap else "DP", address)
+            if ack == ACK_WAIT and retries < 100:
+                retries += 1
+                await self._write(ap=False, address=DP_ABORT, data=DP_ABORT_ORUNERRCLR)
+            elif ack == ACK_WAIT:
+                raise SWDError("%s[%d] access timed out" % ("AP" if ap else "DP", address))
+            elif ack == ACK_FAULT:
+                await self._write(ap=False, address=DP_ABORT,
+                                  data=DP_ABORT_STKCMPCLR | DP_ABORT_STKERRCLR |
+                                       DP_ABORT_WDERRCLR | DP_ABORT_ORUNERRCLR)
+                raise SWDError("%s[%d] access faulted" % ("AP" if ap else "DP", address))
+            else:
+                raise SWDError("%s[%d] access failed with ACK=%s"
+                               % ("AP" if ap else "DP", address, "{:03b}".format(ack)))
+
+        return results
+
+    async def power_up(self):
+        """
+        Power up the debug and system domains, and enable overrun detection.
+        """
+        self._log("power up")
+        request = DP_CTRL_CDBGPWRUPREQ | DP_CTRL_CSYSPWRUPREQ | DP_CTRL_ORUNDETECT
+        if not await self.write_dp(DP_CTRL, request):
+            raise SWDError("cannot write CTRL/STAT")
+        for _ in range(10):
+            ctrl = await self.read_dp(DP_CTRL)
+            if ctrl is None:
+                raise SWDError("cannot read CTRL/STAT")
+            if ctrl & DP_CTRL_CDBGPWRUPACK and ctrl & DP_CTRL_CSYSPWRUPACK:
+                break
+        else:
+            raise SWDError("power up request not acknowledged")
+
+    def mem_ap(self, apsel=0):
+        return SWDMemAPInterface(self, self._logger, apsel)
+
+
+class SWDMemAPInterface:
+    def __init__(self, interface, logger, apsel):
+        self.lower   = interface
+        self._logger = logger
+        self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
+        self._apsel  = apsel
+        self._csw    = None
+
+    def _log(self, message, *args):
+        self._logger.log(self._level, "MEM-AP: " + message, *args)
+
+    def _select(self, register):
+        return (False, DP_SELECT, (self._apsel << 24) | (register & 0xf0))
+
+    def _ap(self, register, *data):
+        return (True, (register & 0xc) >> 2, *data)
+
+    async def _setup(self):
+        if self._csw is None:
+            _, _, csw = await self.lower.transact([
+                self._select(AP_CSW),
+                self._ap(AP_CSW),
+                (False, DP_RDBUFF),
+            ])
+            self._csw = (csw & ~0x3f) | AP_CSW_SIZE_32 | AP_CSW_ADDRINC_SGL
+            self._log("CSW=%08x", self._csw)
+        return [
+            self._select(AP_CSW),
+            self._ap(AP_CSW, self._csw),
+        ]
+
+    @staticmethod
+    def _blocks(address, count):
+        # TAR auto-increment is only guaranteed within a 1 KiB block.
+        while count > 0:
+            block_count = min(count, (0x400 - (address & 0x3ff)) // 4)
+            yield address, block_count
+            address += block_count * 4
+            count   -= block_count
+
+    async def read_words(self, address, count):
+        """Read ``count`` 32-bit words starting at word-aligned ``address``."""
+        assert address % 4 == 0
+        self._log("read address=%08x count=%d", address, count)
+        transactions = await self._setup()
+        for block_address, block_count in self._blocks(address, count):
+            transactions.append(self._ap(AP_TAR, block_address))
+            transactions += [self._ap(AP_DRW)] * block_count
+            transactions.append((False, DP_RDBUFF))
+        results = await self.lower.transact(transactions)
+
+        words = []
+        offset = 2
+        for block_address, block_count in self._blocks(address, count):
+            # Skip the TAR write and the stale result of the first posted read.
+            words  += results[offset + 2:offset + 2 + block_count]
+            offset += 2 + block_count
+        return words
+
+    async def write_words(self, address, words):
+        """Write 32-bit ``words`` starting at word-aligned ``address``."""
+        assert address % 4 == 0
+        self._log("write address=%08x count=%d", address, len(words))
+        transactions = await self._setup()
+        offset = 0
+        for block_address, block_count in self._blocks(address, len(words)):
+            transactions.append(self._ap(AP_TAR, block_address))
+            transactions += [self._ap(AP_DRW, word)
+                             for word in words[offset:offset + block_count]]
+            offset += block_count
+        await self.lower.transact(transactions)
+
+    async def read_memory(self, address, length):
+        start  = address & ~3
+        count  = (address + length - start + 3) // 4
+        data   = bytearray()
+        for word in await self.read_words(start, count):
+            data += struct.pack("<L", word)
+        return bytes(data[address - start:address - start + length])
+
+    async def write_memory(self, address, data):
+        if address % 4 != 0 or len(data) % 4 != 0:
+            raise SWDError("unaligned memory writes are not supported")
+        await self.write_words(address, list(struct.unpack("<{}L".format(len(data) // 4), data)))
+
 
 class DebugARMSWDApplet(GlasgowApplet, name="debug-arm-swd"):
     preview = True
@@ -385,6 +612,44 @@ class DebugARMSWDApplet(GlasgowApplet, name="debug-arm-swd"):
         iface = await device.demultiplexer.claim_interface(self, self.mux_interface, args)
         return SWDInterface(iface, self.logger)
 
+    @classmethod
+    def add_interact_arguments(cls, parser):
+        def address(arg):
+            return int(arg, 0)
+
+        p_operation = parser.add_subparsers(dest="operation", metavar="OPERATION")
+
+        p_read_memory = p_operation.add_parser(
+            "read-memory", help="read target memory via a MEM-AP")
+        p_read_memory.add_argument(
+            "--ap", metavar="APSEL", type=int, default=0,
+            help="use MEM-AP with index APSEL (default: %(default)s)")
+        p_read_memory.add_argument(
+            "address", metavar="ADDRESS", type=address,
+            help="read memory from address ADDRESS")
+        p_read_memory.add_argument(
+            "length", metavar="LENGTH", type=address,
+            help="read LENGTH bytes from memory")
+        p_read_memory.add_argument(
+            "file", metavar="FILENAME", type=argparse.FileType("wb"),
+            help="write memory contents to binary file FILENAME")
+
+    async def interact(self, device, args, swd_iface):
+        if args.operation == "read-memory":
+            await swd_iface.reset()
+            await swd_iface.jtag_to_swd()
+            idcode = await swd_iface.read_dp(DP_IDCODE)
+            if idcode is None:
+                raise SWDError("cannot read IDCODE")
+            self.logger.info("IDCODE=%08x", idcode)
+            await swd_iface.power_up()
+
+            mem_ap_iface = swd_iface.mem_ap(args.ap)
+            for address in range(args.address, args.address + args.length, 0x10000):
+                length = min(0x10000, args.address + args.length - address)
+                self.logger.info("reading memory at %08x", address)
+                args.file.write(await mem_ap_iface.read_memory(address, length))
+
 # -------------------------------------------------------------------------------------------------
 
 class DebugARMSWDAppletTestCase(GlasgowAppletTestCase, applet=DebugARMSWDApplet):
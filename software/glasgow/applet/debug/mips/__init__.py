@@ -2,9 +2,23 @@
 # Document Number: MD00047 Revision 6.10
 # Accession: G00007
 
-import struct
+# Memory transfers
+# ----------------
+#
+# Every PrAcc access costs several DR scans and a USB round trip, since the probe has to read
+# the address and the direction of the access before it can serve it. Memory is therefore copied
+# in aligned words through a dmseg loop, with only the unaligned head and tail copied bytewise.
+#
+# If a work area in target RAM is provided, bulk transfers use the FASTDATA channel instead.
+# A small handler is copied to the work area, and the CPU jumps there; the handler then loads
+# or stores every word through the FASTDATA area of dmseg. An access to the FASTDATA area is
+# completed by a single scan of the FASTDATA DR, which does not depend on anything the probe
+# reads back, so all of these scans are queued at once. The SPrAcc bit captured by each scan
+# indicates whether the CPU was actually waiting for that access; it is checked afterwards.
+
 import logging
 import asyncio
+import random
 
 from ....support.aobject import *
 from ....support.endpoint import *
@@ -21,7 +35,7 @@ class EJTAGError(GlasgowAppletError):
 
 
 class EJTAGDebugInterface(aobject, GDBRemote):
-    async def __init__(self, interface, logger):
+    async def __init__(self, interface, logger, work_area=None):
         self.lower   = interface
         self._logger = logger
         self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
@@ -37,6 +51,9 @@ class EJTAGDebugInterface(aobject, GDBRemote):
         self._instr_brkpts = []
         self._softw_brkpts = {}
 
+        self._work_area        = work_area
+        self._fastdata_handler = None
+
     def _log(self, message, *args):
         self._logger.log(self._level, "EJTAG: " + message, *args)
 
@@ -236,7 +253,7 @@ class EJTAGDebugInterface(aobject, GDBRemote):
         return control.DM
 
     async def _exec_pracc_bare(self, code, data=[], max_steps=1024,
-                               entry_state="Stopped", suspend_state="Stopped"):
+                               entry_state="Stopped", suspend_state="Stopped", fastdata=False):
         self._check_state("execute PrAcc", entry_state)
         self._change_state("PrAcc")
 
@@ -248,6 +265,8 @@ class EJTAGDebugInterface(aobject, GDBRemote):
         temp_end = temp_beg   + len(temp) * 4
         data_beg = (DMSEG_addr + 0x1200)  & self._mask
         data_end = data_beg   + len(data) * 4
+        fast_beg = (DMSEG_addr + 0x0000)  & self._mask
+        fast_end = fast_beg   + 0x10
 
         for step in range(max_steps):
             for _ in range(3):
@@ -268,6 +287,10 @@ class EJTAGDebugInterface(aobject, GDBRemote):
                 self._log("Exec_PrAcc: debug suspend")
                 self._change_state(suspend_state)
                 break
+            if fastdata and address in range(fast_beg, fast_end):
+                self._log("Exec_PrAcc: FASTDATA suspend")
+                self._change_state(suspend_state)
+                break
 
             if address in range(code_beg, code_end):
                 area, area_beg, area_wr, area_name = code, code_beg, False, "code"
@@ -329,6 +352,9 @@ class EJTAGDebugInterface(aobject, GDBRemote):
     async def _pracc_debug_return(self):
         self._log("PrAcc: debug return")
 
+        # The target may overwrite the FASTDATA handler while it is running.
+        self._fastdata_handler = None
+
         Rdata, *_ = range(1, 32)
         await self._exec_pracc_bare(code=[
             MFC0 (Rdata, *CP0_DESAVE_addr),
@@ -549,13 +575,17 @@ class EJTAGDebugInterface(aobject, GDBRemote):
         self._log("PrAcc: write [%#.*x] = %#.*x", self._prec, address, self._prec, value)
         await self._pracc_copy_word(address, value, is_read=False)
 
-    async def _pracc_copy_memory(self, address, length, data, is_read):
+    @staticmethod
+    def _pracc_copy_steps(count):
+        # Each iteration of a copy loop takes 7 instruction fetches (including the delay slot)
+        # and up to 2 data accesses; the rest of the code takes less than 64 accesses.
+        return 64 + 9 * count
+
+    async def _pracc_copy_bytes(self, address, length, data, is_read):
         assert length <= 0x200
 
-        # This really isn't efficient at all, but unaligned accesses to dmseg are currently
-        # not handled correctly, and endianness is a nightmare. This should instead use
-        # word-size transfers, and ideally also the FASTDATA channel, but the implementation
-        # below works as a proof of concept.
+        # Unaligned accesses to dmseg are not handled correctly, so each byte occupies a word
+        # in the data area. This is only used for unaligned heads and tails of transfers.
         Rdata, Rdst, Rsrc, Rlen, Racc, *_ = range(1, 32)
         return await self._exec_pracc(code=[
             SW   (Rdst, self._ws * -1, Rdata),
@@ -579,14 +609,135 @@ class EJTAGDebugInterface(aobject, GDBRemote):
             LW   (Rsrc, self._ws * -2, Rdata),
             LW   (Rdst, self._ws * -1, Rdata),
             NOP  (),
-        ], data=data)
+        ], data=data, max_steps=self._pracc_copy_steps(len(data)))
+
+    async def _pracc_copy_words(self, address, data, is_read):
+        assert len(data) <= 0x100
+
+        Rdata, Rdst, Rsrc, Rlen, Racc, *_ = range(1, 32)
+        return await self._exec_pracc(code=[
+            SW   (Rdst, self._ws * -1, Rdata),
+            SW   (Rsrc, self._ws * -2, Rdata),
+            SW   (Rlen, self._ws * -3, Rdata),
+            SW   (Racc, self._ws * -4, Rdata),
+            LUI  (Racc, address >> 16),
+            ORI  (Racc, Racc, address),
+            OR   (Rdst, 0, Rdata if is_read else Racc),
+            OR   (Rsrc, 0, Racc  if is_read else Rdata),
+            ORI  (Rlen, 0, len(data)),
+            LW   (Racc, 0, Rsrc),
+            ADDI (Rsrc, Rsrc,  4),
+            SW   (Racc, 0, Rdst),
+            ADDI (Rdst, Rdst,  4),
+            ADDI (Rlen, Rlen, -1),
+            BGTZ (Rlen, -6),
+            NOP  (),
+            LW   (Racc, self._ws * -4, Rdata),
+            LW   (Rlen, self._ws * -3, Rdata),
+            LW   (Rsrc, self._ws * -2, Rdata),
+            LW   (Rdst, self._ws * -1, Rdata),
+            NOP  (),
+        ], data=data, max_steps=self._pracc_copy_steps(len(data)))
+
+    async def _pracc_fastdata_load(self, is_read):
+        if self._fastdata_handler == is_read:
+            return
+
+        self._log("PrAcc: load FASTDATA %s handler at %#0.*x",
+                  "read" if is_read else "write", self._prec, self._work_area)
+        Rdata, Rfast, Rbeg, Rend, Racc, *_ = range(1, 32)
+        handler = [
+            LUI  (Rfast, 0xff20),
+            LW   (Rbeg, 0, Rfast),
+            LW   (Rend, 0, Rfast),
+            LW   (Racc, 0, Rbeg  if is_read else Rfast),
+            SW   (Racc, 0, Rfast if is_read else Rbeg),
+            BNE  (Rbeg, Rend, -3),
+            ADDIU(Rbeg, Rbeg, 4),
+            LUI  (Racc, 0xff20),
+            ORI  (Racc, Racc, 0x0200),
+            JR   (Racc),
+            NOP  (),
+        ]
+        await self._pracc_copy_words(self._work_area, handler, is_read=False)
+        for offset in range(0, len(handler) * 4, 16):
+            await self._pracc_sync_icache(self._work_area + offset)
+        self._fastdata_handler = is_read
+
+    async def _pracc_fastdata_copy(self, address, data, is_read):
+        await self._pracc_fastdata_load(is_read)
+
+        self._log("PrAcc: FASTDATA %s address=%#0.*x count=%d",
+                  "read" if is_read else "write", self._prec, address, len(data))
+        Rdata, Rfast, Rbeg, Rend, Racc, *_ = range(1, 32)
+        saved = await self._exec_pracc_bare(code=[
+            SW   (Rfast, self._ws * 0, Rdata),
+            SW   (Rbeg,  self._ws * 1, Rdata),
+            SW   (Rend,  self._ws * 2, Rdata),
+            SW   (Racc,  self._ws * 3, Rdata),
+            LUI  (Racc,  self._work_area >> 16),
+            ORI  (Racc,  Racc, self._work_area),
+            JR   (Racc),
+            NOP  (),
+        ], data=[0] * 4, suspend_state="FastData", fastdata=True)
+
+        # Shifting in SPrAcc=0 completes the pending access, and the shifted out SPrAcc shows
+        # whether there was one. The handler first reads the start and end addresses.
+        await self.lower.write_ir(IR_FASTDATA)
+        results = []
+        for word in [address, address + (len(data) - 1) * 4, *data]:
+            results.append(await self.lower.exchange_dr(bits(word << 1, 33), defer=True))
+        await self.lower.collect()
+        if not all(result.result()[0] for result in results):
+            raise EJTAGError("FASTDATA: target did not keep up with the transfer, "
+                             "try a lower frequency")
+
+        await self._exec_pracc(code=[
+            LW   (Rfast, self._ws * 0, Rdata),
+            LW   (Rbeg,  self._ws * 1, Rdata),
+            LW   (Rend,  self._ws * 2, Rdata),
+            LW   (Racc,  self._ws * 3, Rdata),
+            NOP  (),
+        ], data=saved, entry_state="FastData")
+
+        return [int(result.result()[1:]) for result in results[2:]]
+
+    async def _pracc_copy_memory(self, address, data, is_read):
+        head_length = min(-address % 4, len(data))
+        tail_length = (len(data) - head_length) % 4
+        body_length = len(data) - head_length - tail_length
+
+        result = []
+        if head_length:
+            result += await self._pracc_copy_bytes(address, head_length,
+                                                   data[:head_length], is_read)
+            address += head_length
+            data     = data[head_length:]
+
+        words = [int.from_bytes(bytes(data[offset:offset + 4]), self.target_endianness())
+                 for offset in range(0, body_length, 4)]
+        if self._work_area is not None:
+            chunk_size, copy_words = 0x4000, self._pracc_fastdata_copy
+        else:
+            chunk_size, copy_words = 0x100,  self._pracc_copy_words
+        for offset in range(0, len(words), chunk_size):
+            for word in await copy_words(address + offset * 4,
+                                         words[offset:offset + chunk_size], is_read):
+                result += word.to_bytes(4, self.target_endianness())
+        address += body_length
+        data     = data[body_length:]
+
+        if tail_length:
+            result += await self._pracc_copy_bytes(address, tail_length,
+                                                   data[:tail_length], is_read)
+        return result
 
     async def _pracc_read_memory(self, address, length):
-        data = await self._pracc_copy_memory(address, length, data=[0] * length, is_read=True)
+        data = await self._pracc_copy_memory(address, [0] * length, is_read=True)
         return bytes(data)
 
     async def _pracc_write_memory(self, address, data):
-        await self._pracc_copy_memory(address, len(data), [*data], is_read=False)
+        await self._pracc_copy_memory(address, [*data], is_read=False)
 
     # PrAcc cache operations
 
@@ -658,6 +809,23 @@ class EJTAGDebugInterface(aobject, GDBRemote):
     def target_endianness(self):
         return "big"
 
+    def target_memory_map(self):
+        if self.bits != 32:
+            # The 64-bit address space is not described, so no memory is cached.
+            return None
+        # RAM is normally accessed through kseg0. The boot flash (at the reset vector, physical
+        # address 0x1fc00000) is accessed through both kseg0 and kseg1. Any other memory, either
+        # unmapped in kseg1 or mapped through the TLB in kuseg and kseg2/3, may be I/O.
+        kseg0, kseg1 = KSEG0_addr & self._mask, KSEG1_addr & self._mask
+        return [
+            ("io",  KUSEG_addr & self._mask, 0x8000_0000),
+            ("ram", kseg0,                   0x1fc0_0000),
+            ("rom", kseg0 + 0x1fc0_0000,     0x0040_0000),
+            ("io",  kseg1,                   0x1fc0_0000),
+            ("rom", kseg1 + 0x1fc0_0000,     0x0040_0000),
+            ("io",  KSEG2_addr & self._mask, 0x4000_0000),
+        ]
+
     def target_triple(self):
         if self.target_endianness() == "big":
             return "mips-unknown-none"
@@ -789,14 +957,14 @@ class EJTAGDebugInterface(aobject, GDBRemote):
     async def target_read_memory(self, address, length):
         self._check_state("read memory", "Stopped")
         if address % self._ws == 0 and length == self._ws:
-            return struct.pack("<L", await self._pracc_read_word(address))
+            return (await self._pracc_read_word(address)).to_bytes(4, self.target_endianness())
         else:
             return await self._pracc_read_memory(address, length)
 
     async def target_write_memory(self, address, data):
         self._check_state("write memory", "Stopped")
         if address % self._ws == 0 and len(data) == self._ws:
-            await self._pracc_write_word(address, *struct.unpack("<L", data))
+            await self._pracc_write_word(address, int.from_bytes(data, self.target_endianness()))
         else:
             await self._pracc_write_memory(address, data)
 
@@ -808,6 +976,13 @@ class DebugMIPSApplet(JTAGProbeApplet, name="debug-mips"):
     description = """
     Debug MIPS processors via the EJTAG interface.
 
+    Memory is transferred in aligned words through PrAcc. If a work area in target RAM is
+    specified with --work-area, bulk memory transfers use the FASTDATA channel, which is much
+    faster; the contents of the work area (64 bytes) are destroyed.
+
+    The GDB server caches RAM (kseg0) and the boot flash (treated as ROM) while the target is
+    stopped; all other memory is accessed as I/O.
+
     This applet supports dumping CPU state, which is also useful to check if the CPU is recognized
     correctly, and running a GDB remote protocol server for a debugger. The supported debugger
     features are:
@@ -836,9 +1011,16 @@ class DebugMIPSApplet(JTAGProbeApplet, name="debug-mips"):
     def add_run_arguments(cls, parser, access):
         super().add_run_tap_arguments(parser, access)
 
+        def address(arg):
+            return int(arg, 0)
+
+        parser.add_argument(
+            "--work-area", metavar="ADDRESS", type=address, default=None,
+            help="use 64 bytes of target RAM at ADDRESS for FASTDATA memory transfers")
+
     async def run(self, device, args):
         tap_iface = await self.run_tap(DebugMIPSApplet, device, args)
-        return await EJTAGDebugInterface(tap_iface, self.logger)
+        return await EJTAGDebugInterface(tap_iface, self.logger, work_area=args.work_area)
 
     @classmethod
     def add_interact_arguments(cls, parser):
@@ -885,3 +1067,120 @@ class DebugMIPSApplet(JTAGProbeApplet, name="debug-mips"):
             # Same as above.
             if ejtag_iface.target_attached():
                 await ejtag_iface.target_detach()
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+
+
+class EJTAGPrAccTestCase(unittest.TestCase):
+    # Emulates just enough of a MIPS32 CPU executing from dmseg to run the PrAcc copy loops.
+    MEMORY_BASE = 0x8000_0000
+
+    def setUp(self):
+        self.iface = object.__new__(EJTAGDebugInterface)
+        self.iface._logger = logging.getLogger(__name__)
+        self.iface._level  = logging.DEBUG
+        self.iface._state  = "Stopped"
+        self.iface.bits    = 32
+        self.iface._prec   = 8
+        self.iface._ws     = 4
+        self.iface._mask   = 0xffff_ffff
+        self.iface._work_area = None
+
+        self.memory  = bytearray(random.Random(0).getrandbits(8) for _ in range(0x1000))
+        self.pending = None
+        self.cpu     = self._cpu()
+        self.access  = next(self.cpu)
+
+        async def exchange_control(PrAcc=1):
+            if PrAcc == 0:
+                self.access = self.cpu.send(self.pending)
+            return DR_CONTROL(DM=1, PrAcc=1, PRnW=self.access[1])
+        async def read_address():
+            return self.access[0]
+        async def read_data():
+            return self.access[2]
+        async def write_data(data):
+            self.pending = data
+        self.iface._exchange_control = exchange_control
+        self.iface._read_address     = read_address
+        self.iface._read_data        = read_data
+        self.iface._write_data       = write_data
+
+    def _cpu(self):
+        regs = [0] * 32
+        # On debug entry, r1 is set up to point to the data area; see _pracc_debug_enter.
+        regs[1] = (DMSEG_addr + 0x1200) & 0xffff_ffff
+        def sext(value):
+            return value - 0x10000 if value & 0x8000 else value
+        def load(address, size):
+            if address & DMSEG_mask & 0xffff_ffff == DMSEG_addr & 0xffff_ffff:
+                assert size == 4
+                return (yield (address, 0, None))
+            offset = address - self.MEMORY_BASE
+            return int.from_bytes(self.memory[offset:offset + size], "big")
+        def store(address, size, value):
+            if address & DMSEG_mask & 0xffff_ffff == DMSEG_addr & 0xffff_ffff:
+                assert size == 4
+                yield (address, 1, value)
+                return
+            offset = address - self.MEMORY_BASE
+            self.memory[offset:offset + size] = \
+                (value & ((1 << size * 8) - 1)).to_bytes(size, "big")
+
+        pc, delay_pc = (DMSEG_addr + 0x0200) & 0xffff_ffff, None
+        while True:
+            instr = yield from load(pc, 4)
+            op, rs, rt, rd, fn = \
+                instr >> 26, (instr >> 21) & 31, (instr >> 16) & 31, (instr >> 11) & 31, instr & 63
+            imm, next_pc = instr & 0xffff, pc + 4
+            if op == 0x00 and fn == 0x00:
+                regs[rd] = (regs[rt] << ((instr >> 6) & 31)) & 0xffff_ffff
+            elif op == 0x00 and fn == 0x25:
+                regs[rd] = regs[rs] | regs[rt]
+            elif op in (0x04, 0x07):
+                taken = (regs[rs] == regs[rt]) if op == 0x04 else \
+                        (0 < regs[rs] < 0x8000_0000)
+                if taken:
+                    next_pc = (pc + 4 + sext(imm) * 4) & 0xffff_ffff
+            elif op == 0x08:
+                regs[rt] = (regs[rs] + sext(imm)) & 0xffff_ffff
+            elif op == 0x0d:
+                regs[rt] = regs[rs] | imm
+            elif op == 0x0f:
+                regs[rt] = imm << 16
+            elif op in (0x23, 0x24):
+                address = (regs[rs] + sext(imm)) & 0xffff_ffff
+                regs[rt] = yield from load(address, 4 if op == 0x23 else 1)
+            elif op in (0x2b, 0x28):
+                address = (regs[rs] + sext(imm)) & 0xffff_ffff
+                yield from store(address, 4 if op == 0x2b else 1, regs[rt])
+            else:
+                assert False, "unsupported instruction {:08x}".format(instr)
+            regs[0] = 0
+            if delay_pc is not None:
+                pc, delay_pc = delay_pc, None
+            elif next_pc != pc + 4:
+                pc, delay_pc = pc + 4, next_pc
+            else:
+                pc = next_pc
+
+    def test_read_memory(self):
+        address, length = self.MEMORY_BASE + 0x3, 0x500
+        data = asyncio.get_event_loop().run_until_complete(
+            self.iface._pracc_read_memory(address, length))
+        self.assertEqual(data, self.memory[0x3:0x3 + length])
+
+    def test_write_memory(self):
+        address, data = self.MEMORY_BASE + 0x5, bytes(range(256)) * 5
+        asyncio.get_event_loop().run_until_complete(
+            self.iface._pracc_write_memory(address, data))
+        self.assertEqual(self.memory[0x5:0x5 + len(data)], data)
+
+    def test_memory_map(self):
+        address = 0
+        for kind, start, length in self.iface.target_memory_map():
+            self.assertEqual(start, address)
+            address += length
+        self.assertEqual(address, 1 << 32)
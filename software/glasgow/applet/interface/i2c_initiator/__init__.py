@@ -1,19 +1,49 @@
+# Batched transactions
+# --------------------
+#
+# The subtarget replies to every write command with the number of bytes that were not
+# acknowledged, and to every read command with exactly as many bytes as were requested, even if
+# the address was not acknowledged. (After a byte is not acknowledged, the rest of the bytes
+# of the write command are discarded, so that they are not interpreted as commands.) The length
+# of the reply to a sequence of commands is therefore known in advance, and many transactions
+# can be queued at once, with their acknowledgement status and data read back together.
+#
+# Reads longer than the 16-bit count are split into several read commands, all but the last
+# of which acknowledge every byte (including their last one), so that the target continues
+# the same read.
+#
+# Scanning and polling
+# --------------------
+#
+# Scanning the bus and polling a device until it acknowledges its address (e.g. while an EEPROM
+# is busy with a write cycle) are done entirely in gateware, since either would otherwise need
+# a USB round trip per probed address. A scan is given a bitmap of the addresses to probe, and
+# replies with a bitmap of the addresses that acknowledged; a poll is given the number of
+# attempts, and replies with whether the address was acknowledged before they ran out.
+
 import argparse
+import asyncio
 import logging
 import math
 from nmigen.compat import *
 
 from ....support.pyrepl import *
 from ....gateware.pads import *
-from ....gateware.i2c import I2CInitiator
+from ....gateware.i2c import I2CInitiator, I2CTarget
 from ... import *
 
 
-CMD_START = 0x01
-CMD_STOP  = 0x02
-CMD_COUNT = 0x03
-CMD_WRITE = 0x04
-CMD_READ  = 0x05
+CMD_START     = 0x01
+CMD_STOP      = 0x02
+CMD_COUNT     = 0x03
+CMD_WRITE     = 0x04
+CMD_READ      = 0x05
+CMD_SCAN      = 0x06
+CMD_POLL      = 0x07
+CMD_READ_MORE = 0x08
+
+SCAN_WRITE = 0b01
+SCAN_READ  = 0b10
 
 
 class I2CInitiatorSubtarget(Module):
@@ -24,6 +54,12 @@ class I2CInitiatorSubtarget(Module):
 
         cmd   = Signal(8)
         count = Signal(16)
+        addr  = Signal(7)
+        mode  = Signal(2)
+        mask  = Signal(8)
+        found = Signal(8)
+        rd    = Signal()
+        hit   = Signal()
 
         self.submodules.fsm = FSM(reset_state="IDLE")
         self.fsm.act("IDLE",
@@ -48,12 +84,19 @@ class I2CInitiatorSubtarget(Module):
                 ).Else(
                     NextState("WRITE-FIRST")
                 )
-            ).Elif(cmd == CMD_READ,
+            ).Elif((cmd == CMD_READ) | (cmd == CMD_READ_MORE),
                 If(count == 0,
                     NextState("IDLE")
                 ).Else(
                     NextState("READ-FIRST")
                 )
+            ).Elif(cmd == CMD_SCAN,
+                NextValue(addr, 0),
+                NextValue(hit, 0),
+                NextState("SCAN-MODE")
+            ).Elif(cmd == CMD_POLL,
+                NextValue(hit, 0),
+                NextState("POLL-ADDR")
             ).Else(
                 NextState("IDLE")
             )
@@ -98,12 +141,22 @@ class I2CInitiatorSubtarget(Module):
             If(in_fifo.writable,
                 in_fifo.we.eq(1),
                 in_fifo.din.eq(count),
-                NextValue(count, 0),
+                If(count != 0,
+                    NextValue(count, count - 1)
+                ),
+                NextState("SKIP")
+            )
+        )
+        self.fsm.act("SKIP",
+            If(count == 0,
                 NextState("IDLE")
+            ).Elif(out_fifo.readable,
+                out_fifo.re.eq(1),
+                NextValue(count, count - 1)
             )
         )
         self.fsm.act("READ-FIRST",
-            self.i2c_initiator.ack_i.eq(~(count == 1)),
+            self.i2c_initiator.ack_i.eq(~(count == 1) | (cmd == CMD_READ_MORE)),
             self.i2c_initiator.read.eq(1),
             NextValue(count, count - 1),
             NextState("READ")
@@ -116,13 +169,149 @@ class I2CInitiatorSubtarget(Module):
                     If(count == 0,
                         NextState("IDLE")
                     ).Else(
-                        self.i2c_initiator.ack_i.eq(~(count == 1)),
+                        self.i2c_initiator.ack_i.eq(~(count == 1) | (cmd == CMD_READ_MORE)),
                         self.i2c_initiator.read.eq(1),
                         NextValue(count, count - 1)
                     )
                 )
             )
         )
+        self.fsm.act("SCAN-MODE",
+            If(out_fifo.readable,
+                out_fifo.re.eq(1),
+                NextValue(mode, out_fifo.dout),
+                NextState("SCAN-MASK")
+            )
+        )
+        self.fsm.act("SCAN-MASK",
+            If(out_fifo.readable,
+                out_fifo.re.eq(1),
+                NextValue(mask, out_fifo.dout),
+                NextState("SCAN-NEXT")
+            )
+        )
+        self.fsm.act("SCAN-NEXT",
+            If(mask[0] & ((mode & SCAN_WRITE) != 0),
+                NextValue(rd, 0),
+                NextState("SCAN-START")
+            ).Elif(mask[0] & ((mode & SCAN_READ) != 0),
+                NextValue(rd, 1),
+                NextState("SCAN-START")
+            ).Else(
+                NextState("SCAN-SHIFT")
+            )
+        )
+        self.fsm.act("SCAN-START",
+            If(~self.i2c_initiator.busy,
+                self.i2c_initiator.start.eq(1),
+                NextState("SCAN-ADDR")
+            )
+        )
+        self.fsm.act("SCAN-ADDR",
+            If(~self.i2c_initiator.busy,
+                self.i2c_initiator.data_i.eq(Cat(rd, addr)),
+                self.i2c_initiator.write.eq(1),
+                NextState("SCAN-ACK")
+            )
+        )
+        self.fsm.act("SCAN-ACK",
+            If(~self.i2c_initiator.busy,
+                NextValue(hit, self.i2c_initiator.ack_o),
+                If(self.i2c_initiator.ack_o & rd,
+                    # Read one byte and do not acknowledge it, so that the device releases SDA.
+                    self.i2c_initiator.ack_i.eq(0),
+                    self.i2c_initiator.read.eq(1),
+                ),
+                NextState("SCAN-STOP")
+            )
+        )
+        self.fsm.act("SCAN-STOP",
+            If(~self.i2c_initiator.busy,
+                self.i2c_initiator.stop.eq(1),
+                NextState("SCAN-CHECK")
+            )
+        )
+        self.fsm.act("SCAN-CHECK",
+            If(~self.i2c_initiator.busy,
+                # Like in a write scan, only do a read scan if a write scan found nothing, to
+                # avoid the side effects of reading a byte.
+                If(~hit & ~rd & ((mode & SCAN_READ) != 0),
+                    NextValue(rd, 1),
+                    NextState("SCAN-START")
+                ).Else(
+                    NextState("SCAN-SHIFT")
+                )
+            )
+        )
+        self.fsm.act("SCAN-SHIFT",
+            NextValue(found, Cat(found[1:], hit)),
+            NextValue(mask, mask >> 1),
+            NextValue(addr, addr + 1),
+            NextValue(hit, 0),
+            If(addr[0:3] == 7,
+                NextState("SCAN-REPORT")
+            ).Else(
+                NextState("SCAN-NEXT")
+            )
+        )
+        self.fsm.act("SCAN-REPORT",
+            If(in_fifo.writable,
+                in_fifo.we.eq(1),
+                in_fifo.din.eq(found),
+                If(addr == 0,
+                    NextState("IDLE")
+                ).Else(
+                    NextState("SCAN-MASK")
+                )
+            )
+        )
+        self.fsm.act("POLL-ADDR",
+            If(out_fifo.readable,
+                out_fifo.re.eq(1),
+                NextValue(addr, out_fifo.dout),
+                NextState("POLL-START")
+            )
+        )
+        self.fsm.act("POLL-START",
+            If(count == 0,
+                NextState("POLL-REPORT")
+            ).Elif(~self.i2c_initiator.busy,
+                self.i2c_initiator.start.eq(1),
+                NextValue(count, count - 1),
+                NextState("POLL-WRITE")
+            )
+        )
+        self.fsm.act("POLL-WRITE",
+            If(~self.i2c_initiator.busy,
+                self.i2c_initiator.data_i.eq(Cat(C(0, 1), addr)),
+                self.i2c_initiator.write.eq(1),
+                NextState("POLL-ACK")
+            )
+        )
+        self.fsm.act("POLL-ACK",
+            If(~self.i2c_initiator.busy,
+                NextValue(hit, self.i2c_initiator.ack_o),
+                self.i2c_initiator.stop.eq(1),
+                NextState("POLL-CHECK")
+            )
+        )
+        self.fsm.act("POLL-CHECK",
+            If(~self.i2c_initiator.busy,
+                If(hit,
+                    NextState("POLL-REPORT")
+                ).Else(
+                    NextState("POLL-START")
+                )
+            )
+        )
+        self.fsm.act("POLL-REPORT",
+            If(in_fifo.writable,
+                in_fifo.we.eq(1),
+                in_fifo.din.eq(hit),
+                NextValue(count, 0),
+                NextState("IDLE")
+            )
+        )
 
 
 class I2CInitiatorInterface:
@@ -156,9 +345,27 @@ class I2CInitiatorInterface:
     async def _cmd_read(self):
         await self.lower.write([CMD_READ])
 
+    async def _cmd_read_more(self):
+        await self.lower.write([CMD_READ_MORE])
+
+    async def _cmd_count_read(self, size):
+        for offset in range(0, size, 0xfffe):
+            await self._cmd_count(min(size - offset, 0xfffe))
+            if offset + 0xfffe < size:
+                await self._cmd_read_more()
+            else:
+                await self._cmd_read()
+
     async def _data_read(self, size):
         return await self.lower.read(size)
 
+    async def _cmd_scan(self, mode, mask):
+        assert len(mask) == 16
+        await self.lower.write([CMD_SCAN, mode, *mask])
+
+    async def _cmd_poll(self, addr):
+        await self.lower.write([CMD_POLL, addr])
+
     async def write(self, addr, data, stop=False):
         data = bytes(data)
 
@@ -197,8 +404,7 @@ class I2CInitiatorInterface:
         await self._cmd_count(1)
         await self._cmd_write()
         await self._data_write([(addr << 1) | 1])
-        await self._cmd_count(size)
-        await self._cmd_read()
+        await self._cmd_count_read(size)
         if stop: await self._cmd_stop()
 
         unacked, = await self._data_read(1)
@@ -210,19 +416,89 @@ class I2CInitiatorInterface:
             self._logger.log(self._level, "I2C: unacked")
             return None
 
-    async def poll(self, addr):
-        self._logger.trace("I2C: poll addr=%s", bin(addr))
-        await self._cmd_start()
-        await self._cmd_count(1)
-        await self._cmd_write()
-        await self._data_write([(addr << 1) | 0])
-        await self._cmd_stop()
-
-        unacked, = await self._data_read(1)
-        if unacked == 0:
+    async def transact(self, transactions, *, poll_attempts=None):
+        """
+        Perform a sequence of transactions with a single USB round trip. Each transaction is
+        ``(addr, write_data, read_size)``; it writes ``write_data`` to ``addr`` unless it is
+        ``None``, then reads ``read_size`` bytes from ``addr`` (after a repeated start, if there
+        was a write) unless it is ``None`` or zero, and ends with a stop condition.
+
+        If ``poll_attempts`` is not ``None``, ``addr`` is polled after each transaction (see
+        ``poll``) before the next one starts, e.g. to wait for an EEPROM write cycle.
+
+        Returns a list with, for each transaction, ``None`` if any byte of it was not
+        acknowledged (or if polling timed out), and otherwise the read data (empty if nothing
+        was read).
+        """
+        transactions = list(transactions)
+
+        reply_length = 0
+        for addr, write_data, read_size in transactions:
+            self._logger.log(self._level, "I2C: start addr=%s write=<%s> read=%s stop",
+                             bin(addr), "" if write_data is None else bytes(write_data).hex(),
+                             read_size)
+            if write_data is not None:
+                await self._cmd_start()
+                await self._cmd_count(1 + len(write_data))
+                await self._cmd_write()
+                await self._data_write([(addr << 1) | 0])
+                await self._data_write(write_data)
+                reply_length += 1
+            if read_size:
+                await self._cmd_start()
+                await self._cmd_count(1)
+                await self._cmd_write()
+                await self._data_write([(addr << 1) | 1])
+                await self._cmd_count_read(read_size)
+                reply_length += 1 + read_size
+            await self._cmd_stop()
+            if poll_attempts is not None:
+                await self._cmd_count(poll_attempts)
+                await self._cmd_poll(addr)
+                reply_length += 1
+
+        reply = await self._data_read(reply_length)
+
+        results = []
+        offset  = 0
+        for addr, write_data, read_size in transactions:
+            acked = True
+            if write_data is not None:
+                acked  &= reply[offset] == 0
+                offset += 1
+            if read_size:
+                acked  &= reply[offset] == 0
+                data    = reply[offset + 1:offset + 1 + read_size]
+                offset += 1 + read_size
+            else:
+                data    = b""
+            if poll_attempts is not None:
+                acked  &= reply[offset] == 1
+                offset += 1
+            if acked:
+                self._logger.log(self._level, "I2C: addr=%s acked data=<%s>",
+                                 bin(addr), bytes(data).hex())
+                results.append(bytes(data))
+            else:
+                self._logger.log(self._level, "I2C: addr=%s unacked", bin(addr))
+                results.append(None)
+        return results
+
+    async def poll(self, addr, attempts=1):
+        """
+        Address ``addr`` for writing up to ``attempts`` times, until it is acknowledged.
+
+        Returns ``True`` if it was acknowledged, and ``False`` otherwise.
+        """
+        self._logger.trace("I2C: poll addr=%s attempts=%d", bin(addr), attempts)
+        await self._cmd_count(attempts)
+        await self._cmd_poll(addr)
+
+        acked, = await self._data_read(1)
+        if acked:
             self._logger.log(self._level, "I2C: poll addr=%s acked", bin(addr))
 
-        return unacked == 0
+        return bool(acked)
 
     async def device_id(self, addr):
         if await self.write(0b1111_100, [addr]) is False:
@@ -237,24 +513,22 @@ class I2CInitiatorInterface:
 
     async def scan(self, addresses=range(0b0001_000, 0b1111_000), *, read=True, write=True):
         # default address range: don't scan reserved I2C addresses
-        found = set()
+        mask = bytearray(16)
         for addr in addresses:
-            # Do write scanning before read scanning to reduce the likeliness of possible
-            # side effects due to really reading 1 byte in the read scan
-            if write:
-                if await self.write(addr, [], stop=True) is True:
-                    self._logger.log(self._level, "I2C scan: found write address %s",
-                                        "{:#09b}".format(addr))
-                    found.add(addr)
-                    # After a successful write detection no read scan is done anymore
-                    continue
-            if read:
-                # We need to read at least one byte in order to transmit a NAK bit
-                # so that the addressed device releases SDA.
-                if await self.read(addr, 1, stop=True) is not None:
-                    self._logger.log(self._level, "I2C scan: found read address %s",
-                                        "{:#09b}".format(addr))
-                    found.add(addr)
+            mask[addr // 8] |= 1 << (addr % 8)
+        # Write scanning is done before read scanning (and the latter only for addresses that
+        # were not found by the former) to reduce the likeliness of possible side effects due
+        # to really reading 1 byte in the read scan.
+        mode = (SCAN_WRITE if write else 0) | (SCAN_READ if read else 0)
+        await self._cmd_scan(mode, mask)
+        bitmap = await self._data_read(16)
+
+        found = set()
+        for addr in range(128):
+            if bitmap[addr // 8] & (1 << (addr % 8)):
+                self._logger.log(self._level, "I2C scan: found address %s",
+                                 "{:#09b}".format(addr))
+                found.add(addr)
         return found
 
 
@@ -264,7 +538,7 @@ class I2CInitiatorApplet(GlasgowApplet, name="i2c-initiator"):
     description = """
     Initiate transactions on the I²C bus.
 
-    Maximum transaction length is 65535 bytes.
+    Maximum write transaction length is 65535 bytes; read transactions may be of any length.
     """
     required_revision = "C0"
 
@@ -355,7 +629,135 @@ class I2CInitiatorApplet(GlasgowApplet, name="i2c-initiator"):
 
 # -------------------------------------------------------------------------------------------------
 
+class I2CInitiatorTestTarget(Module):
+    """
+    An I2C target at ``address`` that acknowledges the first ``ack_count`` bytes of every write,
+    and returns consecutive bytes starting at ``data`` on reads. It does not acknowledge its
+    address until ``busy`` start conditions have been seen on the bus.
+    """
+    def __init__(self, pads, address, ack_count, data, busy=0):
+        self.scl_t = TSTriple()
+        self.sda_t = TSTriple()
+        self.submodules.i2c_target = i2c_target = I2CTarget(self)
+
+        ###
+
+        # Both the initiator and the target only ever pull the lines low.
+        self.comb += [
+            pads.scl_t.i.eq(~pads.scl_t.oe & ~self.scl_t.oe),
+            pads.sda_t.i.eq(~pads.sda_t.oe & ~self.sda_t.oe),
+            self.scl_t.i.eq(pads.scl_t.i),
+            self.sda_t.i.eq(pads.sda_t.i),
+        ]
+
+        sda_r   = Signal(reset=1)
+        busy    = Signal(8, reset=busy)
+        self.sync += [
+            sda_r.eq(pads.sda_t.i),
+            If(pads.scl_t.i & sda_r & ~pads.sda_t.i & (busy != 0),
+                busy.eq(busy - 1)
+            )
+        ]
+
+        written = Signal(8)
+        self.comb += [
+            i2c_target.address.eq(Mux(busy == 0, address, 0)),
+            i2c_target.ack_o.eq(i2c_target.write & (written < ack_count)),
+            i2c_target.data_o.eq(data),
+        ]
+        self.sync += [
+            If(i2c_target.start,
+                written.eq(0)
+            ).Elif(i2c_target.write,
+                written.eq(written + 1)
+            ),
+            If(i2c_target.read,
+                data.eq(data + 1)
+            )
+        ]
+
+
 class I2CInitiatorAppletTestCase(GlasgowAppletTestCase, applet=I2CInitiatorApplet):
     @synthesis_test
     def test_build(self):
         self.assertBuilds()
+
+    def setup_target(self):
+        self.build_simulated_applet()
+        mux_iface = self.applet.mux_interface
+        mux_iface.submodules.target = I2CInitiatorTestTarget(mux_iface.pads,
+            address=0b1010000, ack_count=2, data=Signal(8, reset=0x40))
+
+    @applet_simulation_test("setup_target", ["--bit-rate", "1000"])
+    @asyncio.coroutine
+    def test_transact_nak(self):
+        i2c_iface = yield from self.run_simulated_applet()
+
+        # The bytes following the one that is not acknowledged are valid commands, which must
+        # not be executed.
+        results = yield from i2c_iface.transact([
+            (0b1010000, [0x00, 0x01, 0x02, CMD_READ, CMD_START, CMD_STOP], None),
+            (0b1010000, [0x00], 2),
+            (0b1010001, None, 1),
+            (0b1010000, None, 3),
+        ])
+        self.assertEqual(results, [None, b"\x40\x41", None, b"\x42\x43\x44"])
+
+        self.assertEqual((yield from i2c_iface.write(0b1010000, [0x00, 0x01, 0x02])), False)
+        self.assertEqual((yield from i2c_iface.read(0b1010000, 1, stop=True)), b"\x45")
+
+    @applet_simulation_test("setup_target", ["--bit-rate", "1000"])
+    @asyncio.coroutine
+    def test_scan(self):
+        i2c_iface = yield from self.run_simulated_applet()
+
+        addresses = range(0b1001100, 0b1010100)
+        self.assertEqual((yield from i2c_iface.scan(addresses, read=False)), {0b1010000})
+        self.assertEqual((yield from i2c_iface.scan(addresses, write=False)), {0b1010000})
+        # The read scan reads a byte from the target.
+        self.assertEqual((yield from i2c_iface.read(0b1010000, 1, stop=True)), b"\x41")
+        self.assertEqual((yield from i2c_iface.scan([0b1010001])), set())
+
+    @applet_simulation_test("setup_target", ["--bit-rate", "1000"])
+    @asyncio.coroutine
+    def test_read_more(self):
+        i2c_iface = yield from self.run_simulated_applet()
+
+        # Split a read the same way as _cmd_count_read, but with much shorter parts.
+        yield from i2c_iface._cmd_start()
+        yield from i2c_iface._cmd_count(1)
+        yield from i2c_iface._cmd_write()
+        yield from i2c_iface._data_write([(0b1010000 << 1) | 1])
+        yield from i2c_iface._cmd_count(2)
+        yield from i2c_iface._cmd_read_more()
+        yield from i2c_iface._cmd_count(3)
+        yield from i2c_iface._cmd_read_more()
+        yield from i2c_iface._cmd_count(1)
+        yield from i2c_iface._cmd_read()
+        yield from i2c_iface._cmd_stop()
+        self.assertEqual((yield from i2c_iface._data_read(7)), b"\x00\x40\x41\x42\x43\x44\x45")
+
+        # The last byte was not acknowledged, so the target has released the bus.
+        self.assertEqual((yield from i2c_iface.read(0b1010000, 1, stop=True)), b"\x46")
+
+    def setup_busy_target(self):
+        self.build_simulated_applet()
+        mux_iface = self.applet.mux_interface
+        mux_iface.submodules.target = I2CInitiatorTestTarget(mux_iface.pads,
+            address=0b1010000, ack_count=2, data=Signal(8, reset=0x40), busy=4)
+
+    @applet_simulation_test("setup_busy_target", ["--bit-rate", "1000"])
+    @asyncio.coroutine
+    def test_poll(self):
+        i2c_iface = yield from self.run_simulated_applet()
+
+        self.assertEqual((yield from i2c_iface.poll(0b1010000, attempts=2)), False)
+        self.assertEqual((yield from i2c_iface.poll(0b1010000, attempts=0)), False)
+        self.assertEqual((yield from i2c_iface.poll(0b1010000, attempts=3)), True)
+
+        results = yield from i2c_iface.transact([
+            (0b1010000, [0x00], None),
+            (0b1010001, [0x00], None),
+            (0b1010000, None, 1),
+        ], poll_attempts=2)
+        self.assertEqual(results, [b"", None, b"\x40"])
@@ -85,6 +85,9 @@ class JTAGOpenOCDApplet(GlasgowApplet, name="jtag-openocd"):
     ::
         glasgow run jtag-openocd unix:/tmp/jtag.sock
         openocd -c 'interface remote_bitbang; remote_bitbang_host /tmp/jtag.sock'
+
+    The remote bitbang protocol transfers every TCK edge separately, which limits throughput
+    regardless of the TCK frequency. The jtag-vpi applet provides much higher throughput.
     """
 
     __pins = ("tck", "tms", "tdi", "tdo", "trst")
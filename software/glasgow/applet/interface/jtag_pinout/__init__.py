@@ -1,6 +1,16 @@
 # Ref: IEEE Std 1149.1-2001
 # Accession: G00018
 
+# Pinout search
+# -------------
+#
+# The search is combinatorial over TCK×TMS×TDI, and every candidate assignment requires entering
+# Shift-IR and shifting some bits while sampling all pins. Doing this by driving every TCK edge
+# from the host is very slow, so the subtarget includes a sequencer that, given a pin assignment,
+# a TMS sequence and a TDI sequence, clocks both of them out and returns only the pin states
+# sampled while shifting TDI. Sequences for many candidates are queued back to back, and all of
+# the results are read at once.
+
 import logging
 import asyncio
 import random
@@ -19,6 +29,7 @@ CMD_O  = 0x02
 CMD_L  = 0x03
 CMD_H  = 0x04
 CMD_I  = 0x05
+CMD_J  = 0x06
 
 
 class JTAGPinoutSubtarget(Module):
@@ -36,6 +47,19 @@ class JTAGPinoutSubtarget(Module):
         cmd   = Signal(8)
         data  = Signal(16)
 
+        seq_args     = Signal(96)
+        seq_arg_byte = Signal(4)
+        seq_tck      = seq_args[0:16]
+        seq_tms      = seq_args[16:32]
+        seq_tdi      = seq_args[32:48]
+        seq_trst     = seq_args[48:64]
+        tms_count    = Signal(8)
+        tms_bits     = Signal(16)
+        tdi_count    = Signal(8)
+        tdi_bits     = Signal(8)
+        tdi_bitno    = Signal(3)
+        capture      = Signal()
+
         self.submodules.fsm = FSM(reset_state="RECV-COMMAND")
         self.fsm.act("RECV-COMMAND",
             If(out_fifo.readable,
@@ -46,6 +70,9 @@ class JTAGPinoutSubtarget(Module):
                     NextState("WAIT")
                 ).Elif(out_fifo.dout == CMD_I,
                     NextState("SAMPLE")
+                ).Elif(out_fifo.dout == CMD_J,
+                    NextValue(seq_arg_byte, len(seq_args) // 8),
+                    NextState("SEQ-RECV-ARGS")
                 ).Else(
                     NextState("RECV-DATA-1")
                 )
@@ -99,9 +126,118 @@ class JTAGPinoutSubtarget(Module):
             If(in_fifo.writable,
                 in_fifo.we.eq(1),
                 in_fifo.din.eq(data[8:16]),
+                If(cmd == CMD_J,
+                    NextState("SEQ-TCK-H")
+                ).Else(
+                    NextState("RECV-COMMAND")
+                )
+            )
+        )
+        # CMD_J arguments: TCK, TMS, TDI and TRST# pin masks (16 bits each), TMS bit count
+        # (8 bits), TMS bits (16 bits), TDI bit count (8 bits), then TDI bits, 8 per byte.
+        self.fsm.act("SEQ-RECV-ARGS",
+            If(seq_arg_byte == 0,
+                NextValue(tms_count, seq_args[64:72]),
+                NextValue(tms_bits,  seq_args[72:88]),
+                NextValue(tdi_count, seq_args[88:96]),
+                NextValue(tdi_bitno, 0),
+                NextValue(jtag_o,  seq_tck|seq_tms|seq_tdi|seq_trst),
+                NextValue(jtag_oe, seq_tck|seq_tms|seq_tdi|seq_trst),
+                NextValue(timer, period_cyc - 1),
+                NextState("SEQ-TRST-L")
+            ).Elif(out_fifo.readable,
+                out_fifo.re.eq(1),
+                NextValue(seq_args, Cat(seq_args[8:], out_fifo.dout)),
+                NextValue(seq_arg_byte, seq_arg_byte - 1)
+            )
+        )
+        self.fsm.act("SEQ-TRST-L",
+            If(timer == 0,
+                NextValue(jtag_o, jtag_o & ~seq_trst),
+                NextValue(timer, period_cyc - 1),
+                NextState("SEQ-TRST-H")
+            ).Else(
+                NextValue(timer, timer - 1)
+            )
+        )
+        self.fsm.act("SEQ-TRST-H",
+            If(timer == 0,
+                NextValue(jtag_o, jtag_o | seq_trst),
+                NextValue(timer, period_cyc - 1),
+                NextState("SEQ-TCK-H-WAIT")
+            ).Else(
+                NextValue(timer, timer - 1)
+            )
+        )
+        self.fsm.act("SEQ-NEXT",
+            If(tms_count != 0,
+                If(tms_bits[0],
+                    NextValue(jtag_o, jtag_o | seq_tms)
+                ).Else(
+                    NextValue(jtag_o, jtag_o & ~seq_tms)
+                ),
+                NextValue(tms_bits, tms_bits[1:]),
+                NextValue(tms_count, tms_count - 1),
+                NextValue(capture, 0),
+                NextState("SEQ-TCK-L")
+            ).Elif(tdi_count != 0,
+                If(tdi_bitno == 0,
+                    NextState("SEQ-RECV-TDI")
+                ).Else(
+                    NextState("SEQ-SHIFT")
+                )
+            ).Else(
+                NextValue(jtag_oe, 0),
                 NextState("RECV-COMMAND")
             )
         )
+        self.fsm.act("SEQ-RECV-TDI",
+            If(out_fifo.readable,
+                out_fifo.re.eq(1),
+                NextValue(tdi_bits, out_fifo.dout),
+                NextState("SEQ-SHIFT")
+            )
+        )
+        self.fsm.act("SEQ-SHIFT",
+            If(tdi_bits[0],
+                NextValue(jtag_o, jtag_o | seq_tdi)
+            ).Else(
+                NextValue(jtag_o, jtag_o & ~seq_tdi)
+            ),
+            NextValue(tdi_bits, tdi_bits[1:]),
+            NextValue(tdi_bitno, tdi_bitno + 1),
+            NextValue(tdi_count, tdi_count - 1),
+            NextValue(capture, 1),
+            NextState("SEQ-TCK-L")
+        )
+        self.fsm.act("SEQ-TCK-L",
+            NextValue(jtag_o, jtag_o & ~seq_tck),
+            NextValue(timer, period_cyc - 1),
+            NextState("SEQ-TCK-L-WAIT")
+        )
+        self.fsm.act("SEQ-TCK-L-WAIT",
+            If(timer == 0,
+                If(capture,
+                    NextState("SAMPLE")
+                ).Else(
+                    NextState("SEQ-TCK-H")
+                )
+            ).Else(
+                NextValue(timer, timer - 1)
+            )
+        )
+        self.fsm.act("SEQ-TCK-H",
+            NextValue(jtag_o, jtag_o | seq_tck),
+            NextValue(timer, period_cyc - 1),
+            NextState("SEQ-TCK-H-WAIT")
+        )
+        self.fsm.act("SEQ-TCK-H-WAIT",
+            If(timer == 0,
+                NextState("SEQ-NEXT")
+            ).Else(
+                NextValue(timer, timer - 1)
+            )
+        )
 
 
 class JTAGPinoutInterface:
@@ -152,6 +288,32 @@ class JTAGPinoutInterface:
         self._log("get i= %s", "{:016b}".format(word))
         return word
 
+    async def sequence(self, *, tck, tms, tdi, trst, tms_bits, tdi_bits):
+        """
+        Queue a sequence that drives TCK, TMS, TDI and TRST# (given as pin masks) high, pulses
+        TRST#, clocks out ``tms_bits``, and then clocks out ``tdi_bits`` while sampling all pins
+        after every falling TCK edge, then releases the bus.
+
+        The sampled words are not read back; use ``get_sequence_result`` for that.
+        """
+        assert len(tms_bits) <= 16 and len(tdi_bits) <= 255
+        self._log("sequence tck=%s tms=%s tdi=%s trst=%s tms-bits=%s tdi-bits=%s",
+                  "{:016b}".format(tck), "{:016b}".format(tms),
+                  "{:016b}".format(tdi), "{:016b}".format(trst),
+                  "".join(map(str, tms_bits)), "".join(map(str, tdi_bits)))
+        tms_word = reduce(lambda x, y: x|y, (bit << n for n, bit in enumerate(tms_bits)), 0)
+        tdi_word = reduce(lambda x, y: x|y, (bit << n for n, bit in enumerate(tdi_bits)), 0)
+        await self._cmd(CMD_J)
+        await self._lower.write(struct.pack("<HHHHBHB", tck, tms, tdi, trst,
+                                            len(tms_bits), tms_word, len(tdi_bits)))
+        await self._lower.write(tdi_word.to_bytes((len(tdi_bits) + 7) // 8, "little"))
+
+    async def get_sequence_result(self, count):
+        """Read the ``count`` words sampled by one queued sequence."""
+        words = struct.unpack("<{}H".format(count), await self._lower.read(count * 2))
+        self._log("sequence result=%s", " ".join("{:016b}".format(word) for word in words))
+        return words
+
 
 class JTAGPinoutApplet(GlasgowApplet, name="jtag-pinout"):
     logger = logging.getLogger(__name__)
@@ -216,72 +378,33 @@ class JTAGPinoutApplet(GlasgowApplet, name="jtag-pinout"):
         pull_down_bits = self._from_word(~after_low & ~after_high & each)
         return high_z_bits, pull_up_bits, pull_down_bits
 
-    async def _strobe_tck(self, iface, tck):
-        await iface.set_o_0(tck)
-        await iface.wait()
-        await iface.set_o_1(tck)
-        await iface.wait()
-
-    async def _strobe_tck_input(self, iface, tck):
-        await iface.set_o_0(tck)
-        await iface.wait()
-        word = await iface.get_i()
-        await iface.set_o_1(tck)
-        await iface.wait()
-        return word
+    # Test-Logic-Reset, Run-Test/Idle, Select-DR-Scan, Select-IR-Scan, Capture-IR, Shift-IR.
+    _enter_shift_ir_tms = (1,1,1,1,1, 0, 1,1,0,0)
+
+    _pat_bits   = 32
+    _flush_bits = 64
 
-    async def _enter_shift_ir(self, iface, *, tck, tms, tdi, trst=0):
-        await iface.set_o (tck|tms|tdi|trst)
-        await iface.set_oe(tck|tms|tdi|trst)
-        await iface.wait()
-        # Pulse TRST
-        await iface.set_o_0(trst); await iface.wait()
-        await iface.set_o_1(trst); await iface.wait()
-        # Enter Test-Logic-Reset
-        await iface.set_o_1(tms)
-        for _ in range(5):
-            await self._strobe_tck(iface, tck)
-        # Enter Run-Test/Idle
-        await iface.set_o_0(tms)
-        await self._strobe_tck(iface, tck)
-        # Enter Shift-IR
-        await iface.set_o_1(tms); await self._strobe_tck(iface, tck)
-        await iface.set_o_1(tms); await self._strobe_tck(iface, tck)
-        await iface.set_o_0(tms); await self._strobe_tck(iface, tck)
-        await iface.set_o_0(tms); await self._strobe_tck(iface, tck)
-
-    async def _detect_tdo(self, iface, *, tck, tms, trst=0):
-        await self._enter_shift_ir(iface, tck=tck, tms=tms, tdi=0, trst=trst)
-
-        # Shift IR
-        ir_0 = await self._strobe_tck_input(iface, tck)
-        ir_1 = await self._strobe_tck_input(iface, tck)
-        # Release the bus
-        await iface.set_oe(0)
+    async def _queue_detect_tdo(self, iface, *, tck, tms, trst=0):
+        await iface.sequence(tck=tck, tms=tms, tdi=0, trst=trst,
+                             tms_bits=self._enter_shift_ir_tms, tdi_bits=(0,0))
 
+    async def _detect_tdo(self, iface):
+        ir_0, ir_1 = await iface.get_sequence_result(2)
         tdo_bits = self._from_word(ir_0 & ~ir_1)
         return set(tdo_bits)
 
-    async def _detect_tdi(self, iface, *, tck, tms, tdi, tdo, trst=0):
-        await self._enter_shift_ir(iface, tck=tck, tms=tms, tdi=tdi, trst=trst)
+    async def _queue_detect_tdi(self, iface, *, tck, tms, tdi, trst=0):
+        pattern  = random.getrandbits(self._pat_bits)
+        tdi_bits = [(pattern >> bit) & 1 for bit in range(self._pat_bits)]
+        tdi_bits += [1] * self._flush_bits
+        await iface.sequence(tck=tck, tms=tms, tdi=tdi, trst=trst,
+                             tms_bits=self._enter_shift_ir_tms, tdi_bits=tdi_bits)
+        return pattern
 
-        pat_bits   = 32
-        flush_bits = 64
-        pattern    = random.getrandbits(pat_bits)
-        result     = []
-
-        # Shift IR
-        for bit in range(pat_bits):
-            if pattern & (1 << bit):
-                await iface.set_o_1(tdi)
-            else:
-                await iface.set_o_0(tdi)
-            result.append(await self._strobe_tck_input(iface, tck))
-        await iface.set_o_1(tdi)
-        for bit in range(flush_bits):
-            result.append(await self._strobe_tck_input(iface, tck))
-        # Release the bus
-        await iface.set_oe(0)
+    async def _detect_tdi(self, iface, *, pattern, tdo):
+        pat_bits   = self._pat_bits
+        flush_bits = self._flush_bits
+        result     = await iface.get_sequence_result(pat_bits + flush_bits)
 
         ir_lens = []
         for ir_len in range(flush_bits):
@@ -320,39 +443,49 @@ class JTAGPinoutApplet(GlasgowApplet, name="jtag-pinout"):
                                  self.names[bit_trst])
                 data_bits = self.bits - {bit_trst}
 
+            tck_tms = [(bit_tck, bit_tms)
+                       for bit_tck in data_bits
+                       for bit_tms in data_bits - {bit_tck}]
+            for bit_tck, bit_tms in tck_tms:
+                await self._queue_detect_tdo(iface,
+                    tck=1 << bit_tck, tms=1 << bit_tms,
+                    trst=0 if bit_trst is None else 1 << bit_trst)
+
             tck_tms_tdo = []
-            for bit_tck in data_bits:
-                for bit_tms in data_bits - {bit_tck}:
-                    self.logger.debug("trying TCK=%s TMS=%s",
-                        self.names[bit_tck], self.names[bit_tms])
-                    tdo_bits = await self._detect_tdo(iface,
-                        tck=1 << bit_tck, tms=1 << bit_tms,
-                        trst=0 if bit_trst is None else 1 << bit_trst)
-                    for bit_tdo in tdo_bits - {bit_tck, bit_tms}:
-                        self.logger.info("shifted 10 out of IR with TCK=%s TMS=%s TDO=%s",
-                            self.names[bit_tck], self.names[bit_tms], self.names[bit_tdo])
-                        tck_tms_tdo.append((bit_tck, bit_tms, bit_tdo))
+            for bit_tck, bit_tms in tck_tms:
+                self.logger.debug("trying TCK=%s TMS=%s",
+                    self.names[bit_tck], self.names[bit_tms])
+                tdo_bits = await self._detect_tdo(iface)
+                for bit_tdo in tdo_bits - {bit_tck, bit_tms}:
+                    self.logger.info("shifted 10 out of IR with TCK=%s TMS=%s TDO=%s",
+                        self.names[bit_tck], self.names[bit_tms], self.names[bit_tdo])
+                    tck_tms_tdo.append((bit_tck, bit_tms, bit_tdo))
 
             if not tck_tms_tdo:
                 continue
 
             self.logger.info("detecting TDI")
+            tck_tms_tdi_tdo = []
             for (bit_tck, bit_tms, bit_tdo) in tck_tms_tdo:
                 for bit_tdi in data_bits - {bit_tck, bit_tms, bit_tdo}:
-                    self.logger.debug("trying TCK=%s TMS=%s TDI=%s TDO=%s",
+                    pattern = await self._queue_detect_tdi(iface,
+                        tck=1 << bit_tck, tms=1 << bit_tms, tdi=1 << bit_tdi,
+                        trst=0 if bit_trst is None else 1 << bit_trst)
+                    tck_tms_tdi_tdo.append((bit_tck, bit_tms, bit_tdi, bit_tdo, pattern))
+
+            for (bit_tck, bit_tms, bit_tdi, bit_tdo, pattern) in tck_tms_tdi_tdo:
+                self.logger.debug("trying TCK=%s TMS=%s TDI=%s TDO=%s",
+                    self.names[bit_tck], self.names[bit_tms],
+                    self.names[bit_tdi], self.names[bit_tdo])
+                ir_lens = await self._detect_tdi(iface, pattern=pattern, tdo=1 << bit_tdo)
+                for ir_len in ir_lens:
+                    self.logger.info("shifted %d-bit IR with TCK=%s TMS=%s TDI=%s TDO=%s",
+                        ir_len,
                         self.names[bit_tck], self.names[bit_tms],
                         self.names[bit_tdi], self.names[bit_tdo])
-                    ir_lens = await self._detect_tdi(iface,
-                        tck=1 << bit_tck, tms=1 << bit_tms, tdi=1 << bit_tdi, tdo=1 << bit_tdo,
-                        trst=0 if bit_trst is None else 1 << bit_trst)
-                    for ir_len in ir_lens:
-                        self.logger.info("shifted %d-bit IR with TCK=%s TMS=%s TDI=%s TDO=%s",
-                            ir_len,
-                            self.names[bit_tck], self.names[bit_tms],
-                            self.names[bit_tdi], self.names[bit_tdo])
-                        results.append((bit_tck, bit_tms, bit_tdi, bit_tdo, bit_trst))
-                    else:
-                        continue
+                    results.append((bit_tck, bit_tms, bit_tdi, bit_tdo, bit_trst))
+                else:
+                    continue
 
             if bit_trst is None:
                 if results:
@@ -18,10 +18,44 @@
 # by the probe adapter, synchronized to the normal JTAG command stream.
 #
 # By convention, aux[0:1] are {TRST#.Z, TRST#.O} if the probe adapter provides TRST#.
+#
+# Deferred scans
+# --------------
+#
+# Every scan that captures TDO requires the host to read the captured bits back, and if this is
+# done synchronously, each such scan costs a full USB round trip. To avoid this, the probe driver
+# can queue scans: any method that returns TDO bits accepts `defer=True`, in which case it only
+# writes the command to the FIFO and returns a `JTAGProbeDeferredResult` handle. The TDO bits for
+# all queued scans are collected with a single read when `JTAGProbeInterface.collect()` (or
+# `flush()`) is called, or when any of the handles is awaited. The synchronous methods are
+# implemented as a deferred scan that is awaited immediately.
+#
+# Compared scans
+# --------------
+#
+# When the expected TDO bits are known in advance (e.g. when playing SVF test vectors), the probe
+# driver can compare TDO with the expected value under a mask in gateware, and then nothing has to
+# be read back at all. The driver counts compared scan commands, and latches the index of the first
+# command where any unmasked TDO bit did not match; `get_compare_status()` retrieves and clears
+# this status.
+#
+# Multi-TAP scans
+# ---------------
+#
+# Boards often carry several identical devices on one chain. Rather than operating on them one
+# at a time, with all other TAPs in BYPASS, `JTAGProbeInterface.select_taps()` returns
+# a `MultiTAPInterface` that composes IR and DR scans for several TAPs into a single shift: data
+# written to it is either broadcast to every selected TAP or given per TAP, and data read from it
+# is split into a list with an entry per selected TAP. All other TAPs remain in BYPASS.
+#
+# The IR of a chain with more than one TAP cannot be segmented without knowing the IR lengths of
+# the devices on it. If they are not given explicitly, they are inferred for the common case of
+# a chain where every TAP has the same IDCODE.
 
 import struct
 import logging
 import asyncio
+import itertools
 from nmigen.compat import *
 from nmigen.compat.genlib.cdc import MultiReg
 
@@ -114,8 +148,10 @@ class JTAGProbeAdapter(Module):
 CMD_MASK       = 0b11110000
 CMD_SHIFT_TMS  = 0b00000000
 CMD_SHIFT_TDIO = 0b00010000
+CMD_SHIFT_CMP  = 0b00100000
 CMD_GET_AUX    = 0b10000000
 CMD_SET_AUX    = 0b10010000
+CMD_GET_CMP    = 0b10100000
 # CMD_SHIFT_{TMS,TDIO}
 BIT_DATA_OUT   =     0b0001
 BIT_DATA_IN    =     0b0010
@@ -132,6 +168,23 @@ class JTAGProbeDriver(Module):
         align   = Signal(3)
         shreg_o = Signal(8)
         shreg_i = Signal(8)
+        shreg_e = Signal(8)
+        shreg_m = Signal(8)
+
+        cmp_count   = Signal(32)
+        cmp_fail    = Signal()
+        cmp_fail_at = Signal(32)
+        cmp_status  = Signal(40)
+        cmp_byte    = Signal(3)
+
+        tdo_byte = Signal(8)
+        self.comb += [
+            If(count == 0,
+                tdo_byte.eq(shreg_i >> align)
+            ).Else(
+                tdo_byte.eq(shreg_i)
+            )
+        ]
 
         self.submodules.fsm = FSM()
         self.fsm.act("RECV-COMMAND",
@@ -144,12 +197,29 @@ class JTAGProbeDriver(Module):
         )
         self.fsm.act("COMMAND",
             If(((cmd & CMD_MASK) == CMD_SHIFT_TMS) |
-                   ((cmd & CMD_MASK) == CMD_SHIFT_TDIO),
+                   ((cmd & CMD_MASK) == CMD_SHIFT_TDIO) |
+                   ((cmd & CMD_MASK) == CMD_SHIFT_CMP),
                 NextState("RECV-COUNT-1")
             ).Elif((cmd & CMD_MASK) == CMD_GET_AUX,
                 NextState("SEND-AUX")
             ).Elif((cmd & CMD_MASK) == CMD_SET_AUX,
                 NextState("RECV-AUX")
+            ).Elif((cmd & CMD_MASK) == CMD_GET_CMP,
+                NextValue(cmp_status, Cat(cmp_fail, Replicate(0, 7), cmp_fail_at)),
+                NextValue(cmp_byte, 5),
+                NextValue(cmp_count, 0),
+                NextValue(cmp_fail, 0),
+                NextState("SEND-CMP")
+            )
+        )
+        self.fsm.act("SEND-CMP",
+            If(cmp_byte == 0,
+                NextState("RECV-COMMAND")
+            ).Elif(in_fifo.writable,
+                in_fifo.we.eq(1),
+                in_fifo.din.eq(cmp_status[0:8]),
+                NextValue(cmp_status, cmp_status[8:]),
+                NextValue(cmp_byte, cmp_byte - 1)
             )
         )
         self.fsm.act("SEND-AUX",
@@ -190,7 +260,13 @@ class JTAGProbeDriver(Module):
                     NextValue(align, 8 - count[:3]),
                     NextValue(bitno, 8 - count[:3])
                 ),
-                If(cmd & BIT_DATA_OUT,
+                If((cmd & CMD_MASK) == CMD_SHIFT_CMP,
+                    If(out_fifo.readable,
+                        out_fifo.re.eq(1),
+                        NextValue(shreg_o, out_fifo.dout),
+                        NextState("RECV-EXPECT")
+                    )
+                ).Elif(cmd & BIT_DATA_OUT,
                     If(out_fifo.readable,
                         out_fifo.re.eq(1),
                         NextValue(shreg_o, out_fifo.dout),
@@ -202,6 +278,20 @@ class JTAGProbeDriver(Module):
                 )
             )
         )
+        self.fsm.act("RECV-EXPECT",
+            If(out_fifo.readable,
+                out_fifo.re.eq(1),
+                NextValue(shreg_e, out_fifo.dout),
+                NextState("RECV-MASK")
+            )
+        )
+        self.fsm.act("RECV-MASK",
+            If(out_fifo.readable,
+                out_fifo.re.eq(1),
+                NextValue(shreg_m, out_fifo.dout),
+                NextState("SHIFT-SETUP")
+            )
+        )
         self.fsm.act("SHIFT-SETUP",
             NextValue(adapter.stb, 1),
             If((cmd & CMD_MASK) == CMD_SHIFT_TMS,
@@ -231,14 +321,19 @@ class JTAGProbeDriver(Module):
             )
         )
         self.fsm.act("SEND-BITS",
-            If(cmd & BIT_DATA_IN,
+            If((cmd & CMD_MASK) == CMD_SHIFT_CMP,
+                If((((tdo_byte ^ shreg_e) & shreg_m) != 0) & ~cmp_fail,
+                    NextValue(cmp_fail, 1),
+                    NextValue(cmp_fail_at, cmp_count)
+                ),
+                If(count == 0,
+                    NextValue(cmp_count, cmp_count + 1)
+                ),
+                NextState("RECV-BITS")
+            ).Elif(cmd & BIT_DATA_IN,
                 If(in_fifo.writable,
                     in_fifo.we.eq(1),
-                    If(count == 0,
-                        in_fifo.din.eq(shreg_i >> align)
-                    ).Else(
-                        in_fifo.din.eq(shreg_i)
-                    ),
+                    in_fifo.din.eq(tdo_byte),
                     NextState("RECV-BITS")
                 )
             ).Else(
@@ -265,6 +360,69 @@ class JTAGProbeStateTransitionError(JTAGProbeError):
         self.new_state = new_state
 
 
+# TAP state transitions, indexed by the current state and TMS.
+_tap_transitions = {
+    "Test-Logic-Reset": ("Run-Test/Idle",  "Test-Logic-Reset"),
+    "Run-Test/Idle":    ("Run-Test/Idle",  "Select-DR-Scan"),
+    "Select-DR-Scan":   ("Capture-DR",     "Select-IR-Scan"),
+    "Capture-DR":       ("Shift-DR",       "Exit1-DR"),
+    "Shift-DR":         ("Shift-DR",       "Exit1-DR"),
+    "Exit1-DR":         ("Pause-DR",       "Update-DR"),
+    "Pause-DR":         ("Pause-DR",       "Exit2-DR"),
+    "Exit2-DR":         ("Shift-DR",       "Update-DR"),
+    "Update-DR":        ("Run-Test/Idle",  "Select-DR-Scan"),
+    "Select-IR-Scan":   ("Capture-IR",     "Test-Logic-Reset"),
+    "Capture-IR":       ("Shift-IR",       "Exit1-IR"),
+    "Shift-IR":         ("Shift-IR",       "Exit1-IR"),
+    "Exit1-IR":         ("Pause-IR",       "Update-IR"),
+    "Pause-IR":         ("Pause-IR",       "Exit2-IR"),
+    "Exit2-IR":         ("Shift-IR",       "Update-IR"),
+    "Update-IR":        ("Run-Test/Idle",  "Select-DR-Scan"),
+}
+
+
+class JTAGProbeDeferredResult:
+    """
+    A handle to TDO bits captured by a queued scan.
+
+    The bits become available once the probe interface collects them, which happens on
+    ``JTAGProbeInterface.collect()``, or the first time any pending handle is awaited.
+    """
+    def __init__(self, probe, parent=None, transform=None):
+        self._probe     = probe
+        self._parent    = parent
+        self._transform = transform
+        self._value     = None
+        self._ready     = False
+
+    def _set_result(self, value):
+        self._value = value
+        self._ready = True
+
+    def done(self):
+        """Check whether the TDO bits have been collected."""
+        if self._parent is not None:
+            return self._parent.done()
+        return self._ready
+
+    def result(self):
+        """Return the TDO bits, which must have been already collected."""
+        if self._parent is not None:
+            return self._transform(self._parent.result())
+        if not self._ready:
+            raise JTAGProbeError("deferred scan result requested before collection")
+        return self._value
+
+    def map(self, transform):
+        """Return a handle to ``transform`` applied to the TDO bits of this handle."""
+        return JTAGProbeDeferredResult(self._probe, self, transform)
+
+    def __await__(self):
+        if not self.done():
+            yield from self._probe.collect().__await__()
+        return self.result()
+
+
 class JTAGProbeInterface:
     def __init__(self, interface, logger, has_trst=False, __name__=__name__):
         self.lower   = interface
@@ -274,6 +432,8 @@ class JTAGProbeInterface:
         self.has_trst    = has_trst
         self._state      = "Unknown"
         self._current_ir = None
+        self._pending    = []
+        self._cmp_count  = 0
 
     def _log_l(self, message, *args):
         self._logger.log(self._level, "JTAG-L: " + message, *args)
@@ -286,6 +446,31 @@ class JTAGProbeInterface:
     async def flush(self):
         self._log_l("flush")
         await self.lower.flush()
+        await self.collect()
+
+    def _defer_tdo(self, counts, message):
+        result = JTAGProbeDeferredResult(self)
+        self._pending.append((result, counts, message))
+        return result
+
+    async def collect(self):
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        length = sum((count + 7) // 8 for _, counts, _ in pending for count in counts)
+        self._log_l("collect scans=%d bytes=%d", len(pending), length)
+        tdo_bytes = await self.lower.read(length)
+        offset = 0
+        for result, counts, message in pending:
+            tdo_bits = bitbuilder()
+            for count in counts:
+                size = (count + 7) // 8
+                tdo_bits.extend_bytes(tdo_bytes[offset:offset + size], count)
+                offset += size
+            tdo_bits = tdo_bits.to_bits()
+            self._log_l(message, dump_bin(tdo_bits))
+            result._set_result(tdo_bits)
 
     async def set_aux(self, value):
         self._log_l("set aux=%s", format(value, "08b"))
@@ -293,6 +478,7 @@ class JTAGProbeInterface:
             CMD_SET_AUX, value))
 
     async def get_aux(self):
+        await self.collect()
         await self.lower.write(struct.pack("<B",
             CMD_GET_AUX))
         value, = await self.lower.read(1)
@@ -309,12 +495,69 @@ class JTAGProbeInterface:
             self._log_l("set trst=%d", active)
             await self.set_aux(BIT_AUX_TRST_O if active else 0)
 
+    def _follow_tms(self, tms_str):
+        # Any TAP reaches a fixed point after at most five clock cycles with constant TMS,
+        # so only the first five cycles of every run need to be followed.
+        for tms, run in itertools.groupby(tms_str):
+            tms, length = int(tms), len(list(itertools.islice(run, 5)))
+            if self._state in _tap_transitions:
+                for _ in range(length):
+                    self._state = _tap_transitions[self._state][tms]
+            elif tms and length == 5:
+                self._state = "Test-Logic-Reset"
+
     async def shift_tms(self, tms_bits, tdi=False):
         tms_bits = bits(tms_bits)
         self._log_l("shift tms=<%s>", dump_bin(tms_bits))
         await self.lower.write(struct.pack("<BH",
             CMD_SHIFT_TMS|BIT_DATA_OUT|(BIT_TDI if tdi else 0), len(tms_bits)))
         await self.lower.write(tms_bits)
+        self._follow_tms(str(tms_bits)[::-1])
+
+    async def shift_raw(self, tms_bits, tdi_bits, *, defer=False):
+        """
+        Shift arbitrary ``tms_bits`` and ``tdi_bits`` (of equal length) while capturing TDO.
+
+        This is meant for bridging other JTAG protocols, which drive TMS themselves. The vectors
+        are split into as few shift commands as possible: runs of TMS=0 (optionally followed
+        by a single TMS=1) become TDIO shifts, and runs of TMS=1 with constant TDI become TMS
+        shifts. All of them are queued before TDO is read.
+        """
+        tms_bits = bits(tms_bits)
+        tdi_bits = bits(tdi_bits, len(tms_bits))
+        self._log_l("shift raw tms=<%s> tdi=<%s>", dump_bin(tms_bits), dump_bin(tdi_bits))
+        # Strings are indexed and searched in constant and linear time, unlike large bits.
+        tms_str = str(tms_bits)[::-1]
+        tdi_str = str(tdi_bits)[::-1]
+        counts  = []
+        offset  = 0
+        while offset < len(tms_str):
+            if tms_str[offset] == "0":
+                end = tms_str.find("1", offset)
+                if end == -1 or end - offset >= 0xffff:
+                    end  = min(offset + 0xffff, len(tms_str) if end == -1 else end)
+                    last = False
+                else:
+                    end += 1
+                    last = True
+                cmd  = CMD_SHIFT_TDIO|BIT_DATA_IN|BIT_DATA_OUT|(BIT_LAST if last else 0)
+                data = bits(tdi_str[offset:end][::-1])
+            else:
+                tdi  = tdi_str[offset] == "1"
+                ends = (tms_str.find("0", offset), tdi_str.find("10"[tdi], offset),
+                        len(tms_str), offset + 0xffff)
+                end  = min(end for end in ends if end != -1)
+                cmd  = CMD_SHIFT_TMS|BIT_DATA_IN|BIT_DATA_OUT|(BIT_TDI if tdi else 0)
+                data = bits(tms_str[offset:end][::-1])
+            await self.lower.write(struct.pack("<BH", cmd, len(data)))
+            await self.lower.write(bytes(data))
+            counts.append(len(data))
+            offset = end
+        self._follow_tms(tms_str)
+        tdo_bits = self._defer_tdo(counts, "shift raw tdo=<%s>")
+        if defer:
+            return tdo_bits
+        return await tdo_bits
 
     def _shift_last(self, last):
         if last:
@@ -333,54 +576,133 @@ class JTAGProbeInterface:
         yield count, last
 
     @staticmethod
-    def _chunk_bits(bits, last, chunk_size=0xffff):
+    def _chunk_bits(bits, last, chunk_size=0xfff8):
+        # The chunks are byte-aligned, so that the bits are converted to bytes only once, instead
+        # of slicing (and copying) the entire remainder of the bits for every chunk.
+        assert chunk_size % 8 == 0
+        data   = memoryview(bytes(bits))
         offset = 0
         while len(bits) - offset > chunk_size:
-            yield bits[offset:offset + chunk_size], False
+            yield data[offset // 8:(offset + chunk_size) // 8], chunk_size, False
             offset += chunk_size
-        yield bits[offset:], last
+        yield data[offset // 8:], len(bits) - offset, last
 
-    async def shift_tdio(self, tdi_bits, last=True):
+    async def shift_tdio(self, tdi_bits, last=True, *, defer=False):
         assert self._state in ("Shift-IR", "Shift-DR")
         tdi_bits = bits(tdi_bits)
-        tdo_bits = bits()
+        counts   = []
         self._log_l("shift tdio-i=<%s>", dump_bin(tdi_bits))
-        for tdi_bits, last in self._chunk_bits(tdi_bits, last):
+        for tdi_bytes, count, last in self._chunk_bits(tdi_bits, last):
             await self.lower.write(struct.pack("<BH",
                 CMD_SHIFT_TDIO|BIT_DATA_IN|BIT_DATA_OUT|(BIT_LAST if last else 0),
-                len(tdi_bits)))
-            tdi_bytes = bytes(tdi_bits)
+                count))
             await self.lower.write(tdi_bytes)
-            tdo_bytes = await self.lower.read(len(tdi_bytes))
-            tdo_bits += bits(tdo_bytes, len(tdi_bits))
-        self._log_l("shift tdio-o=<%s>", dump_bin(tdo_bits))
+            counts.append(count)
+        tdo_bits = self._defer_tdo(counts, "shift tdio-o=<%s>")
         self._shift_last(last)
-        return tdo_bits
+        if defer:
+            return tdo_bits
+        return await tdo_bits
 
     async def shift_tdi(self, tdi_bits, last=True):
         assert self._state in ("Shift-IR", "Shift-DR")
         tdi_bits = bits(tdi_bits)
         self._log_l("shift tdi=<%s>", dump_bin(tdi_bits))
-        for tdi_bits, last in self._chunk_bits(tdi_bits, last):
+        for tdi_bytes, count, last in self._chunk_bits(tdi_bits, last):
             await self.lower.write(struct.pack("<BH",
                 CMD_SHIFT_TDIO|BIT_DATA_OUT|(BIT_LAST if last else 0),
-                len(tdi_bits)))
-            tdi_bytes = bytes(tdi_bits)
+                count))
             await self.lower.write(tdi_bytes)
         self._shift_last(last)
 
-    async def shift_tdo(self, count, last=True):
+    async def shift_tdi_bytes(self, tdi_bytes, last=True):
+        """
+        Shift ``tdi_bytes`` in, least significant bit of the first byte first. Unlike
+        ``shift_tdi``, the data is sent as-is, without converting it to ``bits``, which is much
+        faster for large scans such as configuration bitstreams.
+        """
+        assert self._state in ("Shift-IR", "Shift-DR")
+        tdi_bytes = memoryview(tdi_bytes).cast("B")
+        self._log_l("shift tdi bytes=%d", len(tdi_bytes))
+        offset = 0
+        for count, last in self._chunk_count(len(tdi_bytes) * 8, last, chunk_size=0xfff8):
+            if count == 0:
+                # Nothing is shifted, so the TAP stays in the Shift-xR state.
+                break
+            await self.lower.write(struct.pack("<BH",
+                CMD_SHIFT_TDIO|BIT_DATA_OUT|(BIT_LAST if last else 0),
+                count))
+            await self.lower.write(tdi_bytes[offset:offset + count // 8])
+            offset += count // 8
+            self._shift_last(last)
+
+    async def shift_tdo(self, count, last=True, *, defer=False):
         assert self._state in ("Shift-IR", "Shift-DR")
-        tdo_bits = bits()
+        counts = []
         for count, last in self._chunk_count(count, last):
             await self.lower.write(struct.pack("<BH",
                 CMD_SHIFT_TDIO|BIT_DATA_IN|(BIT_LAST if last else 0),
                 count))
-            tdo_bytes = await self.lower.read((count + 7) // 8)
-            tdo_bits += bits(tdo_bytes, count)
-        self._log_l("shift tdo=<%s>", dump_bin(tdo_bits))
+            counts.append(count)
+        tdo_bits = self._defer_tdo(counts, "shift tdo=<%s>")
         self._shift_last(last)
-        return tdo_bits
+        if defer:
+            return tdo_bits
+        return await tdo_bits
+
+    async def shift_tdi_compare(self, tdi_bits, tdo_bits, mask_bits, last=True):
+        """
+        Shift ``tdi_bits`` in, and compare the TDO bits shifted out with ``tdo_bits`` under
+        ``mask_bits`` in gateware, without reading them back.
+
+        Returns the range of compare indexes occupied by this scan; if it fails, the index
+        returned by ``get_compare_status()`` will be within this range.
+        """
+        assert self._state in ("Shift-IR", "Shift-DR")
+        tdi_bits  = bits(tdi_bits)
+        tdo_bits  = bits(tdo_bits, len(tdi_bits))
+        mask_bits = bits(mask_bits, len(tdi_bits))
+        self._log_l("shift tdi=<%s> cmp tdo=<%s> mask=<%s>",
+                    dump_bin(tdi_bits), dump_bin(tdo_bits), dump_bin(mask_bits))
+        # Interleave TDI, expected TDO and mask bytes the way the driver consumes them.
+        size = (len(tdi_bits) + 7) // 8
+        data = bytearray(size * 3)
+        data[0::3] = bytes(tdi_bits)
+        data[1::3] = bytes(tdo_bits)
+        data[2::3] = bytes(mask_bits)
+        data   = memoryview(data)
+        offset = 0
+        start  = self._cmp_count
+        for count, last in self._chunk_count(len(tdi_bits), last, chunk_size=0xfff8):
+            if count == 0:
+                # Nothing is shifted, so the TAP stays in the Shift-xR state.
+                break
+            await self.lower.write(struct.pack("<BH",
+                CMD_SHIFT_CMP|BIT_DATA_OUT|(BIT_LAST if last else 0), count))
+            await self.lower.write(data[offset:offset + (count + 7) // 8 * 3])
+            offset += (count + 7) // 8 * 3
+            self._cmp_count += 1
+            self._shift_last(last)
+        return range(start, self._cmp_count)
+
+    async def get_compare_status(self):
+        """
+        Retrieve and clear the status of compared scans.
+
+        Returns ``None`` if every compared scan matched, or the index of the first compared scan
+        that did not.
+        """
+        await self.collect()
+        await self.lower.write(struct.pack("<B",
+            CMD_GET_CMP))
+        failed, index = struct.unpack("<BL", await self.lower.read(5))
+        self._cmp_count = 0
+        if failed:
+            self._log_l("get cmp fail at=%d", index)
+            return index
+        else:
+            self._log_l("get cmp pass")
+            return None
 
     async def shift_dummy(self, count, last=True):
         assert self._state in ("Shift-IR", "Shift-DR")
@@ -528,20 +850,23 @@ class JTAGProbeInterface:
         await self.enter_run_test_idle()
         await self.pulse_tck(count)
 
-    async def exchange_ir(self, data):
+    async def exchange_ir(self, data, *, defer=False):
         self._current_ir = data = bits(data)
         self._log_h("exchange ir")
         await self.enter_shift_ir()
-        data = await self.shift_tdio(data)
+        data = await self.shift_tdio(data, defer=defer)
         await self.enter_update_ir()
         return data
 
-    async def read_ir(self, count):
+    async def read_ir(self, count, *, defer=False):
         self._current_ir = bits((1,)) * count
         await self.enter_shift_ir()
-        data = await self.shift_tdo(count)
+        data = await self.shift_tdo(count, defer=defer)
         await self.enter_update_ir()
-        self._log_h("read ir=<%s>", dump_bin(data))
+        if defer:
+            self._log_h("read ir (deferred)")
+        else:
+            self._log_h("read ir=<%s>", dump_bin(data))
         return data
 
     async def write_ir(self, data, *, elide=True):
@@ -554,16 +879,19 @@ class JTAGProbeInterface:
         await self.shift_tdi(data)
         await self.enter_update_ir()
 
-    async def exchange_dr(self, data):
+    async def exchange_dr(self, data, *, defer=False):
         self._log_h("exchange dr")
         await self.enter_shift_dr()
-        data = await self.shift_tdio(data)
+        data = await self.shift_tdio(data, defer=defer)
         await self.enter_update_dr()
         return data
 
-    async def read_dr(self, count, idempotent=False):
+    async def read_dr(self, count, idempotent=False, *, defer=False):
+        # An idempotent read needs the captured bits to shift them back in, so it cannot be
+        # deferred.
+        assert not (idempotent and defer)
         await self.enter_shift_dr()
-        data = await self.shift_tdo(count, last=not idempotent)
+        data = await self.shift_tdo(count, last=not idempotent, defer=defer)
         if idempotent:
             # Shift what we just read back in. This is useful to avoid disturbing any bits
             # in R/W DRs when we go through Update-DR.
@@ -571,6 +899,8 @@ class JTAGProbeInterface:
         await self.enter_update_dr()
         if idempotent:
             self._log_h("read idempotent dr=<%s>", dump_bin(data))
+        elif defer:
+            self._log_h("read dr (deferred)")
         else:
             self._log_h("read dr=<%s>", dump_bin(data))
         return data
@@ -582,6 +912,29 @@ class JTAGProbeInterface:
         await self.shift_tdi(data)
         await self.enter_update_dr()
 
+    async def write_dr_bytes(self, chunks, *, prefix=bits(), suffix=bits()):
+        """
+        Write the concatenation of byte-like ``chunks`` to DR, least significant bit of every
+        byte first, with ``prefix`` and ``suffix`` bits shifted before and after it. Every chunk
+        is shifted as soon as it is produced, so ``chunks`` may be a generator reading a large
+        file incrementally.
+        """
+        self._log_h("write dr bytes")
+        await self.enter_shift_dr()
+        # Empty chunks are skipped, so that the last bit is always shifted with TMS high.
+        chunks  = (chunk for chunk in chunks if len(chunk) > 0)
+        pending = next(chunks, None)
+        if prefix:
+            await self.shift_tdi(prefix, last=pending is None and not suffix)
+        for chunk in chunks:
+            await self.shift_tdi_bytes(pending, last=False)
+            pending = chunk
+        if pending is not None:
+            await self.shift_tdi_bytes(pending, last=not suffix)
+        if suffix:
+            await self.shift_tdi(suffix)
+        await self.enter_update_dr()
+
     # Specialized operations
 
     async def _scan_xr(self, xr, max_length, zero_ok=False):
@@ -653,14 +1006,26 @@ class JTAGProbeInterface:
 
         return idcodes
 
-    def segment_irs(self, ir_value, count=None):
+    def segment_irs(self, ir_value, count=None, ir_lengths=None):
         if ir_value[0:2] != (1,0):
             self._log_h("ir does not start with 10")
             return
 
         irs = []
         ir_offset = 0
-        if count == 1:
+        if ir_lengths is not None:
+            # Known IR lengths; check that every IR captures 10 and that they add up.
+            if sum(ir_lengths) != len(ir_value):
+                self._log_h("ir lengths do not add up to %d", len(ir_value))
+                return
+            for ir_length in ir_lengths:
+                if ir_value[ir_offset:ir_offset + 2] != (1,0):
+                    self._log_h("ir at offset %d does not start with 10", ir_offset)
+                    return
+                self._log_h("found ir[%d]", ir_length)
+                irs.append((ir_offset, ir_length))
+                ir_offset += ir_length
+        elif count == 1:
             # 1 TAP case; the entire IR belongs to the only TAP we have.
             ir_length = len(ir_value)
             self._log_h("found ir[%d] (1-tap)", ir_length)
@@ -677,7 +1042,7 @@ class JTAGProbeInterface:
 
         return irs
 
-    async def select_tap(self, tap, max_ir_length=128, max_dr_length=1024):
+    async def _scan_chain(self, max_ir_length, max_dr_length, ir_lengths=None):
         await self.test_reset()
 
         dr_value = await self.scan_dr(max_dr_length)
@@ -692,12 +1057,22 @@ class JTAGProbeInterface:
         if ir_value is None:
             return
 
-        irs = self.segment_irs(ir_value, count=len(idcodes))
+        if (ir_lengths is None and len(idcodes) > 1 and idcodes[0] is not None and
+                idcodes.count(idcodes[0]) == len(idcodes) and
+                len(ir_value) % len(idcodes) == 0):
+            # Identical devices have identical IRs.
+            self._log_h("found %d identical taps", len(idcodes))
+            ir_lengths = [len(ir_value) // len(idcodes)] * len(idcodes)
+
+        return self.segment_irs(ir_value, count=len(idcodes), ir_lengths=ir_lengths)
+
+    async def select_tap(self, tap, max_ir_length=128, max_dr_length=1024):
+        irs = await self._scan_chain(max_ir_length, max_dr_length)
         if not irs:
             return
 
         if tap >= len(irs):
-            self._log_h("tap %d not present on chain")
+            self._log_h("tap %d not present on chain", tap)
             return
 
         ir_offset, ir_length = irs[tap]
@@ -716,6 +1091,21 @@ class JTAGProbeInterface:
             *affix(ir_offset, ir_length, total_ir_length),
             *affix(dr_offset, dr_length, total_dr_length))
 
+    async def select_taps(self, taps, max_ir_length=128, max_dr_length=1024, ir_lengths=None):
+        irs = await self._scan_chain(max_ir_length, max_dr_length, ir_lengths)
+        if not irs:
+            return
+
+        for tap in taps:
+            if tap >= len(irs):
+                self._log_h("tap %d not present on chain", tap)
+                return
+        if len(set(taps)) != len(taps):
+            self._log_h("taps %s are not distinct", ", ".join(map(str, taps)))
+            return
+
+        return MultiTAPInterface(self, irs, sorted(taps))
+
 
 class TAPInterface:
     def __init__(self, lower, ir_length, ir_prefix, ir_suffix, dr_prefix, dr_suffix):
@@ -734,46 +1124,62 @@ class TAPInterface:
     async def run_test_idle(self, count):
         await self.lower.run_test_idle(count)
 
-    async def exchange_ir(self, data):
-        data = bits(data)
-        assert len(data) == self.ir_length
-        data = await self.lower.exchange_ir(self._ir_prefix + data + self._ir_suffix)
+    def _strip_ir(self, data):
         if self._ir_suffix:
             return data[len(self._ir_prefix):-len(self._ir_suffix)]
         else:
             return data[len(self._ir_prefix):]
 
-    async def read_ir(self):
-        data = await self.lower.read_ir(self._ir_overhead + self.ir_length)
-        if self._ir_suffix:
-            return data[len(self._ir_prefix):-len(self._ir_suffix)]
+    def _strip_dr(self, data):
+        if self._dr_suffix:
+            return data[len(self._dr_prefix):-len(self._dr_suffix)]
         else:
-            return data[len(self._ir_prefix):]
+            return data[len(self._dr_prefix):]
+
+    @staticmethod
+    def _strip(data, strip, defer):
+        if defer:
+            return data.map(strip)
+        else:
+            return strip(data)
+
+    async def collect(self):
+        await self.lower.collect()
+
+    async def exchange_ir(self, data, *, defer=False):
+        data = bits(data)
+        assert len(data) == self.ir_length
+        data = await self.lower.exchange_ir(self._ir_prefix + data + self._ir_suffix,
+                                            defer=defer)
+        return self._strip(data, self._strip_ir, defer)
+
+    async def read_ir(self, *, defer=False):
+        data = await self.lower.read_ir(self._ir_overhead + self.ir_length, defer=defer)
+        return self._strip(data, self._strip_ir, defer)
 
     async def write_ir(self, data, *, elide=True):
         data = bits(data)
         assert len(data) == self.ir_length
         await self.lower.write_ir(self._ir_prefix + data + self._ir_suffix, elide=elide)
 
-    async def exchange_dr(self, data):
+    async def exchange_dr(self, data, *, defer=False):
         data = bits(data)
-        data = await self.lower.exchange_dr(self._dr_prefix + data + self._dr_suffix)
-        if self._dr_suffix:
-            return data[len(self._dr_prefix):-len(self._dr_suffix)]
-        else:
-            return data[len(self._dr_prefix):]
+        data = await self.lower.exchange_dr(self._dr_prefix + data + self._dr_suffix,
+                                            defer=defer)
+        return self._strip(data, self._strip_dr, defer)
 
-    async def read_dr(self, count, idempotent=False):
-        data = await self.lower.read_dr(self._dr_overhead + count, idempotent=idempotent)
-        if self._dr_suffix:
-            return data[len(self._dr_prefix):-len(self._dr_suffix)]
-        else:
-            return data[len(self._dr_prefix):]
+    async def read_dr(self, count, idempotent=False, *, defer=False):
+        data = await self.lower.read_dr(self._dr_overhead + count, idempotent=idempotent,
+                                        defer=defer)
+        return self._strip(data, self._strip_dr, defer)
 
     async def write_dr(self, data):
         data = bits(data)
         await self.lower.write_dr(self._dr_prefix + data + self._dr_suffix)
 
+    async def write_dr_bytes(self, chunks):
+        await self.lower.write_dr_bytes(chunks, prefix=self._dr_prefix, suffix=self._dr_suffix)
+
     async def scan_dr_length(self, max_length, zero_ok=False):
         length = await self.lower.scan_dr_length(max_length=self._dr_overhead + max_length,
                                                  zero_ok=zero_ok)
@@ -784,6 +1190,115 @@ class TAPInterface:
         return length - self._dr_overhead
 
 
+class MultiTAPInterface:
+    def __init__(self, lower, irs, taps):
+        self.lower = lower
+        self.taps  = taps
+        self._irs  = irs
+
+        ir_lengths = {irs[tap][1] for tap in taps}
+        self.ir_length = ir_lengths.pop() if len(ir_lengths) == 1 else None
+
+    def tap(self, index):
+        """Return a ``TAPInterface`` for the ``index``-th selected TAP alone."""
+        tap = self.taps[index]
+        ir_offset, ir_length = self._irs[tap]
+        total_ir_length = sum(length for offset, length in self._irs)
+        bypass = bits((1,))
+        return TAPInterface(self.lower, ir_length,
+            bypass * ir_offset, bypass * (total_ir_length - ir_offset - ir_length),
+            bypass * tap, bypass * (len(self._irs) - tap - 1))
+
+    def _per_tap(self, data):
+        if isinstance(data, list):
+            assert len(data) == len(self.taps)
+            return [bits(item) for item in data]
+        else:
+            return [bits(data)] * len(self.taps)
+
+    def compose_ir(self, data, fill=1):
+        """
+        Compose a chain IR value from ``data`` (one value for every selected TAP, or a list
+        with a value per selected TAP), filling the IRs of other TAPs with ``fill`` bits.
+        """
+        data = iter(self._per_tap(data))
+        result = bitbuilder()
+        for tap, (ir_offset, ir_length) in enumerate(self._irs):
+            if tap in self.taps:
+                item = next(data)
+                assert len(item) == ir_length
+                result += item
+            else:
+                result += bits(-fill, ir_length)
+        return result.to_bits()
+
+    def compose_dr(self, data, fill=1):
+        """
+        Compose a chain DR value from ``data`` like ``compose_ir``, with other TAPs in BYPASS.
+        """
+        data = iter(self._per_tap(data))
+        result = bitbuilder()
+        for tap in range(len(self._irs)):
+            if tap in self.taps:
+                result += next(data)
+            else:
+                result += bits(-fill, 1)
+        return result.to_bits()
+
+    def split_ir(self, data):
+        return [data[self._irs[tap][0]:sum(self._irs[tap])] for tap in self.taps]
+
+    def split_dr(self, data, count):
+        result = []
+        for index, tap in enumerate(self.taps):
+            offset = (tap - index) + index * count
+            result.append(data[offset:offset + count])
+        return result
+
+    @staticmethod
+    def _split(data, split, defer):
+        if defer:
+            return data.map(split)
+        else:
+            return split(data)
+
+    async def test_reset(self):
+        await self.lower.test_reset()
+
+    async def run_test_idle(self, count):
+        await self.lower.run_test_idle(count)
+
+    async def collect(self):
+        await self.lower.collect()
+
+    async def exchange_ir(self, data, *, defer=False):
+        data = await self.lower.exchange_ir(self.compose_ir(data), defer=defer)
+        return self._split(data, self.split_ir, defer)
+
+    async def read_ir(self, *, defer=False):
+        total_ir_length = sum(length for offset, length in self._irs)
+        data = await self.lower.read_ir(total_ir_length, defer=defer)
+        return self._split(data, self.split_ir, defer)
+
+    async def write_ir(self, data, *, elide=True):
+        await self.lower.write_ir(self.compose_ir(data), elide=elide)
+
+    async def exchange_dr(self, data, *, defer=False):
+        data  = self._per_tap(data)
+        count = len(data[0])
+        assert all(len(item) == count for item in data)
+        data  = await self.lower.exchange_dr(self.compose_dr(data), defer=defer)
+        return self._split(data, lambda data: self.split_dr(data, count), defer)
+
+    async def read_dr(self, count, idempotent=False, *, defer=False):
+        data = await self.lower.read_dr(len(self._irs) - len(self.taps) + count * len(self.taps),
+                                        idempotent=idempotent, defer=defer)
+        return self._split(data, lambda data: self.split_dr(data, count), defer)
+
+    async def write_dr(self, data):
+        await self.lower.write_dr(self.compose_dr(data))
+
+
 class JTAGProbeApplet(GlasgowApplet, name="jtag-probe"):
     logger = logging.getLogger(__name__)
     help = "test integrated circuits via IEEE 1149.1 JTAG"
@@ -840,6 +1355,27 @@ class JTAGProbeApplet(GlasgowApplet, name="jtag-probe"):
             raise JTAGProbeError("cannot select TAP #%d" % args.tap_index)
         return tap_iface
 
+    @classmethod
+    def add_run_multi_tap_arguments(cls, parser, access):
+        super().add_run_arguments(parser, access)
+
+        parser.add_argument(
+            "--tap-index", metavar="INDEX", type=int, action="append", dest="tap_indexes",
+            help="select TAP #INDEX for communication; if specified several times, operate on "
+                 "all of the selected TAPs at once (default: 0)")
+
+    async def run_multi_tap(self, cls, device, args):
+        jtag_iface = await self.run_lower(cls, device, args)
+        tap_indexes = args.tap_indexes or [0]
+        if len(tap_indexes) == 1:
+            tap_iface = await jtag_iface.select_tap(tap_indexes[0])
+        else:
+            tap_iface = await jtag_iface.select_taps(tap_indexes)
+        if not tap_iface:
+            raise JTAGProbeError("cannot select TAP %s"
+                                 % ", ".join("#%d" % index for index in tap_indexes))
+        return tap_iface
+
     @classmethod
     def add_interact_arguments(cls, parser):
         parser.add_argument(
@@ -985,6 +1521,96 @@ class JTAGProbeApplet(GlasgowApplet, name="jtag-probe"):
 
 # -------------------------------------------------------------------------------------------------
 
+import random
+import unittest
+
+
+class JTAGProbeRecordingInterface:
+    """
+    Record the commands written to the probe, and decode them into a string with a ``TMS TDI``
+    pair of characters for every TCK cycle.
+    """
+    def __init__(self):
+        self.data = bytearray()
+
+    async def write(self, data):
+        self.data += bytes(data)
+
+    async def flush(self):
+        pass
+
+    def cycles(self):
+        cycles = []
+        offset = 0
+        while offset < len(self.data):
+            cmd, count = struct.unpack_from("<BH", self.data, offset)
+            offset += 3
+            assert cmd & CMD_MASK in (CMD_SHIFT_TMS, CMD_SHIFT_TDIO)
+            if cmd & BIT_DATA_OUT:
+                size = (count + 7) // 8
+                data = bits(self.data[offset:offset + size], count)
+                offset += size
+            else:
+                data = bits(0, count)
+            for index, bit in enumerate(data):
+                if cmd & CMD_MASK == CMD_SHIFT_TMS:
+                    cycles.append("{:d}{:d}".format(bit, bool(cmd & BIT_TDI)))
+                else:
+                    tms = bool(cmd & BIT_LAST) and index == count - 1
+                    cycles.append("{:d}{:d}".format(tms, bit))
+        return " ".join(cycles)
+
+
+class JTAGProbeInterfaceTestCase(unittest.TestCase):
+    def record(self, operation):
+        lower = JTAGProbeRecordingInterface()
+        iface = JTAGProbeInterface(lower, logging.getLogger(__name__))
+        async def run():
+            await iface.enter_test_logic_reset()
+            await operation(iface)
+            await iface.enter_run_test_idle()
+        asyncio.get_event_loop().run_until_complete(run())
+        return lower.cycles()
+
+    def assertWritesDR(self, chunks, prefix=bits(), suffix=bits()):
+        data = b"".join(chunks)
+        self.assertEqual(
+            self.record(lambda iface: iface.write_dr_bytes(iter(chunks),
+                                                           prefix=prefix, suffix=suffix)),
+            self.record(lambda iface: iface.write_dr(prefix + bits(data, len(data) * 8) + suffix)))
+
+    def test_write_dr_bytes(self):
+        self.assertWritesDR([b"\x5a"])
+        self.assertWritesDR([b"\x01\x02", b"", b"\x80"])
+
+    def test_write_dr_bytes_prefix_suffix(self):
+        self.assertWritesDR([b"\x5a\xa5"], prefix=bits("110"))
+        self.assertWritesDR([b"\x5a\xa5"], suffix=bits("10"))
+        self.assertWritesDR([b"\x5a", b"\xa5"], prefix=bits("0111"), suffix=bits("001"))
+
+    def test_write_dr_bytes_empty(self):
+        self.assertWritesDR([b"\x5a", b"\xa5", b""])
+        self.assertWritesDR([b"\x5a", b"\xa5", b""], suffix=bits("001"))
+        self.assertWritesDR([b"", b"\x5a", b"", b"", b"\xa5", b""], prefix=bits("0111"),
+                            suffix=bits("001"))
+        self.assertWritesDR([b""], prefix=bits("0111"))
+        self.assertWritesDR([], prefix=bits("0111"), suffix=bits("001"))
+
+    def test_shift_tdi_bytes_empty(self):
+        async def shift(iface):
+            await iface.enter_shift_dr()
+            await iface.shift_tdi_bytes(b"")
+            self.assertEqual(iface._state, "Shift-DR")
+            await iface.shift_tdi_bytes(b"\x5a")
+            self.assertEqual(iface._state, "Exit1-DR")
+        self.record(shift)
+
+    def test_write_dr_bytes_long(self):
+        data = bytes(random.Random(0).getrandbits(8) for _ in range(20000))
+        self.assertWritesDR([data[:10000], data[10000:]], prefix=bits("01"), suffix=bits("10"))
+        self.assertWritesDR([data])
+
+
 class JTAGProbeAppletTestCase(GlasgowAppletTestCase, applet=JTAGProbeApplet):
     @synthesis_test
     def test_build(self):
@@ -3,6 +3,18 @@
 # Ref: http://www.jtagtest.com/pdf/svf_specification.pdf
 # Accession: G00023
 
+# Multiple devices
+# ----------------
+#
+# A test vector for a single device can be played to several identical devices on the same chain
+# at once. The IR and DR scans of every SIR and SDR command are then replicated for each of
+# the selected TAPs using a MultiTAPInterface, while all other TAPs are kept in BYPASS, and TDO is
+# compared for each of the selected TAPs. The HIR, TIR, HDR and TDR commands must not be used
+# in this case, since the layout of the chain is already known.
+
+import io
+import mmap
+import bisect
 import struct
 import logging
 import argparse
@@ -12,13 +24,20 @@ from ....support.bits import *
 from ....support.logging import *
 from ....protocol.jtag_svf import *
 from ... import *
-from ..jtag_probe import JTAGProbeApplet, JTAGProbeStateTransitionError
+from ..jtag_probe import JTAGProbeApplet, JTAGProbeError, JTAGProbeStateTransitionError
 
 
 class SVFError(GlasgowAppletError):
     pass
 
 
+class SVFCompareError(SVFError):
+    def __init__(self, command, location):
+        super().__init__("%s command failed" % command)
+        self.command  = command
+        self.location = location
+
+
 class SVFOperation:
     def __init__(self, tdi=bits(), smask=bits(), tdo=None, mask=bits()):
         self.tdi   = tdi
@@ -29,26 +48,39 @@ class SVFOperation:
     def __add__(self, other):
         assert isinstance(other, SVFOperation)
 
+        def concat(*values):
+            result = bitbuilder()
+            for value in values:
+                result += value
+            return result.to_bits()
+
         if self.tdo is None and other.tdo is None:
             # Propagate "TDO don't care".
             tdo = None
         else:
             # Replace "TDO don't care" with all-don't-care mask bits (which are guaranteed
             # to be in that state by SVFParser).
-            tdo = (self.tdo or self.mask) + (other.tdo or other.mask)
+            tdo = concat(self.tdo or self.mask, other.tdo or other.mask)
 
-        return SVFOperation(self.tdi   + other.tdi,
-                            self.smask + other.smask,
-                                 tdo,
-                            self.mask  + other.mask)
+        return SVFOperation(concat(self.tdi,   other.tdi),
+                            concat(self.smask, other.smask),
+                                   tdo,
+                            concat(self.mask,  other.mask))
 
 
 class SVFInterface(SVFEventHandler):
-    def __init__(self, interface, logger, frequency):
+    def __init__(self, interface, logger, frequency, stream=False, taps=None):
         self.lower   = interface
         self._logger = logger
         self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
         self._frequency = frequency
+        self._stream = stream
+        self._taps   = taps
+
+        # Location of the command being played, reported if a scan compared in gateware fails.
+        self.location = None
+        self._compared = []
+        self._checked  = False
 
         self._endir  = "IDLE"
         self._enddr  = "IDLE"
@@ -125,11 +157,54 @@ class SVFInterface(SVFEventHandler):
     async def svf_tdr(self, tdi, smask, tdo, mask):
         self._tdr = SVFOperation(tdi, smask, tdo, mask)
 
+    async def _shift_compare(self, command, op):
+        indexes = await self.lower.shift_tdi_compare(op.tdi, op.tdo, op.mask)
+        if indexes:
+            self._compared.append((indexes.stop, command, self.location))
+        if not self._checked:
+            # The first compared scan is usually an IDCODE check; make sure that the test vector
+            # is played to the right device before any of it is changed.
+            await self.check_compare()
+
+    async def check_compare(self):
+        """
+        Check the scans compared in gateware since the last check.
+
+        Raises :class:`SVFCompareError` with the command and location of the first scan that
+        failed, if any.
+        """
+        if not self._compared:
+            return
+        compared, self._compared = self._compared, []
+        self._checked = True
+        index = await self.lower.get_compare_status()
+        if index is None:
+            return
+        _, command, location = compared[bisect.bisect_right([stop for stop, *_ in compared],
+                                                            index)]
+        raise SVFCompareError(command, location)
+
+    def _replicate(self, command, op, compose):
+        if len(self._hir.tdi) or len(self._tir.tdi) or len(self._hdr.tdi) or len(self._tdr.tdi):
+            raise SVFError("%s command with header or trailer cannot be played to selected TAPs"
+                           % command)
+        return SVFOperation(compose(op.tdi), compose(op.smask),
+                            None if op.tdo is None else compose(op.tdo, fill=0),
+                            compose(op.mask, fill=0))
+
     async def svf_sir(self, tdi, smask, tdo, mask):
-        op = self._hir + SVFOperation(tdi, smask, tdo, mask) + self._tir
+        op = SVFOperation(tdi, smask, tdo, mask)
+        if self._taps is not None:
+            if len(tdi) != self._taps.ir_length:
+                raise SVFError("SIR command length (%d bits) does not match IR length of "
+                               "selected TAPs (%d bits)" % (len(tdi), self._taps.ir_length))
+            op = self._replicate("SIR", op, self._taps.compose_ir)
+        op = self._hir + op + self._tir
         await self.lower.enter_shift_ir()
         if op.tdo is None:
             await self.lower.shift_tdi(op.tdi)
+        elif self._stream:
+            await self._shift_compare("SIR", op)
         else:
             tdo = await self.lower.shift_tdio(op.tdi)
             if tdo & op.mask != op.tdo & op.mask:
@@ -138,10 +213,15 @@ class SVFInterface(SVFEventHandler):
         await self._enter_state(self._endir)
 
     async def svf_sdr(self, tdi, smask, tdo, mask):
-        op = self._hdr + SVFOperation(tdi, smask, tdo, mask) + self._tdr
+        op = SVFOperation(tdi, smask, tdo, mask)
+        if self._taps is not None:
+            op = self._replicate("SDR", op, self._taps.compose_dr)
+        op = self._hdr + op + self._tdr
         await self.lower.enter_shift_dr()
         if op.tdo is None:
             await self.lower.shift_tdi(op.tdi)
+        elif self._stream:
+            await self._shift_compare("SDR", op)
         else:
             tdo = await self.lower.shift_tdio(op.tdi)
             if tdo & op.mask != op.tdo & op.mask:
@@ -158,6 +238,10 @@ class SVFInterface(SVFEventHandler):
             self._logger.warning("RUNTEST exceeds maximum time: %d cycles (%.3f s) > %.3f s"
                                  % (run_count, run_count / self._frequency, max_time))
 
+        # RUNTEST usually waits for an erase or program operation to complete; do not start one
+        # if any of the preceding scans (e.g. a verify) has failed.
+        await self.check_compare()
+
         await self._enter_state(run_state)
         await self.lower.pulse_tck(run_count)
         await self._enter_state(end_state)
@@ -181,11 +265,43 @@ class JTAGSVFApplet(JTAGProbeApplet, name="jtag-svf"):
         * The SCK clock in RUNTEST is not supported.
 
     If any commands requiring these features are encountered, the applet terminates itself.
+
+    If --tap-index is specified, the test vector is played to the selected TAP, or, if it is
+    specified several times, to all of the selected (identical) TAPs at once, with all other TAPs
+    in BYPASS. The test vector must then not use HIR, TIR, HDR or TDR commands.
+
+    In the streaming mode, the test vector is memory-mapped and parsed incrementally, and
+    expected TDO values are compared with the actual ones in gateware. The TDO values are never
+    read back, so playback is not limited by USB round trips. The comparison results are checked
+    after the first compared scan, before every RUNTEST command, and at the end of the test vector;
+    a failure is reported at the first such check after it happens.
     """
 
+    @classmethod
+    def add_run_arguments(cls, parser, access):
+        super().add_run_arguments(parser, access)
+
+        parser.add_argument(
+            "--stream", default=False, action="store_true",
+            help="compare TDO in gateware, and check for failures before RUNTEST")
+        parser.add_argument(
+            "--tap-index", metavar="INDEX", type=int, action="append", dest="tap_indexes",
+            help="play the test vector to TAP #INDEX; if specified several times, play it to "
+                 "all of the selected TAPs at once (default: play it to the entire chain)")
+
     async def run(self, device, args):
         jtag_iface = await self.run_lower(JTAGSVFApplet, device, args)
-        return SVFInterface(jtag_iface, self.logger, args.frequency * 1000)
+        if args.tap_indexes:
+            taps_iface = await jtag_iface.select_taps(args.tap_indexes)
+            if not taps_iface:
+                raise JTAGProbeError("cannot select TAP %s"
+                                     % ", ".join("#%d" % index for index in args.tap_indexes))
+            if taps_iface.ir_length is None:
+                raise SVFError("selected TAPs have different IR lengths")
+        else:
+            taps_iface = None
+        return SVFInterface(jtag_iface, self.logger, args.frequency * 1000, stream=args.stream,
+                            taps=taps_iface)
 
     @classmethod
     def add_interact_arguments(cls, parser):
@@ -194,13 +310,113 @@ class JTAGSVFApplet(JTAGProbeApplet, name="jtag-svf"):
             help="test vector to play")
 
     async def interact(self, device, args, svf_iface):
-        svf_parser = SVFParser(args.svf_file.read(), svf_iface)
-        while True:
-            coro = svf_parser.parse_command()
-            if not coro: break
-
-            for line in svf_parser.last_command().split("\n"):
-                line = line.strip()
-                if line: svf_iface._log(line)
+        if args.stream:
+            try:
+                svf_buffer = mmap.mmap(args.svf_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError, io.UnsupportedOperation):
+                # Empty files and pipes cannot be mapped.
+                svf_buffer = args.svf_file.read()
+        else:
+            svf_buffer = args.svf_file.read()
 
-            await coro
+        svf_parser = SVFParser(svf_buffer, svf_iface)
+        try:
+            while True:
+                coro = svf_parser.parse_command()
+                if not coro: break
+
+                for line in svf_parser.last_command().split("\n"):
+                    line = line.strip()
+                    if line: svf_iface._log(line)
+
+                svf_iface.location = svf_parser.last_command_offset()
+                await coro
+
+            if args.stream:
+                await svf_iface.check_compare()
+        except SVFCompareError as error:
+            raise SVFError("%s command at line %d, column %d failed"
+                           % (error.command, *svf_parser.line_column(error.location))) from None
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+import asyncio
+
+
+class SVFScriptedInterface:
+    def __init__(self, tdo):
+        self._tdo    = iter(tdo)
+        self._index  = 0
+        self._failed = None
+        self.log     = []
+
+    async def enter_test_logic_reset(self, force=True):
+        self.log.append("RESET")
+
+    async def enter_run_test_idle(self):
+        self.log.append("IDLE")
+
+    async def enter_shift_ir(self):
+        self.log.append("SHIFT-IR")
+
+    async def enter_shift_dr(self):
+        self.log.append("SHIFT-DR")
+
+    async def enter_pause_ir(self):
+        self.log.append("PAUSE-IR")
+
+    async def enter_pause_dr(self):
+        self.log.append("PAUSE-DR")
+
+    async def shift_tdi(self, tdi, last=True):
+        self.log.append("TDI %s" % tdi)
+
+    async def shift_tdi_compare(self, tdi, tdo, mask, last=True):
+        self.log.append("TDI %s" % tdi)
+        if next(self._tdo) & mask != tdo & mask and self._failed is None:
+            self._failed = self._index
+        self._index += 1
+        return range(self._index - 1, self._index)
+
+    async def get_compare_status(self):
+        failed, self._failed, self._index = self._failed, None, 0
+        return failed
+
+    async def pulse_tck(self, count):
+        self.log.append("TCK %d" % count)
+
+
+class JTAGSVFStreamTestCase(unittest.TestCase):
+    def play(self, lower, svf):
+        iface = SVFInterface(lower, logging.getLogger(__name__), frequency=1e6, stream=True)
+        args  = argparse.Namespace(stream=True, svf_file=io.StringIO(svf))
+        asyncio.get_event_loop().run_until_complete(JTAGSVFApplet().interact(None, args, iface))
+
+    def test_pass(self):
+        lower = SVFScriptedInterface([bits("0110"), bits("01011010")])
+        self.play(lower, "STATE RESET;\n"
+                         "SIR 4 TDI (1) TDO (2) MASK (3);\n"
+                         "SDR 8 TDI (a5) TDO (5a);\n"
+                         "RUNTEST 100 TCK;\n")
+        self.assertIn("TCK 100", lower.log)
+
+    def test_fail_first(self):
+        lower = SVFScriptedInterface([bits("00000000")])
+        with self.assertRaisesRegex(SVFError,
+                r"^SDR command at line 2, column 1 failed$"):
+            self.play(lower, "STATE RESET;\n"
+                             "SDR 8 TDI (00) TDO (5a);\n"
+                             "SIR 4 TDI (1);\n")
+        self.assertNotIn("SHIFT-IR", lower.log)
+
+    def test_fail_before_runtest(self):
+        lower = SVFScriptedInterface([bits("01011010"), bits("0000"), bits("11111111")])
+        with self.assertRaisesRegex(SVFError,
+                r"^SDR command at line 4, column 3 failed$"):
+            self.play(lower, "STATE RESET;\n"
+                             "SDR 8 TDI (00) TDO (5a);\n"
+                             "SIR 4 TDI (1) TDO (0);\n"
+                             "  SDR 8 TDI (00) TDO (00) MASK (0f);\n"
+                             "RUNTEST 100 TCK;\n")
+        self.assertNotIn("TCK 100", lower.log)
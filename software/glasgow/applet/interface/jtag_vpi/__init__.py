@@ -0,0 +1,219 @@
+# Ref: OpenOCD src/jtag/drivers/jtag_vpi.c
+# Ref: OpenOCD doc/openocd.texi, section "Debug Adapter Configuration", driver "jtag_vpi"
+
+# The jtag_vpi protocol was designed for connecting OpenOCD to HDL simulators, but unlike remote
+# bitbang, it transfers entire TMS sequences and scans (of up to 4096 bits each) in one command,
+# so it is suitable for driving real hardware at the speed of the JTAG clock. Every command is
+# a fixed size structure:
+#
+#   struct vpi_cmd {
+#       int           cmd;
+#       unsigned char buffer_out[512];
+#       unsigned char buffer_in[512];
+#       int           length;  /* in bytes */
+#       int           nb_bits;
+#   };
+#
+# OpenOCD waits for the structure to be sent back (with `buffer_in` filled with TDO) after every
+# scan command, and does not expect any reply to other commands.
+
+import struct
+import logging
+import asyncio
+
+from ....support.bits import *
+from ....support.logging import *
+from ....support.endpoint import *
+from ... import *
+from ..jtag_probe import JTAGProbeApplet
+
+
+VPI_CMD_RESET                = 0
+VPI_CMD_TMS_SEQ              = 1
+VPI_CMD_SCAN_CHAIN           = 2
+VPI_CMD_SCAN_CHAIN_FLIP_TMS  = 3
+VPI_CMD_STOP_SIMU            = 4
+
+VPI_XFER_MAX_SIZE = 512
+
+_vpi_cmd = struct.Struct("<i{0}s{0}sii".format(VPI_XFER_MAX_SIZE))
+
+
+class JTAGVPIError(GlasgowAppletError):
+    pass
+
+
+class JTAGVPIInterface:
+    def __init__(self, interface, logger):
+        self.lower   = interface
+        self._logger = logger
+        self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
+
+    def _log(self, message, *args):
+        self._logger.log(self._level, "VPI: " + message, *args)
+
+    async def reset(self):
+        self._log("reset")
+        if self.lower.has_trst:
+            await self.lower.pulse_trst()
+        await self.lower.enter_test_logic_reset()
+
+    async def tms_seq(self, tms_bits):
+        self._log("tms seq=<%s>", dump_bin(tms_bits))
+        await self.lower.shift_tms(tms_bits)
+
+    async def scan_chain(self, tdi_bits, flip_tms):
+        self._log("scan chain%s tdi=<%s>", " flip tms" if flip_tms else "", dump_bin(tdi_bits))
+        tms_bits = bits(1 << (len(tdi_bits) - 1) if flip_tms else 0, len(tdi_bits))
+        tdo_bits = await self.lower.shift_raw(tms_bits, tdi_bits)
+        self._log("scan chain tdo=<%s>", dump_bin(tdo_bits))
+        return tdo_bits
+
+    async def serve(self, endpoint):
+        try:
+            while True:
+                await self._serve_command(endpoint)
+        except JTAGVPIError as error:
+            # The rest of the stream cannot be parsed; drop the connection, and discard anything
+            # else received from it, until the end of stream raises CancelledError.
+            self._logger.error("VPI: %s", error)
+            await endpoint.close()
+            while True:
+                await endpoint.recv()
+
+    async def _serve_command(self, endpoint):
+        cmd, buffer_out, _, length, nb_bits = \
+            _vpi_cmd.unpack(await endpoint.recv(_vpi_cmd.size))
+        if not 0 <= length <= VPI_XFER_MAX_SIZE or not 0 <= nb_bits <= length * 8:
+            raise JTAGVPIError("malformed command: length=%d nb_bits=%d"
+                               % (length, nb_bits))
+
+        if cmd == VPI_CMD_RESET:
+            await self.reset()
+        elif cmd == VPI_CMD_TMS_SEQ:
+            await self.tms_seq(bits(buffer_out, nb_bits))
+        elif cmd in (VPI_CMD_SCAN_CHAIN, VPI_CMD_SCAN_CHAIN_FLIP_TMS):
+            if nb_bits > 0:
+                tdo_bits = await self.scan_chain(bits(buffer_out, nb_bits),
+                                                 flip_tms=cmd == VPI_CMD_SCAN_CHAIN_FLIP_TMS)
+            else:
+                tdo_bits = bits()
+            await endpoint.send(_vpi_cmd.pack(cmd, buffer_out, bytes(tdo_bits),
+                                              length, nb_bits))
+        elif cmd == VPI_CMD_STOP_SIMU:
+            self._log("stop")
+            await self.lower.flush()
+        else:
+            raise JTAGVPIError("unknown command %d" % cmd)
+
+
+class JTAGVPIApplet(JTAGProbeApplet, name="jtag-vpi"):
+    logger = logging.getLogger(__name__)
+    help = "expose JTAG via OpenOCD jtag_vpi interface"
+    description = """
+    Expose JTAG via a socket using the OpenOCD jtag_vpi protocol.
+
+    Unlike the remote bitbang protocol used by the jtag-openocd applet, which transfers every
+    TCK edge separately, the jtag_vpi protocol transfers entire scans, which are performed
+    at the configured TCK frequency.
+
+    Usage:
+
+    ::
+        glasgow run jtag-vpi tcp:localhost:5555
+        openocd -c 'interface jtag_vpi; jtag_vpi_set_port 5555'
+    """
+
+    async def run(self, device, args):
+        jtag_iface = await self.run_lower(JTAGVPIApplet, device, args)
+        return JTAGVPIInterface(jtag_iface, self.logger)
+
+    @classmethod
+    def add_interact_arguments(cls, parser):
+        ServerEndpoint.add_argument(parser, "endpoint")
+
+    async def interact(self, device, args, vpi_iface):
+        endpoint = await ServerEndpoint("socket", self.logger, args.endpoint)
+        while True:
+            try:
+                await vpi_iface.serve(endpoint)
+            except asyncio.CancelledError:
+                pass
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+import tempfile
+
+
+class JTAGVPIScriptedInterface:
+    def __init__(self):
+        self.has_trst = False
+        self.log      = []
+
+    async def enter_test_logic_reset(self):
+        self.log.append("reset")
+
+    async def shift_tms(self, tms_bits):
+        self.log.append("tms {}".format(tms_bits))
+
+    async def shift_raw(self, tms_bits, tdi_bits):
+        self.log.append("raw tms={} tdi={}".format(tms_bits, tdi_bits))
+        return bits(~int(tdi_bits), len(tdi_bits))
+
+    async def flush(self):
+        self.log.append("flush")
+
+
+class JTAGVPIInterfaceTestCase(unittest.TestCase):
+    @staticmethod
+    def command(cmd, data=b"", nb_bits=0, length=None):
+        if length is None:
+            length = len(data)
+        return _vpi_cmd.pack(cmd, data, b"", length, nb_bits)
+
+    async def do_test_serve(self):
+        sock  = ("unix", "{}/test_vpi_sock".format(tempfile.gettempdir()))
+        endp  = await ServerEndpoint("socket", logging.getLogger(__name__), sock)
+        lower = JTAGVPIScriptedInterface()
+        iface = JTAGVPIInterface(lower, logging.getLogger(__name__))
+
+        async def serve():
+            for _ in range(4):
+                with self.assertRaises(asyncio.CancelledError):
+                    await iface.serve(endp)
+        server = asyncio.ensure_future(serve())
+
+        conn_rd, conn_wr = await asyncio.open_unix_connection(*sock[1:])
+        conn_wr.write(self.command(VPI_CMD_RESET) +
+                      self.command(VPI_CMD_TMS_SEQ, b"\x1f", 6) +
+                      self.command(VPI_CMD_SCAN_CHAIN_FLIP_TMS, b"\x35\x01", 9))
+        reply = _vpi_cmd.unpack(await conn_rd.readexactly(_vpi_cmd.size))
+        self.assertEqual(reply, (VPI_CMD_SCAN_CHAIN_FLIP_TMS, b"\x35\x01" + bytes(510),
+                                 b"\xca\x00" + bytes(510), 2, 9))
+        conn_wr.close()
+
+        for request in (self.command(VPI_CMD_SCAN_CHAIN, b"\x00", 9),
+                        self.command(VPI_CMD_RESET, length=513),
+                        self.command(7) + self.command(VPI_CMD_RESET)):
+            conn_rd, conn_wr = await asyncio.open_unix_connection(*sock[1:])
+            conn_wr.write(request)
+            self.assertEqual(await conn_rd.read(), b"")
+            conn_wr.close()
+
+        await server
+        endp.server.close()
+        self.assertEqual(lower.log, [
+            "reset",
+            "tms 011111",
+            "raw tms=100000000 tdi=100110101",
+        ])
+
+    def test_serve(self):
+        asyncio.get_event_loop().run_until_complete(self.do_test_serve())
+
+
+class JTAGVPIAppletTestCase(GlasgowAppletTestCase, applet=JTAGVPIApplet):
+    @synthesis_test
+    def test_build(self):
+        self.assertBuilds()
@@ -0,0 +1,171 @@
+# Ref: https://github.com/Xilinx/XilinxVirtualCable/blob/master/README.md
+
+# The Xilinx Virtual Cable protocol consists of three commands:
+#
+#   getinfo:                                      -> "xvcServer_v1.0:<max vector bytes>\n"
+#   settck:<period in ns, u32le>                  -> <actual period in ns, u32le>
+#   shift:<bit count, u32le><TMS vector><TDI vector> -> <TDO vector>
+#
+# The TMS and TDI vectors of a shift command are arbitrary, but in practice they consist of long
+# runs with TMS low, so every vector is split into a few probe shift commands, all of which are
+# queued before TDO is read back.
+
+import struct
+import logging
+import asyncio
+
+from ....support.bits import *
+from ....support.logging import *
+from ....support.endpoint import *
+from ... import *
+from ..jtag_probe import JTAGProbeApplet
+
+
+class JTAGXVCError(GlasgowAppletError):
+    pass
+
+
+class JTAGXVCInterface:
+    def __init__(self, interface, logger, frequency, max_vector_bytes=32768):
+        self.lower   = interface
+        self._logger = logger
+        self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
+        self._frequency = frequency
+
+        self.max_vector_bytes = max_vector_bytes
+
+    def _log(self, message, *args):
+        self._logger.log(self._level, "XVC: " + message, *args)
+
+    @property
+    def period_ns(self):
+        return round(1e9 / self._frequency)
+
+    async def shift(self, tms_bits, tdi_bits):
+        self._log("shift tms=<%s> tdi=<%s>", dump_bin(tms_bits), dump_bin(tdi_bits))
+        tdo_bits = await self.lower.shift_raw(tms_bits, tdi_bits)
+        self._log("shift tdo=<%s>", dump_bin(tdo_bits))
+        return tdo_bits
+
+    async def serve(self, endpoint):
+        try:
+            while True:
+                await self._serve_command(endpoint)
+        except JTAGXVCError as error:
+            # The rest of the stream cannot be parsed; drop the connection, and discard anything
+            # else received from it, until the end of stream raises CancelledError.
+            self._logger.error("XVC: %s", error)
+            await endpoint.close()
+            while True:
+                await endpoint.recv()
+
+    async def _serve_command(self, endpoint):
+        command = await endpoint.recv_until(b":")
+        if command == b"getinfo":
+            self._log("getinfo")
+            await endpoint.send(b"xvcServer_v1.0:%d\n" % self.max_vector_bytes)
+
+        elif command == b"settck":
+            period_ns, = struct.unpack("<L", await endpoint.recv(4))
+            # TCK frequency is fixed when the gateware is built; report the actual period,
+            # as the protocol requires.
+            self._log("settck period=%d ns (actual %d ns)", period_ns, self.period_ns)
+            await endpoint.send(struct.pack("<L", self.period_ns))
+
+        elif command == b"shift":
+            count, = struct.unpack("<L", await endpoint.recv(4))
+            size = (count + 7) // 8
+            if size > self.max_vector_bytes:
+                raise JTAGXVCError("shift of %d bits exceeds maximum vector length" % count)
+            if count == 0:
+                await endpoint.send(b"")
+                return
+            tms_bits = bits(await endpoint.recv(size), count)
+            tdi_bits = bits(await endpoint.recv(size), count)
+            tdo_bits = await self.shift(tms_bits, tdi_bits)
+            await endpoint.send(bytes(tdo_bits))
+
+        else:
+            raise JTAGXVCError("unknown command %r" % bytes(command))
+
+
+class JTAGXVCApplet(JTAGProbeApplet, name="jtag-xvc"):
+    logger = logging.getLogger(__name__)
+    help = "expose JTAG via Xilinx Virtual Cable"
+    description = """
+    Expose JTAG via a socket using the Xilinx Virtual Cable 1.0 protocol, which is supported
+    by Xilinx hw_server (and thus Vivado and iMPACT), as well as by other tools.
+
+    The TCK frequency is configured when building the applet; requests to change it are
+    acknowledged with the actual TCK period.
+
+    Usage:
+
+    ::
+        glasgow run jtag-xvc tcp::2542
+        hw_server -e 'set auto-open-servers xilinx-xvc:localhost:2542'
+    """
+
+    async def run(self, device, args):
+        jtag_iface = await self.run_lower(JTAGXVCApplet, device, args)
+        return JTAGXVCInterface(jtag_iface, self.logger, args.frequency * 1000)
+
+    @classmethod
+    def add_interact_arguments(cls, parser):
+        ServerEndpoint.add_argument(parser, "endpoint", default="tcp::2542")
+
+    async def interact(self, device, args, xvc_iface):
+        endpoint = await ServerEndpoint("socket", self.logger, args.endpoint)
+        while True:
+            try:
+                await xvc_iface.serve(endpoint)
+            except asyncio.CancelledError:
+                pass
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+import tempfile
+
+
+class JTAGXVCLoopbackInterface:
+    async def shift_raw(self, tms_bits, tdi_bits):
+        return tdi_bits
+
+
+class JTAGXVCInterfaceTestCase(unittest.TestCase):
+    async def do_test_errors(self):
+        sock = ("unix", "{}/test_xvc_sock".format(tempfile.gettempdir()))
+        endp = await ServerEndpoint("socket", logging.getLogger(__name__), sock)
+        iface = JTAGXVCInterface(JTAGXVCLoopbackInterface(), logging.getLogger(__name__),
+                                 frequency=1e6, max_vector_bytes=2)
+
+        async def serve():
+            for _ in range(3):
+                with self.assertRaises(asyncio.CancelledError):
+                    await iface.serve(endp)
+        server = asyncio.ensure_future(serve())
+
+        for request in (b"foo:getinfo:", b"shift:\x11\x00\x00\x00" + bytes(6)):
+            conn_rd, conn_wr = await asyncio.open_unix_connection(*sock[1:])
+            conn_wr.write(request)
+            self.assertEqual(await conn_rd.read(), b"")
+            conn_wr.close()
+
+        conn_rd, conn_wr = await asyncio.open_unix_connection(*sock[1:])
+        conn_wr.write(b"getinfo:shift:\x10\x00\x00\x00\x00\x00\x34\x12")
+        self.assertEqual(await conn_rd.readexactly(17), b"xvcServer_v1.0:2\n")
+        self.assertEqual(await conn_rd.readexactly(2), b"\x34\x12")
+        conn_wr.close()
+
+        await server
+        endp.server.close()
+
+    def test_errors(self):
+        asyncio.get_event_loop().run_until_complete(self.do_test_errors())
+
+
+class JTAGXVCAppletTestCase(GlasgowAppletTestCase, applet=JTAGXVCApplet):
+    @synthesis_test
+    def test_build(self):
+        self.assertBuilds()
@@ -1,12 +1,29 @@
 # Ref: MSP430™ Programming With the JTAG Interface
 # Accession: G00038
 
+# Memory access
+# -------------
+#
+# The MSP430 JTAG interface exposes the memory bus of the CPU, and the most straightforward way to
+# access memory is to drive the address and data buses for every word, which takes several IR and
+# DR scans, a few TCLK cycles, and (for reads) a USB round trip per word. Instead, memory is
+# accessed with the "quick" instruction: the PC is loaded with the start address, and then every
+# TCLK cycle in IR_DATA_QUICK mode increments the PC and performs a bus cycle at it, so that only
+# a single DR scan per word is needed.
+#
+# None of the scans in a quick transfer depend on the data read back, so they are all queued
+# as deferred scans, and the captured words are collected once for every chunk.
+
 import logging
 import asyncio
+import argparse
+import time
 from nmigen.compat import *
 from nmigen.compat.genlib.cdc import MultiReg
 
 from ....gateware.pads import *
+from ....support.bits import *
+from ....arch.msp430.jtag import *
 from ... import *
 from ..jtag_probe import JTAGProbeDriver, JTAGProbeInterface
 
@@ -189,11 +206,144 @@ class SpyBiWireProbeInterface(JTAGProbeInterface):
         await self.set_aux(0)
 
 
+class MSP430JTAGError(GlasgowAppletError):
+    pass
+
+
+class MSP430JTAGInterface:
+    """
+    Memory access for MSP430 devices with JTAG ID 0x89 (the 1xx, 2xx, and 4xx families), using
+    the sequences from "MSP430 Programming With the JTAG Interface".
+    """
+
+    def __init__(self, interface, logger):
+        self.lower   = interface
+        self._logger = logger
+        self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
+
+    def _log(self, message, *args):
+        self._logger.log(self._level, "MSP430: " + message, *args)
+
+    # The data registers are shifted MSB first.
+
+    async def _write_dr16(self, value):
+        await self.lower.write_dr(bits(value, 16).reversed())
+
+    async def _read_dr16(self, *, defer=False):
+        data_bits = await self.lower.read_dr(16, defer=defer)
+        if defer:
+            return data_bits.map(lambda data_bits: int(data_bits.reversed()))
+        return int(data_bits.reversed())
+
+    async def _write_cntrl_sig(self, **fields):
+        await self.lower.write_ir(IR_CNTRL_SIG_16BIT)
+        await self._write_dr16(DR_CNTRL_SIG_124(TCE1=1, TAGFUNCSAT=1, **fields).to_int())
+
+    async def identify(self):
+        await self.lower.test_reset()
+        jtag_id = int((await self.lower.read_ir(8)).reversed())
+        self._log("JTAG ID %#04x", jtag_id)
+        return jtag_id
+
+    async def _wait_cntrl_sig(self, field, tclk=False):
+        await self.lower.write_ir(IR_CNTRL_SIG_CAPTURE)
+        for _ in range(50):
+            if tclk:
+                await self.lower.set_tclk(False)
+                await self.lower.set_tclk(True)
+            cntrl_sig = DR_CNTRL_SIG_124.from_int(await self._read_dr16())
+            if getattr(cntrl_sig, field):
+                return
+        raise MSP430JTAGError("CPU did not assert %s" % field)
+
+    async def attach(self):
+        """Take control of the CPU via JTAG."""
+        jtag_id = await self.identify()
+        if jtag_id == 0xff:
+            raise MSP430JTAGError("no target detected; connection problem?")
+        if jtag_id != 0x89:
+            raise MSP430JTAGError("MSP430 core with JTAG ID %#04x is not supported" % jtag_id)
+
+        self._log("attach")
+        await self._write_cntrl_sig(R_W=1)
+        await self._wait_cntrl_sig("TCE")
+
+    async def _set_instr_fetch(self):
+        await self._wait_cntrl_sig("INSTR_LOAD", tclk=True)
+
+    async def _set_pc(self, address):
+        self._log("set pc=%04x", address)
+        await self._set_instr_fetch()
+        await self._write_cntrl_sig(R_W=1, RELEASE_LBYTE=1)
+        await self.lower.write_ir(IR_DATA_16BIT)
+        await self._write_dr16(0x4030) # MOV #imm, PC
+        await self.lower.set_tclk(False)
+        await self.lower.set_tclk(True)
+        await self._write_dr16(address)
+        await self.lower.set_tclk(False)
+        await self.lower.write_ir(IR_ADDR_CAPTURE)
+        await self.lower.set_tclk(True)
+        await self.lower.set_tclk(False)
+        await self._write_cntrl_sig(R_W=1)
+
+    async def _halt_cpu(self):
+        self._log("halt cpu")
+        await self._set_instr_fetch()
+        await self.lower.write_ir(IR_DATA_16BIT)
+        await self._write_dr16(0x3fff) # JMP $
+        await self.lower.set_tclk(False)
+        await self._write_cntrl_sig(R_W=1, HALT_JTAG=1)
+        await self.lower.set_tclk(True)
+
+    async def _release_cpu(self):
+        self._log("release cpu")
+        await self.lower.set_tclk(False)
+        await self._write_cntrl_sig(R_W=1)
+        await self.lower.write_ir(IR_ADDR_CAPTURE)
+        await self.lower.set_tclk(True)
+
+    async def read_words(self, address, count, chunk_size=0x400):
+        """Read ``count`` 16-bit words starting at word-aligned ``address``."""
+        if address % 2 != 0:
+            raise MSP430JTAGError("address %#06x is not word-aligned" % address)
+        if address < 0 or count < 0 or address + count * 2 > 0x10000:
+            raise MSP430JTAGError("%d words at address %#06x are outside of address space"
+                                  % (count, address))
+        self._log("read address=%04x count=%d", address, count)
+        await self._set_pc(address - 4)
+        await self._halt_cpu()
+        await self.lower.set_tclk(False)
+        await self._write_cntrl_sig(R_W=1, HALT_JTAG=1)
+        await self.lower.write_ir(IR_DATA_QUICK)
+        words = []
+        for chunk_offset in range(0, count, chunk_size):
+            results = []
+            for _ in range(min(chunk_size, count - chunk_offset)):
+                await self.lower.pulse_tclk(2)
+                results.append(await self._read_dr16(defer=True))
+            await self.lower.collect()
+            words += [result.result() for result in results]
+        await self._write_cntrl_sig(R_W=1)
+        await self._release_cpu()
+        return words
+
+    async def read_memory(self, address, length):
+        start = address & ~1
+        count = (address + length - start + 1) // 2
+        data  = bytearray()
+        for word in await self.read_words(start, count):
+            data += word.to_bytes(2, "little")
+        return bytes(data[address - start:address - start + length])
+
+
 class SpyBiWireProbeApplet(GlasgowApplet, name="sbw-probe"):
     logger = logging.getLogger(__name__)
     help = "probe microcontrollers via TI Spy-Bi-Wire"
     description = """
     Probe Texas Instruments microcontrollers via Spy-Bi-Wire 2-wire JTAG transport layer.
+
+    Memory of MSP430 devices with JTAG ID 0x89 (the 1xx, 2xx, and 4xx families) can be read and
+    verified using quick memory access.
     """
     required_revision = "C0"
 
@@ -224,17 +374,97 @@ class SpyBiWireProbeApplet(GlasgowApplet, name="sbw-probe"):
         iface = await device.demultiplexer.claim_interface(self, self.mux_interface, args)
         return SpyBiWireProbeInterface(iface, self.logger, __name__=__name__)
 
+    @classmethod
+    def add_interact_arguments(cls, parser):
+        def address(arg):
+            return int(arg, 0)
+
+        p_operation = parser.add_subparsers(dest="operation", metavar="OPERATION")
+
+        p_read_memory = p_operation.add_parser(
+            "read-memory", help="read target memory")
+        p_read_memory.add_argument(
+            "address", metavar="ADDRESS", type=address,
+            help="read memory from address ADDRESS")
+        p_read_memory.add_argument(
+            "length", metavar="LENGTH", type=address,
+            help="read LENGTH bytes from memory")
+        p_read_memory.add_argument(
+            "file", metavar="FILENAME", type=argparse.FileType("wb"),
+            help="write memory contents to binary file FILENAME")
+
+        p_verify_memory = p_operation.add_parser(
+            "verify-memory", help="verify target memory")
+        p_verify_memory.add_argument(
+            "address", metavar="ADDRESS", type=address,
+            help="verify memory starting at address ADDRESS")
+        p_verify_memory.add_argument(
+            "file", metavar="FILENAME", type=argparse.FileType("rb"),
+            help="compare memory contents with binary file FILENAME")
+
     async def interact(self, device, args, sbw_iface):
         await sbw_iface.test_reset()
         version_bits = await sbw_iface.read_ir(8)
         version = int(version_bits.reversed())
         if version == 0xff:
             self.logger.error("no target detected; connection problem?")
+            return
         else:
             self.logger.info("found MSP430 core with JTAG ID %#04x", version)
 
+        if args.operation is None:
+            return
+
+        msp430_iface = MSP430JTAGInterface(sbw_iface, self.logger)
+        await msp430_iface.attach()
+
+        if args.operation == "read-memory":
+            begin = time.time()
+            data  = await msp430_iface.read_memory(args.address, args.length)
+            end   = time.time()
+            args.file.write(data)
+
+        if args.operation == "verify-memory":
+            gold_data = args.file.read()
+            begin = time.time()
+            data  = await msp430_iface.read_memory(args.address, len(gold_data))
+            end   = time.time()
+            for offset, (byte, gold_byte) in enumerate(zip(data, gold_data)):
+                if byte != gold_byte:
+                    raise MSP430JTAGError("verification failed at address %04x: "
+                                          "expected %02x, got %02x"
+                                          % (args.address + offset, gold_byte, byte))
+            self.logger.info("verified successfully")
+
+        self.logger.info("read %d bytes in %.3f s (%.2f KiB/s)",
+                         len(data), end - begin, len(data) / 1024 / (end - begin))
+
 # -------------------------------------------------------------------------------------------------
 
+import unittest
+
+
+class MSP430JTAGInterfaceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.iface = MSP430JTAGInterface(None, logging.getLogger(__name__))
+
+    def assertFails(self, coro, message):
+        with self.assertRaisesRegex(MSP430JTAGError, message):
+            asyncio.get_event_loop().run_until_complete(coro)
+
+    def test_read_unaligned(self):
+        self.assertFails(self.iface.read_words(0x201, 1),
+            r"^address 0x0201 is not word-aligned$")
+
+    def test_read_out_of_range(self):
+        self.assertFails(self.iface.read_words(0xfffe, 2),
+            r"^2 words at address 0xfffe are outside of address space$")
+        self.assertFails(self.iface.read_memory(0xffff, 2),
+            r"^2 words at address 0xfffe are outside of address space$")
+        self.assertFails(self.iface.read_words(0x0200, -1),
+            r"^-1 words at address 0x0200 are outside of address space$")
+
+
 class SpyBiWireProbeAppletTestCase(GlasgowAppletTestCase, applet=SpyBiWireProbeApplet):
     @synthesis_test
     def test_build(self):
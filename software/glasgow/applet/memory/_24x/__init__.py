@@ -1,3 +1,4 @@
+import time
 import logging
 import argparse
 
@@ -27,37 +28,23 @@ class Memory24xInterface:
             return (i2c_addr, [addr & 0xff])
 
     async def read(self, addr, length):
-        chunks = []
+        i2c_addr, addr_bytes = self._carry_addr(addr)
 
-        while length > 0:
-            i2c_addr, addr_bytes = self._carry_addr(addr)
-
-            # Our lower layer can't do reads of 64K and higher, so use 32K chunks.
-            chunk_size = min(length, 0x8000)
-
-            # Note that even if this is a 1-byte address EEPROM and we write 2 bytes here,
-            # we will not overwrite the contents, since the actual write is only initiated
-            # on stop, not repeated start condition.
-            self._log("i2c-addr=%#04x addr=%#06x", i2c_addr, addr)
-            result = await self.lower.write(i2c_addr, addr_bytes)
-            if result is False:
-                self._log("unacked")
-                return None
-
-            self._log("read=%d", chunk_size)
-            chunk = await self.lower.read(i2c_addr, chunk_size, stop=True)
-            if chunk is None:
-                self._log("unacked")
-            else:
-                self._log("chunk=<%s>", chunk.hex())
-                chunks.append(chunk)
+        # Note that the address is written and then the data is read after a repeated start
+        # condition; the actual write would only be initiated on a stop condition.
+        self._log("i2c-addr=%#04x addr=%#06x read=%d", i2c_addr, addr, length)
+        data, = await self.lower.transact([(i2c_addr, addr_bytes, length)])
+        if data is None:
+            self._log("unacked")
+            return None
 
-            length -= chunk_size
-            addr   += chunk_size
-
-        return b"".join(chunks)
+        self._log("data=<%s>", data.hex())
+        return data
 
     async def write(self, addr, data):
+        # Every page write is followed by polling the memory until it finishes the write cycle,
+        # which is done in gateware, so all of the pages are queued at once.
+        transactions = []
         while len(data) > 0:
             i2c_addr, addr_bytes = self._carry_addr(addr)
 
@@ -69,16 +56,32 @@ class Memory24xInterface:
             chunk = data[:chunk_size]
             data  = data[chunk_size:]
             self._log("i2c-addr=%#04x addr=%#06x write=<%s>", i2c_addr, addr, chunk.hex())
-            result = await self.lower.write(i2c_addr, [*addr_bytes, *chunk], stop=True)
-            if result is False:
-                self._log("unacked")
-                return False
-
-            while not await self.lower.poll(i2c_addr): pass
+            transactions.append((i2c_addr, [*addr_bytes, *chunk], None))
             addr += len(chunk)
 
+        results = await self.lower.transact(transactions, poll_attempts=10000)
+        for (i2c_addr, *_), result in zip(transactions, results):
+            if result is None:
+                self._log("i2c-addr=%#04x unacked", i2c_addr)
+                return False
+
         return True
 
+    async def verify(self, addr, data):
+        """
+        Read back ``len(data)`` bytes starting at ``addr`` and compare them with ``data``.
+
+        Returns ``None`` if they match, or the address of the first differing byte, together
+        with the expected and the actual value of that byte.
+        """
+        actual_data = await self.read(addr, len(data))
+        if actual_data is None:
+            raise GlasgowAppletError("memory did not acknowledge read")
+        for offset, (gold_byte, actual_byte) in enumerate(zip(data, actual_data)):
+            if gold_byte != actual_byte:
+                return addr + offset, gold_byte, actual_byte
+        return None
+
 
 class Memory24xApplet(I2CInitiatorApplet, name="memory-24x"):
     logger = logging.getLogger(__name__)
@@ -182,6 +185,9 @@ class Memory24xApplet(I2CInitiatorApplet, name="memory-24x"):
         g_write_data.add_argument(
             "-f", "--file", metavar="FILENAME", type=argparse.FileType("rb"),
             help="write memory with contents of FILENAME")
+        p_write.add_argument(
+            "-V", "--verify", default=False, action="store_true",
+            help="read back and verify memory contents after writing")
 
         p_verify = p_operation.add_parser(
             "verify", help="verify memory")
@@ -207,26 +213,24 @@ class Memory24xApplet(I2CInitiatorApplet, name="memory-24x"):
             else:
                 print(data.hex())
 
-        if args.operation == "write":
+        if args.operation in ("write", "verify"):
             if args.data is not None:
                 data = args.data
             if args.file is not None:
                 data = args.file.read()
 
+        if args.operation == "write":
+            begin = time.time()
             success = await m24x_iface.write(args.address, data)
             if not success:
                 raise GlasgowAppletError("memory did not acknowledge write")
+            self.logger.info("wrote %d bytes in %.3f s", len(data), time.time() - begin)
 
-        if args.operation == "verify":
-            if args.data is not None:
-                golden_data = args.data
-            if args.file is not None:
-                golden_data = args.file.read()
-
-            actual_data = await m24x_iface.read(args.address, len(golden_data))
-            if actual_data is None:
-                raise GlasgowAppletError("memory did not acknowledge read")
-            if actual_data == golden_data:
+        if args.operation == "verify" or args.operation == "write" and args.verify:
+            difference = await m24x_iface.verify(args.address, data)
+            if difference is None:
                 self.logger.info("verify PASS")
             else:
+                self.logger.error("first differing byte at %#06x (expected %#04x, actual %#04x)",
+                                  *difference)
                 raise GlasgowAppletError("verify FAIL")
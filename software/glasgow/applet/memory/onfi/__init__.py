@@ -74,17 +74,70 @@
 # of the selected planes, the page index must be the same. For example, in a device with two
 # planes, a multi-plane operation may affect any even and any odd block, and if the operation
 # is page-oriented, the offset into the block must be the same for both.
+#
+# Streaming reads
+# ---------------
+#
+# Reading a page consists of loading it from the array into the page register, which takes tR
+# (typically tens of microseconds), and then transferring it out. When the memory supports
+# the Read Cache commands, the page register is copied into a separate cache register with
+# the Read Cache Sequential (31h) command, and the next page is loaded from the array while
+# the previous one is transferred out of the cache register; the last page is copied with
+# the Read Cache End (3Fh) command. A sequence of cache reads is always started anew at a block
+# boundary, since some memories do not allow it to cross one.
+#
+# In either case, the commands to read the next block are queued before the data of the current
+# block is received, so that the memory is never idle while waiting for the host.
+#
+# Bad blocks
+# ----------
+#
+# Blocks that are found to be bad during manufacturing are marked by a byte other than FFh in
+# the first byte of the spare area of the first or the last page of the block. These markers may
+# be lost after the block is erased, so they should be recorded before that.
+#
+# Interleaved programming
+# -----------------------
+#
+# Programming a page takes tPROG (typically hundreds of microseconds), and erasing a block takes
+# tBERS (typically milliseconds), which is much longer than it takes to transfer a page, so
+# programming is sped up by keeping as many LUNs busy at once as possible. Blocks are programmed
+# in rounds: in every round, a page is transferred to every LUN (on every target, if several CE#
+# pins are used), and only then the host waits for R/B#. Since all R/B# pins are tied together,
+# this waits until every LUN is ready. Afterwards, the status of every LUN is read with Read
+# Status (70h) if there is only one LUN in use on that target, and with Read Status Enhanced (78h)
+# otherwise. The status replies are only checked at the end of every block, so the status reads
+# do not add round trips.
+#
+# When the memory supports the Page Cache Program (15h) command, every page in a block except
+# for the last one is programmed with it, so that the next page is transferred while the previous
+# one is being programmed. The status after a Page Cache Program command reports whether
+# the previous page failed to program (in the FAILC bit); the status after the last page, which
+# is programmed with the Page Program (10h) command, reports both of the last two pages.
+#
+# Error correction
+# ----------------
+#
+# The data read from the memory can be corrected on the host, using a Hamming or BCH code and
+# an ECC layout in the spare area as described in glasgow.protocol.nand_ecc. Correction is much
+# slower than reading, so every block is corrected in a process pool while the following blocks
+# are being read, and written out in order once it is corrected.
 
+import os
+import time
 import argparse
 import logging
 import asyncio
 import struct
+import collections
+import concurrent.futures
 from nmigen.compat import *
 from nmigen.compat.genlib.cdc import MultiReg
 
 from ....support.logging import *
 from ....database.jedec import *
 from ....protocol.onfi import *
+from ....protocol.nand_ecc import *
 from ... import *
 
 
@@ -273,6 +326,7 @@ class ONFIInterface:
         self.lower   = interface
         self._logger = logger
         self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
+        self._chip   = None
 
     def _log(self, message, *args):
         self._logger.log(self._level, "ONFI: " + message, *args)
@@ -281,6 +335,7 @@ class ONFIInterface:
         assert chip in range(0, 4)
         self._log("select chip=%d", chip)
         await self.lower.write(struct.pack("<BB", CMD_SELECT, chip))
+        self._chip = chip
 
     async def _control(self, bits):
         await self.lower.write(struct.pack("<BB", CMD_CONTROL, bits))
@@ -358,6 +413,50 @@ class ONFIInterface:
         self._log("read unique ID")
         return await self._do_read(command=0xED, address=[0x00], wait=True, length=32)
 
+    async def _queue_read(self, row, count, length, cache):
+        self._log("read row=%#08x count=%d cache=%d", row, count, cache)
+        def address(row):
+            return [
+                0,
+                0,
+                (row >>  0) & 0xff,
+                (row >>  8) & 0xff,
+                (row >> 16) & 0xff,
+            ]
+        if cache and count > 1:
+            await self._do(command=0x00, address=address(row))
+            await self._do(command=0x30, wait=True)
+            for index in range(count):
+                await self._do(command=0x31 if index < count - 1 else 0x3F, wait=True)
+                await self._read(length)
+        else:
+            for index in range(count):
+                await self._do(command=0x00, address=address(row + index))
+                await self._do(command=0x30, wait=True)
+                await self._read(length)
+
+    async def read_pages(self, row, count, length, block_size, cache=False):
+        """
+        Read the first ``length`` bytes of ``count`` pages starting at ``row``, using the Read
+        Cache commands if ``cache`` is true. Yields ``(row, data)`` for every page.
+        """
+        segments = []
+        while count > 0:
+            segment_count = min(count, block_size - row % block_size)
+            segments.append((row, segment_count))
+            row   += segment_count
+            count -= segment_count
+
+        if segments:
+            await self._queue_read(*segments[0], length, cache)
+        for index, (row, count) in enumerate(segments):
+            if index + 1 < len(segments):
+                await self._queue_read(*segments[index + 1], length, cache)
+            data = await self.lower.read(count * length)
+            self._log("read data=<%s>", dump_hex(data))
+            for offset in range(count):
+                yield row + offset, data[offset * length:(offset + 1) * length]
+
     async def read(self, row, column, length):
         self._log("read row=%#08x column=%#06x", row, column)
         await self._do(command=0x00, address=[
@@ -400,6 +499,155 @@ class ONFIInterface:
         await self._do(command=0xD0, wait=True)
         return (await self.read_status() & BIT_STATUS_FAIL) == 0
 
+    async def _queue_program(self, row, chunks, cache):
+        self._log("program row=%#08x cache=%d", row, cache)
+        await self._do_write(command=0x80, address=[
+            0,
+            0,
+            (row >>  0) & 0xff,
+            (row >>  8) & 0xff,
+            (row >> 16) & 0xff,
+        ])
+
+        for (column, data) in chunks:
+            data = bytes(data)
+            self._log("column=%#06x data=<%s>", column, dump_hex(data))
+            await self._do_write(command=0x85, address=[
+                (column >>  0) & 0xff,
+                (column >>  8) & 0xff,
+            ], data=data)
+
+        await self._do(command=0x15 if cache else 0x10)
+
+    async def _queue_erase(self, row):
+        self._log("erase row=%#08x", row)
+        await self._do(command=0x60, address=[
+            (row >>  0) & 0xff,
+            (row >>  8) & 0xff,
+            (row >> 16) & 0xff,
+        ])
+        await self._do(command=0xD0)
+
+    async def _queue_status(self, row=None):
+        if row is None:
+            await self._do(command=0x70)
+        else:
+            await self._do(command=0x78, address=[
+                (row >>  0) & 0xff,
+                (row >>  8) & 0xff,
+                (row >> 16) & 0xff,
+            ])
+        await self._read(1)
+
+    async def _queue_round(self, operations, enhanced):
+        # Start every operation, wait until all of them complete, and queue the status reads.
+        for chip, row, operation in operations:
+            if chip != self._chip:
+                await self.select(chip)
+            await operation
+        self._log("r/b wait")
+        await self._wait()
+        for chip, row, operation in operations:
+            if chip != self._chip:
+                await self.select(chip)
+            await self._queue_status(row if chip in enhanced else None)
+
+    @staticmethod
+    def _shared_chips(chips):
+        return {chip for chip in chips if chips.count(chip) > 1}
+
+    async def program_blocks(self, units, cache=False):
+        """
+        Program pages in several blocks at once. Each of ``units`` is a ``(chip, row, pages)``
+        tuple, where ``pages`` is a list of ``chunks`` (as for ``program``) for consecutive pages
+        starting at ``row``, all within one block. All units must be on different targets, or on
+        different LUNs of the same target. If ``cache`` is true, Page Cache Program is used.
+
+        Returns a list of the rows that failed to program.
+        """
+        chip     = self._chip
+        enhanced = self._shared_chips([chip for chip, row, pages in units])
+        checks   = []
+        for index in range(max(len(pages) for chip, row, pages in units)):
+            operations = []
+            for unit_chip, row, pages in units:
+                if index >= len(pages):
+                    continue
+                last = index + 1 == len(pages)
+                operations.append((unit_chip, row + index,
+                    self._queue_program(row + index, pages[index], cache=cache and not last)))
+                checks.append((row + index, index > 0 and cache, last or not cache))
+            await self._queue_round(operations, enhanced)
+        if self._chip != chip:
+            await self.select(chip)
+
+        statuses = await self.lower.read(len(checks))
+        self._log("status=<%s>", dump_hex(statuses))
+        failed = []
+        for (row, check_prev, check_this), status in zip(checks, statuses):
+            if check_prev and status & BIT_STATUS_FAIL_PREV:
+                failed.append(row - 1)
+            if check_this and status & BIT_STATUS_FAIL:
+                failed.append(row)
+        return sorted(failed)
+
+    async def erase_blocks(self, units):
+        """
+        Erase several blocks at once. Each of ``units`` is a ``(chip, row)`` tuple. All units
+        must be on different targets, or on different LUNs of the same target.
+
+        Returns a list of the rows that failed to erase.
+        """
+        chip     = self._chip
+        enhanced = self._shared_chips([chip for chip, row in units])
+        await self._queue_round([
+            (unit_chip, row, self._queue_erase(row))
+            for unit_chip, row in units
+        ], enhanced)
+        if self._chip != chip:
+            await self.select(chip)
+
+        statuses = await self.lower.read(len(units))
+        self._log("status=<%s>", dump_hex(statuses))
+        return [row for (unit_chip, row), status in zip(units, statuses)
+                if status & BIT_STATUS_FAIL]
+
+
+class _ECCPipeline:
+    def __init__(self, layout):
+        self._layout   = layout
+        self._executor = concurrent.futures.ProcessPoolExecutor()
+        self._pending  = collections.deque()
+        self._limit    = 2 * (os.cpu_count() or 1)
+        self.histogram = collections.Counter()
+        self.failed    = []
+
+    def submit(self, row, pages):
+        future = asyncio.get_event_loop().run_in_executor(
+            self._executor, correct_pages, self._layout, [bytes(page) for page in pages])
+        self._pending.append((row, future))
+
+    async def collect(self, wait=False):
+        """
+        Yield ``(row, pages)`` for every corrected batch of pages, in order. Unless ``wait`` is
+        true, only batches that are already corrected are yielded, unless there are too many
+        pending ones.
+        """
+        while self._pending and (wait or self._pending[0][1].done() or
+                                 len(self._pending) > self._limit):
+            row, future = self._pending.popleft()
+            pages = []
+            for index, (page, flips) in enumerate(await future):
+                if flips is None:
+                    self.failed.append(row + index)
+                else:
+                    self.histogram[flips] += 1
+                pages.append(page)
+            yield row, pages
+
+    def close(self):
+        self._executor.shutdown()
+
 
 class MemoryONFIApplet(GlasgowApplet, name="memory-onfi"):
     preview = True
@@ -428,9 +676,21 @@ class MemoryONFIApplet(GlasgowApplet, name="memory-onfi"):
     The applet use the following commands while reading and writing data:
 
         * Cmd 0x70: Read Status (all devices)
+        * Cmd 0x78 Addr Row1..3: Read Status Enhanced (if several LUNs are used at once)
         * Cmd 0x00 Addr Col1..2,Row1..3 Cmd 0x30: Read (all devices)
+        * Cmd 0x31, Cmd 0x3F: Read Cache Sequential/End (if supported)
         * Cmd 0x60 Addr Row1..3 Cmd 0xD0: Erase (all devices)
         * Cmd 0x80 Addr Col1..2,Row1..3 [Cmd 0x85 Col1..2]+ Cmd 0x10: Page Program (all devices)
+        * Cmd 0x80 Addr Col1..2,Row1..3 [Cmd 0x85 Col1..2]+ Cmd 0x15: Page Cache Program
+          (if supported)
+
+    When reading, the data area can be corrected using a Hamming code (3 bytes of ECC per
+    256 bytes) or a BCH code, with ECCs stored one after another in the spare area. The BCH code
+    strength defaults to the ECC correctability reported in the ONFI parameter page, and
+    the ECCs are by default placed at the end of the spare area.
+
+    When programming or erasing, blocks on different LUNs (if multi-LUN operations are supported)
+    and, with --all-chips, on different targets are programmed or erased at the same time.
     """
     pin_sets = ("io", "ce")
     pins = ("cle", "ale", "re", "we", "r_b")
@@ -496,6 +756,21 @@ class MemoryONFIApplet(GlasgowApplet, name="memory-onfi"):
             "-B", "--block-size", metavar="SIZE", type=size,
             help="Flash block size, in pages (default: autodetect)")
 
+        def add_ecc_arguments(parser):
+            parser.add_argument(
+                "--ecc", metavar="CODE", choices=("hamming", "bch"),
+                help="correct data area using ECC code CODE (one of: hamming bch)")
+            parser.add_argument(
+                "--ecc-step", metavar="SIZE", type=size,
+                help="correct SIZE bytes of data per ECC (default: 256 for hamming, "
+                     "512 for bch)")
+            parser.add_argument(
+                "--ecc-strength", metavar="BITS", type=int,
+                help="correct BITS bit errors per ECC step with bch (default: autodetect)")
+            parser.add_argument(
+                "--ecc-offset", metavar="OFFSET", type=size,
+                help="ECCs start at OFFSET bytes into spare area (default: at the end)")
+
         # TODO(py3.7): add required=True
         p_operation = parser.add_subparsers(dest="operation", metavar="OPERATION")
 
@@ -510,6 +785,7 @@ class MemoryONFIApplet(GlasgowApplet, name="memory-onfi"):
         p_read.add_argument(
             "count", metavar="COUNT", type=count,
             help="read COUNT pages")
+        add_ecc_arguments(p_read)
         p_read.add_argument(
             "data_file", metavar="DATA-FILE", type=argparse.FileType("wb"),
             help="write bytes from data and possibly spare area to DATA-FILE")
@@ -517,6 +793,28 @@ class MemoryONFIApplet(GlasgowApplet, name="memory-onfi"):
             "spare_file", metavar="SPARE-FILE", type=argparse.FileType("wb"), nargs="?",
             help="write bytes from spare area to SPARE-FILE instead of DATA-FILE")
 
+        p_dump = p_operation.add_parser(
+            "dump", help="read data and spare contents for the entire target")
+        p_dump.add_argument(
+            "-C", "--block-count", metavar="COUNT", type=count,
+            help="read COUNT blocks (default: autodetect)")
+        p_dump.add_argument(
+            "--no-cache", dest="cache", default=True, action="store_false",
+            help="do not use Read Cache commands even if they are supported")
+        p_dump.add_argument(
+            "--skip-bad-blocks", default=False, action="store_true",
+            help="do not write blocks marked as bad to DATA-FILE and SPARE-FILE")
+        p_dump.add_argument(
+            "--bad-block-map", metavar="MAP-FILE", type=argparse.FileType("w"),
+            help="write indexes of blocks marked as bad to MAP-FILE, one per line")
+        add_ecc_arguments(p_dump)
+        p_dump.add_argument(
+            "data_file", metavar="DATA-FILE", type=argparse.FileType("wb"),
+            help="write bytes from data and possibly spare area to DATA-FILE")
+        p_dump.add_argument(
+            "spare_file", metavar="SPARE-FILE", type=argparse.FileType("wb"), nargs="?",
+            help="write bytes from spare area to SPARE-FILE instead of DATA-FILE")
+
         p_program = p_operation.add_parser(
             "program", help="program data and spare contents for a page range")
         p_program.add_argument(
@@ -525,12 +823,19 @@ class MemoryONFIApplet(GlasgowApplet, name="memory-onfi"):
         p_program.add_argument(
             "count", metavar="COUNT", type=count,
             help="program COUNT pages")
+        p_program.add_argument(
+            "-A", "--all-chips", default=False, action="store_true",
+            help="program the page range on every connected target; DATA-FILE and SPARE-FILE "
+                 "contain the contents for every target, one after another")
+        p_program.add_argument(
+            "--no-cache", dest="cache", default=True, action="store_false",
+            help="do not use Page Cache Program command even if it is supported")
         p_program.add_argument(
             "data_file", metavar="DATA-FILE", type=argparse.FileType("rb"),
-            help="program bytes to data area from DATA-FILE")
+            help="program bytes to data and possibly spare area from DATA-FILE")
         p_program.add_argument(
-            "spare_file", metavar="SPARE-FILE", type=argparse.FileType("rb"),
-            help="program bytes to spare area from SPARE-FILE")
+            "spare_file", metavar="SPARE-FILE", type=argparse.FileType("rb"), nargs="?",
+            help="program bytes to spare area from SPARE-FILE instead of DATA-FILE")
 
         p_erase = p_operation.add_parser(
             "erase", help="erase any blocks containing a page range")
@@ -540,6 +845,25 @@ class MemoryONFIApplet(GlasgowApplet, name="memory-onfi"):
         p_erase.add_argument(
             "count", metavar="COUNT", type=count, nargs="?", default=1,
             help="erase blocks containing the next COUNT pages")
+        p_erase.add_argument(
+            "-A", "--all-chips", default=False, action="store_true",
+            help="erase the blocks on every connected target")
+
+    @staticmethod
+    def _schedule(chips, row, count, block_size, lun_size):
+        # Split the page range on every chip at block boundaries, and group the resulting
+        # segments into rounds, with at most one segment on every LUN of every chip per round.
+        lanes = {}
+        for chip in chips:
+            segment_row = row
+            while segment_row < row + count:
+                segment_count = min(row + count - segment_row,
+                                    block_size - segment_row % block_size)
+                lane = (chip, segment_row // lun_size if lun_size else 0)
+                lanes.setdefault(lane, []).append((chip, segment_row, segment_count))
+                segment_row += segment_count
+        while any(lanes.values()):
+            yield [lane.pop(0) for lane in lanes.values() if lane]
 
     async def interact(self, device, args, onfi_iface):
         manufacturer_id, device_id = await onfi_iface.read_jedec_id()
@@ -703,59 +1027,218 @@ class MemoryONFIApplet(GlasgowApplet, name="memory-onfi"):
             block_size = args.block_size
 
         if args.operation in ("program", "erase"):
-            if await onfi_iface.is_write_protected():
-                self.logger.error("device is write-protected")
-                return
+            if args.all_chips:
+                chips = list(range(len(args.pin_set_ce)))
+            else:
+                chips = [args.chip - 1]
+            for chip in chips:
+                await onfi_iface.select(chip)
+                if await onfi_iface.is_write_protected():
+                    self.logger.error("device is write-protected")
+                    return
+            await onfi_iface.select(args.chip - 1)
+
+            if (onfi_param is not None and onfi_param.luns_per_target > 1 and
+                    onfi_param.features.multiple_lun_ops):
+                lun_size = onfi_param.blocks_per_lun * block_size
+            else:
+                lun_size = None
+            rounds = self._schedule(chips, args.start_page, args.count, block_size, lun_size)
+
+        if args.operation in ("read", "dump"):
+            ecc_pipeline = None
+            if args.ecc == "hamming":
+                if args.ecc_step not in (None, HammingCode.step_size):
+                    self.logger.error("Hamming code ECC step must be %d bytes",
+                                      HammingCode.step_size)
+                    return
+                ecc_code = HammingCode()
+            elif args.ecc == "bch":
+                ecc_step = args.ecc_step or 512
+                if args.ecc_strength is not None:
+                    ecc_strength = args.ecc_strength
+                elif (onfi_param is not None and
+                        onfi_param.ecc_correctability_bits not in (0, 0xff)):
+                    # The parameter page specifies correctability per 512 bytes.
+                    ecc_strength = -(-onfi_param.ecc_correctability_bits * ecc_step // 512)
+                else:
+                    self.logger.error("configure the ECC strength explicitly via "
+                                      "--ecc-strength")
+                    return
+                ecc_code = BCHCode(ecc_step, ecc_strength)
+            if args.ecc is not None:
+                if page_size % ecc_code.step_size != 0:
+                    self.logger.error("page size is not a multiple of ECC step size")
+                    return
+                ecc_size = page_size // ecc_code.step_size * ecc_code.ecc_size
+                if args.ecc_offset is not None:
+                    ecc_offset = args.ecc_offset
+                else:
+                    ecc_offset = spare_size - ecc_size
+                if ecc_offset < 0 or ecc_offset + ecc_size > spare_size:
+                    self.logger.error("ECCs (%d bytes) do not fit into spare area", ecc_size)
+                    return
+                self.logger.info("correcting data using %r with ECCs at spare offset %d",
+                                 ecc_code, ecc_offset)
+                ecc_pipeline = _ECCPipeline(ECCLayout(ecc_code, page_size, ecc_offset))
+
+            def write_pages(pages):
+                if args.spare_file:
+                    args.data_file.write(b"".join(page[:page_size] for page in pages))
+                    args.spare_file.write(b"".join(page[page_size:] for page in pages))
+                else:
+                    args.data_file.write(b"".join(pages))
+
+            async def output_pages(row, pages):
+                if ecc_pipeline is None:
+                    write_pages(pages)
+                else:
+                    ecc_pipeline.submit(row, pages)
+                    async for row, pages in ecc_pipeline.collect():
+                        write_pages(pages)
+
+            async def flush_pages():
+                if ecc_pipeline is None:
+                    return
+                async for row, pages in ecc_pipeline.collect(wait=True):
+                    write_pages(pages)
+                ecc_pipeline.close()
+
+                for row in ecc_pipeline.failed:
+                    self.logger.error("uncorrectable errors in page (row) %d", row)
+                self.logger.info("bit flips per page: %s",
+                                 ", ".join("{}: {} pages".format(flips, pages)
+                                           for flips, pages in
+                                           sorted(ecc_pipeline.histogram.items())))
 
         if args.operation == "read":
-            row   = args.start_page
-            count = args.count
-            while count > 0:
+            pages = []
+            async for row, chunk in onfi_iface.read_pages(row=args.start_page, count=args.count,
+                                                          length=page_size + spare_size,
+                                                          block_size=block_size):
                 self.logger.info("reading page (row) %d", row)
-                chunk = await onfi_iface.read(column=0, row=row, length=page_size + spare_size)
+                pages.append(chunk)
+                if (row + 1) % block_size == 0 or row + 1 == args.start_page + args.count:
+                    await output_pages(row + 1 - len(pages), pages)
+                    pages = []
+            await flush_pages()
+
+        if args.operation == "dump":
+            if args.block_count is not None:
+                block_count = args.block_count
+            elif onfi_param is not None:
+                block_count = onfi_param.luns_per_target * onfi_param.blocks_per_lun
+            else:
+                self.logger.error("configure the block count explicitly via --block-count")
+                return
 
-                if args.spare_file:
-                    args.data_file.write(chunk[:page_size])
-                    args.data_file.flush()
-                    args.spare_file.write(chunk[-spare_size:])
-                    args.spare_file.flush()
+            cache = (args.cache and onfi_param is not None and
+                     onfi_param.opt_commands.read_cache)
+            if cache:
+                self.logger.info("using Read Cache commands")
+
+            # Collect every block in memory before writing it out, both to check its bad block
+            # markers and to write the files in large chunks.
+            pages      = []
+            bad_blocks = []
+            begin = time.time()
+            async for row, chunk in onfi_iface.read_pages(row=0, count=block_count * block_size,
+                                                          length=page_size + spare_size,
+                                                          block_size=block_size, cache=cache):
+                pages.append(chunk)
+                if len(pages) < block_size:
+                    continue
+
+                block = row // block_size
+                if spare_size > 0 and (pages[0][page_size] != 0xff or
+                                       pages[-1][page_size] != 0xff):
+                    self.logger.warning("block %d is marked as bad", block)
+                    bad_blocks.append(block)
+                    if args.bad_block_map:
+                        args.bad_block_map.write("{}\n".format(block))
+                    skip = args.skip_bad_blocks
                 else:
-                    args.data_file.write(chunk)
-                    args.data_file.flush()
+                    self.logger.info("read block %d", block)
+                    skip = False
 
-                row   += 1
-                count -= 1
+                if not skip:
+                    await output_pages(block * block_size, pages)
+                pages = []
+            await flush_pages()
+            end = time.time()
+
+            size = block_count * block_size * (page_size + spare_size)
+            self.logger.info("read %d blocks (%d bad) in %.3f s (%.2f MB/s)",
+                             block_count, len(bad_blocks), end - begin,
+                             size / (end - begin) / 1e6)
 
         if args.operation == "program":
-            row   = args.start_page
-            count = args.count
-            while count > 0:
+            cache = (args.cache and onfi_param is not None and
+                     onfi_param.opt_commands.page_cache_program)
+            if cache:
+                self.logger.info("using Page Cache Program command")
+
+            def page_index(chip, row):
+                return chips.index(chip) * args.count + row - args.start_page
+
+            # Pages are not programmed in file order when interleaving, so seek as necessary,
+            # but avoid seeking otherwise so that the files may be pipes. Offsets are relative
+            # to the initial position in the file.
+            rounds = list(rounds)
+            files  = [file for file in (args.data_file, args.spare_file) if file is not None]
+            order  = [page_index(chip, row + index)
+                      for segments in rounds
+                      for chip, row, count in segments
+                      for index in range(count)]
+            if order != sorted(order) and not all(file.seekable() for file in files):
+                self.logger.error("cannot program several chips or LUNs at once from a pipe")
+                return
+
+            bases   = {file: file.tell() if file.seekable() else 0 for file in files}
+            offsets = {file: 0 for file in files}
+            def read_file(file, offset, length):
+                if offsets[file] != offset:
+                    file.seek(bases[file] + offset)
+                offsets[file] = offset + length
+                return file.read(length)
+
+            def read_page(chip, row):
+                index = page_index(chip, row)
                 if args.spare_file:
-                    data   = args.data_file.read(page_size)
-                    spare  = args.spare_file.read(spare_size)
-                    chunks = [(0, data), (page_size, spare)]
+                    data  = read_file(args.data_file,  index * page_size,  page_size)
+                    spare = read_file(args.spare_file, index * spare_size, spare_size)
+                    return [(0, data), (page_size, spare)]
                 else:
-                    chunk  = args.data_file.read(page_size + spare_size)
-                    chunks = [(0, chunk)]
-
-                self.logger.info("programming page (row) %d", row)
-                if not await onfi_iface.program(row=row, chunks=chunks):
+                    chunk = read_file(args.data_file, index * (page_size + spare_size),
+                                      page_size + spare_size)
+                    return [(0, chunk)]
+
+            begin = time.time()
+            for segments in rounds:
+                units = []
+                for chip, row, count in segments:
+                    self.logger.info("programming pages (rows) %d..%d on chip %d",
+                                     row, row + count - 1, chip + 1)
+                    units.append((chip, row, [read_page(chip, row + index)
+                                              for index in range(count)]))
+                for row in await onfi_iface.program_blocks(units, cache=cache):
                     self.logger.error("failed to program page (row) %d", row)
+            end = time.time()
 
-                row   += 1
-                count -= 1
+            size = len(chips) * args.count * (page_size + spare_size)
+            self.logger.info("programmed %d pages in %.3f s (%.2f MB/s)",
+                             len(chips) * args.count, end - begin, size / (end - begin) / 1e6)
 
         if args.operation == "erase":
-            row   = args.start_page
-            count = args.count
-            while count > 0:
-                self.logger.info("erasing block %d (row %d)", row // block_size, row)
-                if not await onfi_iface.erase(row=row):
+            for segments in rounds:
+                units = []
+                for chip, row, count in segments:
+                    self.logger.info("erasing block %d (row %d) on chip %d",
+                                     row // block_size, row, chip + 1)
+                    units.append((chip, row))
+                for row in await onfi_iface.erase_blocks(units):
                     self.logger.error("failed to erase block %d (row %d)", row // block_size, row)
 
-                row   += block_size
-                count -= block_size
-
 # -------------------------------------------------------------------------------------------------
 
 class MemoryONFIAppletTestCase(GlasgowAppletTestCase, applet=MemoryONFIApplet):
@@ -1,3 +1,16 @@
+# Bulk operations
+# ---------------
+#
+# Every serial programming instruction is 4 bytes long, and the result of a read instruction is
+# its last byte, so a range of memory is read with a single SPI transfer containing the read
+# instructions for every address in it.
+#
+# A range of memory is written by loading each page with a single SPI write, issuing the write
+# page instruction, and then waiting in gateware for at least the maximum page write time
+# (tWD_FLASH or tWD_EEPROM) instead of polling RDY/BSY, since the target must not be accessed
+# while it writes the page. Nothing is read back, so loading each page is queued right behind
+# the write of the previous one, and the entire range is written without any USB round trips.
+
 import time
 import math
 import struct
@@ -14,6 +27,11 @@ from ... import *
 from . import AVRError
 
 
+# Maximum page write times across the supported devices.
+T_WD_FLASH_US  = 4500
+T_WD_EEPROM_US = 9000
+
+
 class ProgramAVRInterface:
     def __init__(self, interface, logger, addr_dut_reset):
         self.lower   = interface
@@ -114,95 +132,116 @@ class ProgramAVRInterface:
     async def read_calibration_range(self, addresses):
         return bytearray([await self.read_calibration(address) for address in addresses])
 
+    async def _read_range(self, command, addresses):
+        addresses = list(addresses)
+        if not addresses:
+            return bytearray()
+        commands = b"".join(bytes(command(address)) for address in addresses)
+        result = await self.lower.transfer(commands)
+        return bytearray(result[3::4])
+
+    async def _write_range(self, load_command, write_command, delay_us,
+                           address, chunk, page_size):
+        page_mask = page_size - 1
+        for page_address in range(address & ~page_mask, address + len(chunk), page_size):
+            self._log("load and write page at %#06x", page_address)
+            commands = bytearray()
+            for byte_address in range(max(address, page_address),
+                                      min(address + len(chunk), page_address + page_size)):
+                commands += bytes(load_command(byte_address & page_mask,
+                                               chunk[byte_address - address]))
+            commands += bytes(write_command(page_address))
+            await self.lower.write(commands)
+            await self.lower.delay_us(delay_us)
+        await self.lower.synchronize()
+
+    @staticmethod
+    def _read_program_memory_command(address):
+        return (0b0010_0000 | (address & 1) << 3,
+                (address >> 9) & 0xff,
+                (address >> 1) & 0xff,
+                0)
+
+    @staticmethod
+    def _load_program_memory_page_command(address, data):
+        return (0b0100_0000 | (address & 1) << 3,
+                (address >> 9) & 0xff,
+                (address >> 1) & 0xff,
+                data)
+
+    @staticmethod
+    def _write_program_memory_page_command(address):
+        return (0b0100_1100,
+                (address >> 9) & 0xff,
+                (address >> 1) & 0xff,
+                0)
+
     async def read_program_memory(self, address):
         self._log("read program memory address %#06x", address)
-        _, _, _, data = await self._command(
-            0b0010_0000 | (address & 1) << 3,
-            (address >> 9) & 0xff,
-            (address >> 1) & 0xff,
-            0)
+        _, _, _, data = await self._command(*self._read_program_memory_command(address))
         return data
 
     async def read_program_memory_range(self, addresses):
-        return bytearray([await self.read_program_memory(address) for address in addresses])
+        self._log("read program memory range")
+        return await self._read_range(self._read_program_memory_command, addresses)
 
     async def load_program_memory_page(self, address, data):
         self._log("load program memory address %#06x data %02x", address, data)
-        await self._command(
-            0b0100_0000 | (address & 1) << 3,
-            (address >> 9) & 0xff,
-            (address >> 1) & 0xff,
-            data)
+        await self._command(*self._load_program_memory_page_command(address, data))
 
     async def write_program_memory_page(self, address):
         self._log("write program memory page at %#06x", address)
-        await self._command(
-            0b0100_1100,
-            (address >> 9) & 0xff,
-            (address >> 1) & 0xff,
-            0)
+        await self._command(*self._write_program_memory_page_command(address))
 
     async def write_program_memory_range(self, address, chunk, page_size):
-        dirty_page = False
-        page_mask  = page_size - 1
+        self._log("write program memory range at %#06x", address)
+        await self._write_range(self._load_program_memory_page_command,
+                                self._write_program_memory_page_command, T_WD_FLASH_US,
+                                address, chunk, page_size)
 
-        for offset, byte in enumerate(chunk):
-            byte_address = address + offset
-            if dirty_page and byte_address % page_size == 0:
-                await self.write_program_memory_page((byte_address - 1) & ~page_mask)
-                while await self.is_busy(): pass
+    @staticmethod
+    def _read_eeprom_command(address):
+        return (0b1010_0000,
+                (address >> 8) & 0x1f,
+                (address >> 0) & 0xff,
+                0)
 
-            await self.load_program_memory_page(byte_address & page_mask, byte)
-            dirty_page = True
+    @staticmethod
+    def _load_eeprom_page_command(address, data):
+        return (0b1100_0001,
+                (address >> 8) & 0xff,
+                (address >> 0) & 0xff,
+                data)
 
-        if dirty_page:
-            await self.write_program_memory_page(byte_address & ~page_mask)
-            while await self.is_busy(): pass
+    @staticmethod
+    def _write_eeprom_page_command(address):
+        return (0b1100_0010,
+                (address >> 8) & 0xff,
+                (address >> 0) & 0xff,
+                0)
 
     async def read_eeprom(self, address):
         self._log("read EEPROM address %#06x", address)
-        _, _, _, data = await self._command(
-            0b1010_0000,
-            (address >> 8) & 0x1f,
-            (address >> 0) & 0xff,
-            0)
+        _, _, _, data = await self._command(*self._read_eeprom_command(address))
         return data
 
     async def read_eeprom_range(self, addresses):
-        return bytearray([await self.read_eeprom(address) for address in addresses])
+        self._log("read EEPROM range")
+        return await self._read_range(self._read_eeprom_command, addresses)
 
     async def load_eeprom_page(self, address, data):
         self._log("load EEPROM address %#06x data %02x", address, data)
-        await self._command(
-            0b1100_0001,
-            (address >> 8) & 0xff,
-            (address >> 0) & 0xff,
-            data)
+        await self._command(*self._load_eeprom_page_command(address, data))
 
     async def write_eeprom_page(self, address):
         self._log("write EEPROM page at %#06x", address)
-        await self._command(
-            0b1100_0010,
-            (address >> 8) & 0xff,
-            (address >> 0) & 0x3f,
-            0)
+        await self._command(*self._write_eeprom_page_command(address))
 
     async def write_eeprom_range(self, address, chunk, page_size):
-        dirty_page = False
-        page_mask  = page_size - 1
-
-        for offset, byte in enumerate(chunk):
-            byte_address = address + offset
-            if dirty_page and byte_address % page_size == 0:
-                await self.write_eeprom_page((byte_address - 1) & ~page_mask)
-                while await self.is_busy(): pass
-
-            await self.load_eeprom_page(byte_address & page_mask, byte)
-            dirty_page = True
-
-        if dirty_page:
-            await self.write_eeprom_page(byte_address & ~page_mask)
-            while await self.is_busy(): pass
+        self._log("write EEPROM range at %#06x", address)
+        await self._write_range(self._load_eeprom_page_command,
+                                self._write_eeprom_page_command, T_WD_EEPROM_US,
+                                address, chunk, page_size)
 
     async def chip_erase(self):
         self._log("chip erase")
@@ -426,7 +465,8 @@ class ProgramAVRSPIApplet(GlasgowApplet, name="program-avr-spi"):
             for address, chunk in data:
                 chunk = bytes(chunk)
                 await avr_iface.write_program_memory_range(address, chunk, device.program_page)
-                written = await avr_iface.read_program_memory_range(range(address, len(chunk)))
+                written = await avr_iface.read_program_memory_range(
+                    range(address, address + len(chunk)))
                 if written != chunk:
                     raise GlasgowAppletError("verification failed at address %#06x: %s != %s" %
                                              (address, written.hex(), chunk.hex()))
@@ -439,7 +479,7 @@ class ProgramAVRSPIApplet(GlasgowApplet, name="program-avr-spi"):
             for address, chunk in data:
                 chunk = bytes(chunk)
                 await avr_iface.write_eeprom_range(address, chunk, device.eeprom_page)
-                written = await avr_iface.read_eeprom_range(range(address, len(chunk)))
+                written = await avr_iface.read_eeprom_range(range(address, address + len(chunk)))
                 if written != chunk:
                     raise GlasgowAppletError("verification failed at address %#06x: %s != %s" %
                                              (address, written.hex(), chunk.hex()))
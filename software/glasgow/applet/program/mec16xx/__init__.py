@@ -5,6 +5,7 @@
 # Document Number: DS00002485A
 # Accession: G00006
 
+import time
 import logging
 import argparse
 import struct
@@ -12,7 +13,7 @@ import struct
 from ....support.aobject import *
 from ....arch.arc import *
 from ....arch.arc.mec16xx import *
-from ...debug.arc import DebugARCApplet
+from ...debug.arc import DebugARCApplet, ARCDebugError
 from ... import *
 
 
@@ -42,9 +43,9 @@ class MEC16xxInterface(aobject):
 
     async def read_firmware_mapped(self, size):
         words = []
-        for offset in range(0, size, 4):
+        for offset in range(0, size, 0x1000):
             self._log("read firmware mapped offset=%05x", offset)
-            words.append(await self.lower.read(offset, space="memory"))
+            words += await self.lower.read_block(offset, min(0x1000, size - offset) // 4)
         return words
 
     async def emergency_flash_erase(self):
@@ -100,49 +101,83 @@ class MEC16xxInterface(aobject):
                                    % (flash_command.bits_repr(omit_zero=True),
                                       flash_status.bits_repr(omit_zero=True)))
 
-    async def read_flash(self, address, count):
-        words = []
-        for offset in range(count):
-            await self._flash_command(mode=Flash_Mode_Read, address=address + offset * 4)
-            data_1 = await self.lower.read(Flash_Data_addr, space="memory")
-            self._log("read Flash_Address=%05x Flash_Data=%08x",
-                      address + offset * 4, data_1)
-
-            # This is hella cursed. In theory, we should be able to just enable Burst in
-            # Flash_Command and do a long series of reads from Flash_Data. However... sometimes
-            # we silently get zeroes back for no discernible reason. I spent like two days trying
-            # to figure out *anything* that correlates with glitches, and could not, so I guess
-            # this works as a workaround. I'm sorry.
-            #
-            # Remarkably, none of this happens during *programming* for some inexplicable reason,
-            # which is why we can just do a simple burst there.
-            await self.lower.write(Flash_Address_addr, address + offset * 4, space="memory")
-            data_2 = await self.lower.read(Flash_Data_addr, space="memory")
-            self._log("read Flash_Address=%05x Flash_Data=%08x",
-                      address + offset * 4, data_2)
+    async def _read_flash_word(self, address):
+        await self._flash_command(mode=Flash_Mode_Read, address=address)
+        data_1 = await self.lower.read(Flash_Data_addr, space="memory")
+        self._log("read Flash_Address=%05x Flash_Data=%08x", address, data_1)
+
+        # This is hella cursed. In theory, we should be able to just enable Burst in
+        # Flash_Command and do a long series of reads from Flash_Data. However... sometimes
+        # we silently get zeroes back for no discernible reason. I spent like two days trying
+        # to figure out *anything* that correlates with glitches, and could not, so I guess
+        # this works as a workaround. I'm sorry.
+        #
+        # Remarkably, none of this happens during *programming* for some inexplicable reason,
+        # which is why we can just do a simple burst there.
+        await self.lower.write(Flash_Address_addr, address, space="memory")
+        data_2 = await self.lower.read(Flash_Data_addr, space="memory")
+        self._log("read Flash_Address=%05x Flash_Data=%08x", address, data_2)
+
+        if data_1 == data_2:
+            data = data_1
+        else:
+            # Third time's the charm.
+            await self.lower.write(Flash_Address_addr, address, space="memory")
+            data_3 = await self.lower.read(Flash_Data_addr, space="memory")
+            self._log("read Flash_Address=%05x Flash_Data=%08x", address, data_3)
+
+            self._logger.warn("read glitch Flash_Address=%05x Flash_Data=%08x/%08x/%08x",
+                              address, data_1, data_2, data_3)
 
             if data_1 == data_2:
                 data = data_1
+            elif data_2 == data_3:
+                data = data_2
+            elif data_1 == data_3:
+                data = data_3
             else:
-                # Third time's the charm.
-                await self.lower.write(Flash_Address_addr, address + offset * 4, space="memory")
-                data_3 = await self.lower.read(Flash_Data_addr, space="memory")
-                self._log("read Flash_Address=%05x Flash_Data=%08x",
-                          address + offset * 4, data_3)
-
-                self._logger.warn("read glitch Flash_Address=%05x Flash_Data=%08x/%08x/%08x",
-                                  address + offset * 4, data_1, data_2, data_3)
-
-                if data_1 == data_2:
-                    data = data_1
-                elif data_2 == data_3:
-                    data = data_2
-                elif data_1 == data_3:
-                    data = data_3
-                else:
-                    raise MEC16xxError("cannot select a read by majority")
+                raise MEC16xxError("cannot select a read by majority")
 
-            words.append(data)
+        return data
+
+    async def read_flash(self, address, count, chunk_size=0x400):
+        # Queue the same sequence as _read_flash_word, except for the Flash_Status polling,
+        # for many words at once; then fall back to _read_flash_word for any word that was not
+        # read back consistently, or if the Flash controller was not ready.
+        flash_command = Flash_Command(Reg_Ctl=1, Flash_Mode=Flash_Mode_Read)
+        words = []
+        for chunk_offset in range(0, count, chunk_size):
+            results = []
+            for offset in range(chunk_offset, min(chunk_offset + chunk_size, count)):
+                word_address = address + offset * 4
+                await self.lower.write(Flash_Command_addr, flash_command.to_int(),
+                                       space="memory", defer=True)
+                await self.lower.write(Flash_Address_addr, word_address,
+                                       space="memory", defer=True)
+                flash_status = await self.lower.read(Flash_Status_addr,
+                                                     space="memory", defer=True)
+                data_1 = await self.lower.read(Flash_Data_addr, space="memory", defer=True)
+                await self.lower.write(Flash_Address_addr, word_address,
+                                       space="memory", defer=True)
+                data_2 = await self.lower.read(Flash_Data_addr, space="memory", defer=True)
+                results.append((word_address, flash_status, data_1, data_2))
+            await self.lower.collect()
+
+            for word_address, flash_status, data_1, data_2 in results:
+                try:
+                    flash_status = Flash_Status.from_int(flash_status.result())
+                    data_1, data_2 = data_1.result(), data_2.result()
+                    ok = (not flash_status.Busy and data_1 == data_2 and
+                          not (flash_status.Busy_Err or flash_status.CMD_Err or
+                               flash_status.Protect_Err))
+                except ARCDebugError:
+                    ok = False
+                if ok:
+                    self._log("read Flash_Address=%05x Flash_Data=%08x", word_address, data_1)
+                    words.append(data_1)
+                else:
+                    self._log("read Flash_Address=%05x failed, retrying", word_address)
+                    words.append(await self._read_flash_word(word_address))
         return words
 
     async def erase_flash(self, address=0b11111 << 19):
@@ -150,9 +185,18 @@ class MEC16xxInterface(aobject):
 
     async def program_flash(self, address, words):
         await self._flash_command(mode=Flash_Mode_Program, address=address, burst=1)
+        results = []
         for offset, data in enumerate(words):
-            await self.lower.write(Flash_Data_addr, data, space="memory")
+            results.append(await self.lower.write(Flash_Data_addr, data,
+                                                  space="memory", defer=True))
             self._log("program Flash_Address=%05x Flash_Data=%08x", address + offset * 4, data)
+        await self.lower.collect()
+        for offset, result in enumerate(results):
+            try:
+                result.result()
+            except ARCDebugError as error:
+                raise MEC16xxError("programming Flash_Address=%05x failed: %s"
+                                   % (address + offset * 4, error))
 
 
 class ProgramMEC16xxApplet(DebugARCApplet, name="program-mec16xx"):
@@ -183,26 +227,62 @@ class ProgramMEC16xxApplet(DebugARCApplet, name="program-mec16xx"):
             "file", metavar="FILE", type=argparse.FileType("wb"),
             help="write EC firmware to FILE")
 
+        p_read_mapped = p_operation.add_parser(
+            "read-mapped", help="read EC firmware as mapped into the CPU address space")
+        p_read_mapped.add_argument(
+            "file", metavar="FILE", type=argparse.FileType("wb"),
+            help="write EC firmware to FILE")
+
+        p_verify = p_operation.add_parser(
+            "verify", help="verify EC firmware")
+        p_verify.add_argument(
+            "file", metavar="FILE", type=argparse.FileType("rb"),
+            help="read EC firmware from FILE")
+
         p_write = p_operation.add_parser(
             "write", help="write EC firmware")
         p_write.add_argument(
             "file", metavar="FILE", type=argparse.FileType("rb"),
             help="read EC firmware from FILE")
 
+    def _log_throughput(self, action, begin, end):
+        self.logger.info("%s %d KiB in %.3f s (%.2f KiB/s)",
+                         action, FIRMWARE_SIZE // 1024, end - begin,
+                         FIRMWARE_SIZE / 1024 / (end - begin))
+
     async def interact(self, device, args, mec_iface):
-        if args.operation == "read":
+        if args.operation in ("read", "verify"):
+            begin = time.time()
             await mec_iface.enable_flash_access(enabled=True)
             words = await mec_iface.read_flash(0, FIRMWARE_SIZE // 4)
             await mec_iface.enable_flash_access(enabled=False)
+            self._log_throughput("read", begin, time.time())
 
+        if args.operation == "read-mapped":
+            begin = time.time()
+            words = await mec_iface.read_firmware_mapped(FIRMWARE_SIZE)
+            self._log_throughput("read", begin, time.time())
+
+        if args.operation in ("read", "read-mapped"):
             for word in words:
                 args.file.write(struct.pack("<L", word))
 
-        if args.operation == "write":
-            words = []
+        if args.operation in ("verify", "write"):
+            gold_words = []
             for _ in range(FIRMWARE_SIZE // 4):
                 word, = struct.unpack("<L", args.file.read(4))
-                words.append(word)
+                gold_words.append(word)
+
+        if args.operation == "verify":
+            for offset, (word, gold_word) in enumerate(zip(words, gold_words)):
+                if word != gold_word:
+                    raise MEC16xxError("verification failed at address %05x: "
+                                       "expected %08x, got %08x"
+                                       % (offset * 4, gold_word, word))
+            self.logger.info("verified successfully")
+
+        if args.operation == "write":
+            words = gold_words
 
             await mec_iface.enable_flash_access(enabled=True)
             await mec_iface.erase_flash()
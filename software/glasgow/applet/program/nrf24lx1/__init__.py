@@ -1,9 +1,21 @@
 # Reference: https://infocenter.nordicsemi.com/pdf/nRF24LE1_PS_v1.6.pdf
 # Accession: G00035
 
+# Queued operations
+# -----------------
+#
+# After every erase or program command, the Flash must not be accessed until the operation
+# completes, which is indicated by both WEN and RDYN being cleared in FSR. Instead of polling
+# FSR from the host, which takes a USB round trip per page, a wait command (that is not used by
+# the SPI master) is interpreted by the gateware in front of the SPI master, which then issues
+# RDSR commands until FSR indicates that the Flash is ready. This way, all pages to be erased or
+# programmed are queued at once, and the host only waits for the last one of them.
+
 import os
 import math
+import time
 import asyncio
+import hashlib
 import logging
 import argparse
 import struct
@@ -13,6 +25,7 @@ from fx2.format import input_data, output_data
 
 from ....support.logging import dump_hex
 from ...interface.spi_master import SPIMasterSubtarget, SPIMasterInterface
+from ...interface.spi_master import CMD_SHIFT, BIT_DATA_OUT, BIT_DATA_IN, BIT_HOLD_SS
 from ... import *
 
 
@@ -50,6 +63,84 @@ FSR_BIT_INFEN   = 0b00001000
 FSR_BIT_RDISMB  = 0b00000100
 
 
+CMD_WAIT_READY  = 0x30
+
+
+class ProgramNRF24Lx1Subtarget(Module):
+    def __init__(self, pads, out_fifo, in_fifo, period_cyc, delay_cyc):
+        spi_out_fifo = Record([("readable", 1), ("re", 1), ("dout", 8)])
+        spi_in_fifo  = Record([("writable", 1), ("we", 1), ("din", 8), ("flush", 1)])
+        self.submodules.spi = SPIMasterSubtarget(
+            pads=pads,
+            out_fifo=spi_out_fifo,
+            in_fifo=spi_in_fifo,
+            period_cyc=period_cyc,
+            delay_cyc=delay_cyc,
+            sck_idle=0,
+            sck_edge="rising",
+            ss_active=0,
+        )
+
+        ###
+
+        # RDSR, issued until the Flash is ready; see above.
+        seq_rom   = Array([CMD_SHIFT|BIT_DATA_OUT|BIT_HOLD_SS, 1, 0,
+                           0x05,
+                           CMD_SHIFT|BIT_DATA_IN, 1, 0])
+        seq_index = Signal(max=len(seq_rom))
+
+        spi_idle = self.spi.fsm.ongoing("RECV-COMMAND")
+        host     = Signal()
+        status   = Signal(8)
+
+        self.comb += [
+            in_fifo.flush.eq(spi_in_fifo.flush),
+            spi_out_fifo.dout.eq(Mux(host, out_fifo.dout, seq_rom[seq_index])),
+        ]
+
+        self.submodules.fsm = FSM(reset_state="HOST")
+        self.fsm.act("HOST",
+            host.eq(1),
+            If(spi_idle & out_fifo.readable & (out_fifo.dout == CMD_WAIT_READY),
+                out_fifo.re.eq(1),
+                NextValue(seq_index, 0),
+                NextState("POLL")
+            ).Else(
+                spi_out_fifo.readable.eq(out_fifo.readable),
+                out_fifo.re.eq(spi_out_fifo.re),
+            ),
+            spi_in_fifo.writable.eq(in_fifo.writable),
+            in_fifo.we.eq(spi_in_fifo.we),
+            in_fifo.din.eq(spi_in_fifo.din),
+        )
+        self.fsm.act("POLL",
+            spi_out_fifo.readable.eq(1),
+            If(spi_out_fifo.re,
+                NextValue(seq_index, seq_index + 1),
+                If(seq_index == len(seq_rom) - 1,
+                    NextState("POLL-WAIT")
+                )
+            )
+        )
+        self.fsm.act("POLL-WAIT",
+            spi_in_fifo.writable.eq(1),
+            If(spi_in_fifo.we,
+                NextValue(status, spi_in_fifo.din),
+                NextState("POLL-CHECK")
+            )
+        )
+        self.fsm.act("POLL-CHECK",
+            If(spi_idle,
+                If((status & (FSR_BIT_WEN|FSR_BIT_RDYN)) == 0,
+                    NextState("HOST")
+                ).Else(
+                    NextValue(seq_index, 0),
+                    NextState("POLL")
+                )
+            )
+        )
+
+
 class ProgramNRF24Lx1Interface:
     def __init__(self, interface, logger, device, addr_dut_prog, addr_dut_reset):
         self.lower   = interface
@@ -99,9 +190,14 @@ class ProgramNRF24Lx1Interface:
         self._log("write status=%s", "{:#010b}".format(status))
         await self._command(0x01, arg=[status])
 
+    async def _queue_wait_status(self):
+        self._log("queue wait status")
+        await self.lower.lower.write([CMD_WAIT_READY])
+
     async def wait_status(self):
         self._log("wait status")
-        while await self.read_status() & FSR_BIT_WEN: pass
+        await self._queue_wait_status()
+        await self.lower.synchronize()
 
     async def write_enable(self):
         self._log("write enable")
@@ -119,10 +215,33 @@ class ProgramNRF24Lx1Interface:
         self._log("program address=%#06x length=%#06x", address, len(data))
         await self._command(0x02, arg=struct.pack(">H", address) + bytes(data))
 
+    async def program_pages(self, address, data, buffer_size):
+        """
+        Program ``data`` at ``address``, ``buffer_size`` bytes at a time, waiting for each of
+        the program commands to complete in gateware.
+        """
+        self._log("program pages address=%#06x length=%#06x", address, len(data))
+        for offset in range(0, len(data), buffer_size):
+            await self.write_enable()
+            await self.program(address + offset, data[offset:offset + buffer_size])
+            await self._queue_wait_status()
+        await self.lower.synchronize()
+
     async def erase_page(self, page):
         self._log("erase page=%#04x", page)
         await self._command(0x52, arg=[page])
 
+    async def erase_pages(self, pages):
+        """
+        Erase each of ``pages``, waiting for each of the erase commands to complete in gateware.
+        """
+        self._log("erase pages=<%s>", " ".join("{:#04x}".format(page) for page in pages))
+        for page in pages:
+            await self.write_enable()
+            await self.erase_page(page)
+            await self._queue_wait_status()
+        await self.lower.synchronize()
+
     async def erase_all(self):
         self._log("erase all")
         await self._command(0x62)
@@ -146,6 +265,11 @@ class ProgramNRF24Lx1Applet(GlasgowApplet, name="program-nrf24lx1"):
     help = "program nRF24LE1 and nRF24LU1+ RF microcontrollers"
     description = """
     Program the non-volatile memory of nRF24LE1 and nRF24LU1+ microcontrollers.
+
+    Erase and program commands are queued, and the gateware waits for each of them to complete,
+    so that programming is not limited by USB round trips. The `verify` operation (or
+    `program --verify`) reads back the memory areas present in the firmware file, and compares
+    their SHA-256 digests with those of the firmware file.
     """
 
     __pins = ("prog", "sck", "mosi", "miso", "ss", "reset")
@@ -173,22 +297,19 @@ class ProgramNRF24Lx1Applet(GlasgowApplet, name="program-nrf24lx1"):
         self.mux_interface = iface = target.multiplexer.claim_interface(self, args)
         pads = iface.get_pads(args, pins=self.__pins)
 
-        subtarget = iface.add_subtarget(SPIMasterSubtarget(
+        subtarget = iface.add_subtarget(ProgramNRF24Lx1Subtarget(
             pads=pads,
             out_fifo=iface.get_out_fifo(),
             in_fifo=iface.get_in_fifo(auto_flush=True),
             period_cyc=math.ceil(target.sys_clk_freq / (args.frequency * 1000)),
             delay_cyc=math.ceil(target.sys_clk_freq / 1e6),
-            sck_idle=0,
-            sck_edge="rising",
-            ss_active=0,
         ))
         subtarget.comb += [
             pads.prog_t.o.eq(dut_prog),
             pads.prog_t.oe.eq(1),
             pads.reset_t.o.eq(~dut_reset),
             pads.reset_t.oe.eq(1),
-            subtarget.bus.oe.eq(dut_prog),
+            subtarget.spi.bus.oe.eq(dut_prog),
         ]
 
         return subtarget
@@ -224,6 +345,18 @@ class ProgramNRF24Lx1Applet(GlasgowApplet, name="program-nrf24lx1"):
         p_program.add_argument(
             "--info-page", default=False, action="store_true",
             help="erase and program info page, if present in firmware file (DANGEROUS)")
+        p_program.add_argument(
+            "-V", "--verify", default=False, action="store_true",
+            help="verify MCU memory contents after programming")
+
+        p_verify = p_operation.add_parser(
+            "verify", help="verify MCU memory contents")
+        p_verify.add_argument(
+            "file", metavar="HEX-FILE", type=argparse.FileType("rb"),
+            help="firmware file to compare with (in Intel HEX format)")
+        p_verify.add_argument(
+            "--info-page", default=False, action="store_true",
+            help="verify info page, if present in firmware file")
 
         p_erase = p_operation.add_parser(
             "erase", help="erase MCU memory contents")
@@ -282,14 +415,10 @@ class ProgramNRF24Lx1Applet(GlasgowApplet, name="program-nrf24lx1"):
                     chunks.append((memory_area.mem_addr, area_data))
                 output_data(args.file, chunks, fmt="ihex")
 
-            if args.operation == "program":
-                await check_read_protected()
-
+            def map_chunks(chunks):
                 area_index   = 0
                 memory_area  = memory_map[area_index]
-                erased_pages = set()
-                for chunk_mem_addr, chunk_data in sorted(input_data(args.file, fmt="ihex"),
-                                                         key=lambda c: c[0]):
+                for chunk_mem_addr, chunk_data in sorted(chunks, key=lambda c: c[0]):
                     if len(chunk_data) == 0:
                         continue
                     if chunk_mem_addr < memory_area.mem_addr:
@@ -297,13 +426,60 @@ class ProgramNRF24Lx1Applet(GlasgowApplet, name="program-nrf24lx1"):
                                                  .format(chunk_mem_addr))
                     while chunk_mem_addr >= memory_area.mem_addr + memory_area.size:
                         area_index += 1
-                        if area_index >= len(memory_area):
+                        if area_index >= len(memory_map):
                             raise ProgramNRF24Lx1Error("data outside of memory map at {:#06x}"
                                                      .format(chunk_mem_addr))
                         memory_area = memory_map[area_index]
                     if chunk_mem_addr + len(chunk_data) > memory_area.mem_addr + memory_area.size:
                         raise ProgramNRF24Lx1Error("data outside of memory map at {:#06x}"
                                                  .format(memory_area.mem_addr + memory_area.size))
+                    yield memory_area, chunk_mem_addr, chunk_data
+
+            async def verify_chunks(chunks):
+                for memory_area in memory_map:
+                    area_chunks = [(chunk_mem_addr, chunk_data)
+                                   for chunk_area, chunk_mem_addr, chunk_data in chunks
+                                   if chunk_area is memory_area]
+                    if not area_chunks:
+                        continue
+                    if memory_area.spi_addr & 0x10000:
+                        await nrf24lx1_iface.write_status(FSR_BIT_INFEN)
+                    else:
+                        await nrf24lx1_iface.write_status(0)
+
+                    # Read everything between the first and the last chunk at once.
+                    first_addr = area_chunks[0][0]
+                    last_addr  = area_chunks[-1][0] + len(area_chunks[-1][1])
+                    area_data  = await nrf24lx1_iface.read(
+                        (first_addr - memory_area.mem_addr + memory_area.spi_addr) & 0xffff,
+                        last_addr - first_addr)
+
+                    gold_digest = hashlib.sha256()
+                    area_digest = hashlib.sha256()
+                    for chunk_mem_addr, chunk_data in area_chunks:
+                        offset = chunk_mem_addr - first_addr
+                        gold_digest.update(chunk_data)
+                        area_digest.update(area_data[offset:offset + len(chunk_data)])
+                    if area_digest.digest() != gold_digest.digest():
+                        for chunk_mem_addr, chunk_data in area_chunks:
+                            offset = chunk_mem_addr - first_addr
+                            for index, byte in enumerate(chunk_data):
+                                if area_data[offset + index] != byte:
+                                    raise ProgramNRF24Lx1Error(
+                                        "verification failed at {:#06x}: expected {:02x}, "
+                                        "got {:02x}".format(chunk_mem_addr + index, byte,
+                                                            area_data[offset + index]))
+                    self.logger.info("verified %s memory (SHA-256 %s)",
+                                     memory_area.name, gold_digest.hexdigest())
+
+            if args.operation == "program":
+                await check_read_protected()
+
+                begin        = time.time()
+                erased_pages = set()
+                programmed   = []
+                for memory_area, chunk_mem_addr, chunk_data in \
+                        map_chunks(input_data(args.file, fmt="ihex")):
                     if memory_area.spi_addr & 0x10000 and not args.info_page:
                         self.logger.warn("data provided for info page, but info page programming "
                                          "is not enabled")
@@ -322,25 +498,37 @@ class ProgramNRF24Lx1Applet(GlasgowApplet, name="program-nrf24lx1"):
                     overwrite_pages = set(range(
                         (chunk_spi_addr // page_size),
                         (chunk_spi_addr + len(chunk_data) + page_size - 1) // page_size))
-                    need_erase_pages = overwrite_pages - erased_pages
+                    need_erase_pages = sorted(overwrite_pages - erased_pages)
                     if need_erase_pages:
                         for page in need_erase_pages:
                             page_addr = (memory_area.spi_addr & 0x10000) | (page * page_size)
                             self.logger.log(level, "erasing %s memory at %#06x+%#06x",
                                             memory_area.name, page_addr, page_size)
-                            await nrf24lx1_iface.write_enable()
-                            await nrf24lx1_iface.erase_page(page)
-                            await nrf24lx1_iface.wait_status()
+                        await nrf24lx1_iface.erase_pages(need_erase_pages)
                         erased_pages.update(need_erase_pages)
 
                     self.logger.log(level, "programming %s memory at %#06x+%#06x",
                                     memory_area.name, chunk_mem_addr, len(chunk_data))
-                    while len(chunk_data) > 0:
-                        await nrf24lx1_iface.write_enable()
-                        await nrf24lx1_iface.program(chunk_spi_addr, chunk_data[:buffer_size])
-                        await nrf24lx1_iface.wait_status()
-                        chunk_data  = chunk_data[buffer_size:]
-                        chunk_spi_addr += buffer_size
+                    await nrf24lx1_iface.program_pages(chunk_spi_addr, chunk_data, buffer_size)
+                    programmed.append((memory_area, chunk_mem_addr, chunk_data))
+
+                length = sum(len(chunk_data) for _, _, chunk_data in programmed)
+                self.logger.info("programmed %d bytes in %.3f s",
+                                 length, time.time() - begin)
+
+                if args.verify:
+                    await verify_chunks(programmed)
+
+            if args.operation == "verify":
+                await check_read_protected()
+
+                chunks = []
+                for memory_area, chunk_mem_addr, chunk_data in \
+                        map_chunks(input_data(args.file, fmt="ihex")):
+                    if memory_area.spi_addr & 0x10000 and not args.info_page:
+                        continue
+                    chunks.append((memory_area, chunk_mem_addr, chunk_data))
+                await verify_chunks(chunks)
 
             if args.operation == "erase":
                 if args.info_page:
@@ -395,7 +583,117 @@ class ProgramNRF24Lx1Applet(GlasgowApplet, name="program-nrf24lx1"):
 
 # -------------------------------------------------------------------------------------------------
 
+class ProgramNRF24Lx1TestTarget(Module):
+    """
+    An nRF24Lx1 Flash that implements the RDSR, READ and PROGRAM commands on ``size`` bytes of
+    memory, ignoring the high address byte. RDSR returns consecutive entries of ``busy_fsr``
+    as FSR, and then 0.
+    """
+    def __init__(self, pads, busy_fsr, size=64):
+        self.rdsr_count = Signal(8)
+
+        ###
+
+        self.specials.mem  = Memory(width=8, depth=size)
+        self.specials.port = port = self.mem.get_port(write_capable=True, async_read=True)
+
+        fsr = Array(busy_fsr + [0])
+
+        sck_r   = Signal()
+        rising  = Signal()
+        falling = Signal()
+        self.sync += sck_r.eq(pads.sck_t.o)
+        self.comb += [
+            rising.eq(~pads.ss_t.o & ~sck_r & pads.sck_t.o),
+            falling.eq(~pads.ss_t.o & sck_r & ~pads.sck_t.o),
+        ]
+
+        bitno   = Signal(3)
+        byteno  = Signal(2)
+        cmd     = Signal(8)
+        shreg_i = Signal(8)
+        data_i  = Signal(8)
+        shreg_o = Signal(8)
+        self.comb += [
+            data_i.eq(Cat(pads.mosi_t.o, shreg_i[:7])),
+            pads.miso_t.i.eq(shreg_o[7]),
+            port.dat_w.eq(data_i),
+            port.we.eq(rising & (bitno == 7) & (byteno == 3) & (cmd == 0x02)),
+        ]
+        self.sync += [
+            If(pads.ss_t.o,
+                bitno.eq(0),
+                byteno.eq(0),
+                shreg_o.eq(0),
+            ).Elif(rising,
+                shreg_i.eq(data_i),
+                bitno.eq(bitno + 1),
+                If(bitno == 7,
+                    If(byteno == 0,
+                        cmd.eq(data_i),
+                        If(data_i == 0x05,
+                            self.rdsr_count.eq(self.rdsr_count + 1)
+                        )
+                    ),
+                    If(byteno == 2,
+                        port.adr.eq(data_i)
+                    ),
+                    If(byteno == 3,
+                        port.adr.eq(port.adr + 1)
+                    ).Else(
+                        byteno.eq(byteno + 1)
+                    )
+                )
+            ).Elif(falling,
+                If(bitno == 0,
+                    If(cmd == 0x05,
+                        shreg_o.eq(fsr[Mux(self.rdsr_count > len(busy_fsr),
+                                           len(busy_fsr), self.rdsr_count - 1)])
+                    ).Elif((cmd == 0x03) & (byteno == 3),
+                        shreg_o.eq(port.dat_r)
+                    ).Else(
+                        shreg_o.eq(0)
+                    )
+                ).Else(
+                    shreg_o.eq(shreg_o << 1)
+                )
+            )
+        ]
+
+
 class ProgramNRF24Lx1AppletTestCase(GlasgowAppletTestCase, applet=ProgramNRF24Lx1Applet):
     @synthesis_test
     def test_build(self):
         self.assertBuilds()
+
+    def setup_target(self):
+        self.build_simulated_applet()
+        mux_iface = self.applet.mux_interface
+        mux_iface.submodules.target = ProgramNRF24Lx1TestTarget(mux_iface.pads,
+            busy_fsr=[FSR_BIT_WEN|FSR_BIT_RDYN, FSR_BIT_WEN, FSR_BIT_RDYN])
+
+    @applet_simulation_test("setup_target")
+    @asyncio.coroutine
+    def test_wait_status(self):
+        mux_iface = self.applet.mux_interface
+        nrf24lx1_iface = yield from self.run_simulated_applet()
+
+        # PROGRAM and READ commands of 0x30 bytes each put CMD_WAIT_READY in the length and
+        # data positions of SPI master commands, where it must not be interpreted.
+        data = bytes(range(0x30 - 20, 0x30 + 25))
+        yield from nrf24lx1_iface.program(0x0000, data)
+        self.assertEqual((yield mux_iface.target.rdsr_count), 0)
+
+        # Every RDSR command returns a busy FSR except the last one; none of the statuses
+        # must reach the host, or they would be read instead of the data below.
+        yield from nrf24lx1_iface.wait_status()
+        self.assertEqual((yield mux_iface.target.rdsr_count), 4)
+        self.assertEqual((yield from nrf24lx1_iface.read(0x0000, 0x30)),
+                         data + bytes(3))
+        self.assertEqual((yield from nrf24lx1_iface.read_status()), 0)
+        self.assertEqual((yield mux_iface.target.rdsr_count), 5)
+
+        # Once FSR is ready, waiting issues a single RDSR command.
+        yield from nrf24lx1_iface.wait_status()
+        self.assertEqual((yield mux_iface.target.rdsr_count), 6)
+        self.assertEqual((yield from nrf24lx1_iface.read(0x0010, 4)), data[0x10:0x14])
@@ -6,10 +6,15 @@
 # conditions. Shifting BYPASS in would activate the normal configuration logic, which can cause
 # failure to program or even a corrupted bitstream (if a bitstream is loaded from memory on top
 # of the one loaded from JTAG).
+#
+# Note: the configuration bitstream is shifted most significant bit of every byte first, while
+# JTAG scans are shifted least significant bit first, so every byte is bit-reversed, one chunk
+# at a time, just before it is shifted. The bitstream is never converted to ``bits``, so loading
+# it is limited by the TCK frequency rather than by the host.
 
+import time
 import logging
 import argparse
-from bitarray import bitarray
 from nmigen.compat import *
 
 from ... import *
@@ -24,6 +29,9 @@ class XC6SJTAGError(GlasgowAppletError):
     pass
 
 
+_BIT_REVERSE = bytes(int("{:08b}".format(byte)[::-1], 2) for byte in range(256))
+
+
 class XC6SJTAGInterface:
     def __init__(self, interface, logger):
         self.lower   = interface
@@ -57,17 +65,17 @@ class XC6SJTAGInterface:
                 return
         raise GlasgowAppletError("configuration reset failed: {}".format(status.bits_repr()))
 
-    async def load_bitstream(self, bitstream, *, byte_reverse=True):
-        if byte_reverse:
-            ba = bitarray()
-            ba.frombytes(bitstream)
-            ba.bytereverse()
-            bitstream = bits(ba.tobytes(), len(ba))
-        else:
-            bitstream = bits(bitstream)
-        self._log("load size=%d [bits]", len(bitstream))
+    async def load_bitstream(self, bitstream, *, byte_reverse=True, chunk_size=0x10000):
+        bitstream = memoryview(bitstream)
+        def chunks():
+            for offset in range(0, len(bitstream), chunk_size):
+                chunk = bitstream[offset:offset + chunk_size]
+                if byte_reverse:
+                    chunk = bytes(chunk).translate(_BIT_REVERSE)
+                yield chunk
+        self._log("load size=%d [bits]", len(bitstream) * 8)
         await self.lower.lower.write_ir(IR_CFG_IN)
-        await self.lower.write_dr(bitstream)
+        await self.lower.write_dr_bytes(chunks())
 
     async def start(self):
         self._log("start")
@@ -86,8 +94,17 @@ class ProgramXC6SApplet(JTAGProbeApplet, name="program-xc6s"):
     preview = True
     description = """
     Program Xilinx Spartan-6 FPGAs via the JTAG interface.
+
+    The TCK frequency defaults to 5 MHz, since configuration time is limited by it; it can be
+    raised with --frequency if the wiring allows.
     """
 
+    @classmethod
+    def add_build_arguments(cls, parser, access):
+        super().add_build_arguments(parser, access)
+
+        parser.set_defaults(frequency=5000)
+
     @classmethod
     def add_run_arguments(cls, parser, access):
         super().add_run_tap_arguments(parser, access)
@@ -111,6 +128,12 @@ class ProgramXC6SApplet(JTAGProbeApplet, name="program-xc6s"):
 
         if args.bit_file:
             self.logger.info("configuring from %r", args.bit_file.name)
+            bitstream = args.bit_file.read()
             await xc6s_iface.reconfigure()
-            await xc6s_iface.load_bitstream(args.bit_file.read())
+            begin = time.time()
+            await xc6s_iface.load_bitstream(bitstream)
             await xc6s_iface.start()
+            end = time.time()
+            self.logger.info("configured %d KiB in %.3f s (%.2f Mbit/s)",
+                             len(bitstream) // 1024, end - begin,
+                             len(bitstream) * 8 / (end - begin) / 1e6)
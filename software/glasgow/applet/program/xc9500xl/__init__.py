@@ -214,6 +214,17 @@
 # The FPGMI instruction works similarly to FVFYI, but it looks like the counter is only set
 # by FPGM in a way that it is reused by FPGMI once FPGM DR is updated once with the strobe bit
 # set.
+#
+# None of the ISC operations need the captured data to decide what to shift next, so all scans
+# for a whole operation are queued as deferred scans and their results are collected at once.
+# When FVFYI captures a word that is not valid, the address counter does not advance; so after
+# collecting, only the valid words are kept, and reads are queued again for the remaining ones.
+#
+# Several identical devices on one chain can be operated on at once through a MultiTAPInterface.
+# Every scan is then broadcast to all of them, and every captured value is split into a list with
+# an entry per device; each device is checked separately. Once a device has captured all valid
+# words it needs, its excess FVFYI reads are discarded. Blocks that fail to program are retried
+# on the failing device alone.
 
 import struct
 import logging
@@ -224,7 +235,7 @@ from ....arch.jtag import *
 from ....arch.xilinx.xc9500xl import *
 from ....support.logging import *
 from ....database.xilinx.xc9500xl import *
-from ...interface.jtag_probe import JTAGProbeApplet
+from ...interface.jtag_probe import JTAGProbeApplet, MultiTAPInterface
 from ....protocol.jesd3 import *
 from ... import *
 
@@ -274,16 +285,27 @@ class XC9500XLInterface:
         self._logger = logger
         self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
         self._frequency = frequency
+        self.multi   = isinstance(interface, MultiTAPInterface)
 
     def _log(self, message, *args):
         self._logger.log(self._level, "XC9500XL: " + message, *args)
 
+    def _each(self, result):
+        return result if self.multi else [result]
+
     async def identify(self):
         await self.lower.test_reset()
-        idcode_bits = await self.lower.read_dr(32)
-        idcode = DR_IDCODE.from_bits(idcode_bits)
-        self._log("read idcode mfg-id=%03x part-id=%04x",
-                  idcode.mfg_id, idcode.part_id)
+        idcodes = []
+        for idcode_bits in self._each(await self.lower.read_dr(32)):
+            idcode = DR_IDCODE.from_bits(idcode_bits)
+            self._log("read idcode mfg-id=%03x part-id=%04x",
+                      idcode.mfg_id, idcode.part_id)
+            idcodes.append(idcode)
+        idcode = idcodes[0]
+        if any((other.mfg_id, other.part_id) != (idcode.mfg_id, idcode.part_id)
+               for other in idcodes):
+            raise XC9500XLError("selected TAPs have different IDCODEs: %s"
+                                % ", ".join("%#010x" % other.to_int() for other in idcodes))
         device = devices_by_idcode[idcode.mfg_id, idcode.part_id]
         if device is None:
             xc95xx_iface = None
@@ -293,9 +315,11 @@ class XC9500XLInterface:
 
     async def read_usercode(self):
         await self.lower.write_ir(IR_USERCODE)
-        usercode_bits = await self.lower.read_dr(32)
-        self._log("read usercode <%s>", dump_bin(usercode_bits))
-        return bytes(usercode_bits)[::-1]
+        usercodes = []
+        for usercode_bits in self._each(await self.lower.read_dr(32)):
+            self._log("read usercode <%s>", dump_bin(usercode_bits))
+            usercodes.append(bytes(usercode_bits)[::-1])
+        return usercodes if self.multi else usercodes[0]
 
 
 class XC95xxXLInterface:
@@ -305,12 +329,23 @@ class XC95xxXLInterface:
         self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
         self._frequency = frequency
         self.device  = device
+        self.multi   = isinstance(interface, MultiTAPInterface)
+        self.count   = len(interface.taps) if self.multi else 1
         self.DR_ISDATA = DR_ISDATA(device.word_width)
         self.DR_ISCONFIGURATION = DR_ISCONFIGURATION(device.word_width)
 
     def _log(self, message, *args):
         self._logger.log(self._level, "XC95xx: " + message, *args)
 
+    def _each(self, result):
+        return result if self.multi else [result]
+
+    def _where(self, index):
+        return " on TAP #%d" % self.lower.taps[index] if self.multi else ""
+
+    def _format_words(self, words):
+        return " ".join("{:0{}b}".format(word, self.device.word_width) for word in words)
+
     async def programming_enable(self):
         self._log("programming enable")
         await self.lower.write_ir(IR_ISPEN)
@@ -331,49 +366,67 @@ class XC95xxXLInterface:
         isconf = self.DR_ISCONFIGURATION(valid=1, strobe=1, address=dev_address)
         await self.lower.write_dr(isconf.to_bits())
 
-        words = []
+        results = []
         for offset in range(count):
             await self.lower.run_test_idle(1)
 
             dev_address = bitstream_to_device_address(address + offset + 1)
             isconf = self.DR_ISCONFIGURATION(valid=1, strobe=1, address=dev_address)
-            isconf_bits = await self.lower.exchange_dr(isconf.to_bits())
-            isconf = self.DR_ISCONFIGURATION.from_bits(isconf_bits)
-            self._log("read address=%03x prev-data=%s",
-                      dev_address, "{:0{}b}".format(isconf.data, self.device.word_width))
-            words.append(isconf.data)
+            results.append(await self.lower.exchange_dr(isconf.to_bits(), defer=True))
+        await self.lower.collect()
+
+        words = [[] for _ in range(self.count)]
+        for offset, result in enumerate(results):
+            data = [self.DR_ISCONFIGURATION.from_bits(isconf_bits).data
+                    for isconf_bits in self._each(result.result())]
+            self._log("read address=%03x data=%s",
+                      bitstream_to_device_address(address + offset), self._format_words(data))
+            for index, word in enumerate(data):
+                words[index].append(word)
 
         return words
 
     async def _fvfyi(self, count):
         await self.lower.write_ir(IR_FVFYI)
 
-        words = []
-        index = 0
-        while index < count:
-            await self.lower.run_test_idle(1)
-
-            isdata_bits = await self.lower.read_dr(self.DR_ISDATA.bit_length())
-            isdata = self.DR_ISDATA.from_bits(isdata_bits)
-            if isdata.valid:
-                self._log("read autoinc %d data=%s",
-                          index, "{:0{}b}".format(isdata.data, self.device.word_width))
-                words.append(isdata.data)
-                index += 1
-            else:
-                self._log("read autoinc %d invalid")
+        words = [[] for _ in range(self.count)]
+        while min(map(len, words)) < count:
+            results = []
+            for _ in range(count - min(map(len, words))):
+                await self.lower.run_test_idle(1)
+                results.append(await self.lower.read_dr(self.DR_ISDATA.bit_length(), defer=True))
+            await self.lower.collect()
+
+            for result in results:
+                for index, isdata_bits in enumerate(self._each(result.result())):
+                    if len(words[index]) == count:
+                        continue
+                    isdata = self.DR_ISDATA.from_bits(isdata_bits)
+                    if isdata.valid:
+                        self._log("read autoinc %d data=%s%s",
+                                  len(words[index]), self._format_words([isdata.data]),
+                                  self._where(index))
+                        words[index].append(isdata.data)
+                    else:
+                        self._log("read autoinc %d invalid%s",
+                                  len(words[index]), self._where(index))
 
         return words
 
     async def read(self, address, count, fast=True):
+        """
+        Read ``count`` words starting at ``address``. Returns a list of words, or, for
+        a multi-TAP interface, a list with a list of words for every device.
+        """
         if fast:
             # Use FVFY just to set the address counter.
             await self._fvfy(address, 0)
             # Use FVFYI for much faster reads.
-            return await self._fvfyi(count)
+            words = await self._fvfyi(count)
         else:
             # Use FVFY for all reads.
-            return await self._fvfy(address, count)
+            words = await self._fvfy(address, count)
+        return words if self.multi else words[0]
 
     async def bulk_erase(self):
         self._log("bulk erase")
@@ -384,9 +437,11 @@ class XC95xxXLInterface:
         await self.lower.run_test_idle(200_000)
 
         isaddr_bits = await self.lower.read_dr(DR_ISADDRESS.bit_length())
-        isaddr = DR_ISADDRESS.from_bits(isaddr_bits)
-        if not (isaddr.valid and not isaddr.strobe):
-            raise XC9500XLError("bulk erase failed %s" % isaddr.bits_repr())
+        for index, isaddr_bits in enumerate(self._each(isaddr_bits)):
+            isaddr = DR_ISADDRESS.from_bits(isaddr_bits)
+            if not (isaddr.valid and not isaddr.strobe):
+                raise XC9500XLError("bulk erase failed%s %s"
+                                    % (self._where(index), isaddr.bits_repr()))
 
     async def override_erase(self):
         self._log("override erase")
@@ -397,13 +452,16 @@ class XC95xxXLInterface:
         await self.lower.run_test_idle(200_000)
 
         isaddr_bits = await self.lower.read_dr(DR_ISADDRESS.bit_length())
-        isaddr = DR_ISADDRESS.from_bits(isaddr_bits)
-        if not (isaddr.valid and not isaddr.strobe):
-            raise XC9500XLError("override erase failed %s" % isaddr.bits_repr())
+        for index, isaddr_bits in enumerate(self._each(isaddr_bits)):
+            isaddr = DR_ISADDRESS.from_bits(isaddr_bits)
+            if not (isaddr.valid and not isaddr.strobe):
+                raise XC9500XLError("override erase failed%s %s"
+                                    % (self._where(index), isaddr.bits_repr()))
 
     async def _fpgm(self, address, words):
         await self.lower.write_ir(IR_FPGM)
 
+        results = []
         for offset, word in enumerate(words):
             dev_address = bitstream_to_device_address(address + offset)
             self._log("program address=%03x data=%s",
@@ -419,20 +477,30 @@ class XC95xxXLInterface:
                 await self.lower.run_test_idle(20_000)
 
                 isconf = self.DR_ISCONFIGURATION(address=dev_address)
-                isconf_bits = await self.lower.exchange_dr(isconf.to_bits())
-                isconf = self.DR_ISCONFIGURATION.from_bits(isconf_bits)
-                if not (isconf.valid and not isconf.strobe):
-                    self._logger.warn("program failed address=%03x %s",
-                                      offset, isconf.bits_repr())
+                results.append((offset - BLOCK_WORDS + 1,
+                                await self.lower.exchange_dr(isconf.to_bits(), defer=True)))
 
         if not words:
             dev_address = bitstream_to_device_address(address)
             isconf = self.DR_ISCONFIGURATION(valid=1, address=dev_address)
             await self.lower.write_dr(isconf.to_bits())
+        await self.lower.collect()
+
+        failed = [[] for _ in range(self.count)]
+        for offset, result in results:
+            for index, isconf_bits in enumerate(self._each(result.result())):
+                isconf = self.DR_ISCONFIGURATION.from_bits(isconf_bits)
+                if not (isconf.valid and not isconf.strobe):
+                    self._log("program failed address=%03x %s%s",
+                              bitstream_to_device_address(address + offset), isconf.bits_repr(),
+                              self._where(index))
+                    failed[index].append(offset)
+        return failed
 
     async def _fpgmi(self, words):
         await self.lower.write_ir(IR_FPGMI)
 
+        results = []
         for offset, word in enumerate(words):
             self._log("program autoinc data=%s",
                       "{:0{}b}".format(word, self.device.word_width))
@@ -446,23 +514,48 @@ class XC95xxXLInterface:
                 await self.lower.run_test_idle(20_000)
 
                 isdata = self.DR_ISDATA()
-                isdata_bits = await self.lower.exchange_dr(isdata.to_bits())
+                results.append((offset - BLOCK_WORDS + 1,
+                                await self.lower.exchange_dr(isdata.to_bits(), defer=True)))
+        await self.lower.collect()
+
+        failed = [[] for _ in range(self.count)]
+        for offset, result in results:
+            for index, isdata_bits in enumerate(self._each(result.result())):
                 isdata = self.DR_ISDATA.from_bits(isdata_bits)
                 if not (isdata.valid and not isdata.strobe):
-                    self._logger.warn("program autoinc word %03x failed %s",
-                                      offset, isdata.bits_repr())
+                    self._log("program autoinc word %03x failed %s%s",
+                              offset, isdata.bits_repr(), self._where(index))
+                    failed[index].append(offset)
+        return failed
 
     async def program(self, address, words, fast=True):
         assert address % BLOCK_WORDS == 0 and len(words) % BLOCK_WORDS == 0
 
         if fast:
             # Use FPGM to program first block and set the address counter.
-            await self._fpgm(0, words[:BLOCK_WORDS])
+            failed  = await self._fpgm(address, words[:BLOCK_WORDS])
             # Use FPGMI for much faster following writes.
-            return await self._fpgmi(words[BLOCK_WORDS:])
+            for index, offsets in enumerate(await self._fpgmi(words[BLOCK_WORDS:])):
+                failed[index] += [BLOCK_WORDS + offset for offset in offsets]
         else:
             # Use FPGM for all writes.
-            return await self._fpgm(address, words)
+            failed  = await self._fpgm(address, words)
+
+        # Retry the blocks that failed once, addressing each of them explicitly, and only on
+        # the device where they failed.
+        for index, offsets in enumerate(failed):
+            if not offsets:
+                continue
+            if self.multi:
+                xc95xx_iface = XC95xxXLInterface(self.lower.tap(index), self._logger,
+                                                 self._frequency, self.device)
+            else:
+                xc95xx_iface = self
+            for offset in offsets:
+                block = words[offset:offset + BLOCK_WORDS]
+                if (await xc95xx_iface._fpgm(address + offset, block))[0]:
+                    self._logger.warn("program block at word %03x failed%s",
+                                      address + offset, self._where(index))
 
 
 class ProgramXC9500XLApplet(JTAGProbeApplet, name="program-xc9500xl"):
@@ -473,10 +566,14 @@ class ProgramXC9500XLApplet(JTAGProbeApplet, name="program-xc9500xl"):
 
     It is recommended to use TCK frequency between 100 and 250 kHz for programming.
 
+    Several identical CPLDs on the same chain can be programmed, verified, or erased at once by
+    specifying --tap-index several times.
+
     Some CPLDs in the wild have been observed to return failures during programming, possibly
-    because they are taken from the rejects bin or recycled, see [1]. The "program word failed"
-    messages during programming do not necessarily mean a failed device; if the bitstream verifies
-    afterwards, it is likely to operate correctly.
+    because they are taken from the rejects bin or recycled, see [1]. Blocks that fail to program
+    are retried once; the "program block failed" messages reported for blocks that still fail do
+    not necessarily mean a failed device; if the bitstream verifies afterwards, it is likely to
+    operate correctly.
 
     [1]: http://tech.mattmillman.com/making-use-of-recycled-xilinx-xc9500-cplds/
 
@@ -493,10 +590,10 @@ class ProgramXC9500XLApplet(JTAGProbeApplet, name="program-xc9500xl"):
 
     @classmethod
     def add_run_arguments(cls, parser, access):
-        super().add_run_tap_arguments(parser, access)
+        super().add_run_multi_tap_arguments(parser, access)
 
     async def run(self, device, args):
-        tap_iface = await self.run_tap(ProgramXC9500XLApplet, device, args)
+        tap_iface = await self.run_multi_tap(ProgramXC9500XLApplet, device, args)
         return XC9500XLInterface(tap_iface, self.logger, args.frequency * 1000)
 
     @classmethod
@@ -537,15 +634,21 @@ class ProgramXC9500XLApplet(JTAGProbeApplet, name="program-xc9500xl"):
             raise GlasgowAppletError("cannot operate on unknown device with IDCODE=%#10x"
                                      % idcode.to_int())
         self.logger.info("found %s rev=%d",
-                         idcode.to_int(), xc9500_device.name, idcode.version)
+                         xc9500_device.name, idcode.version)
 
-        usercode = await xc9500_iface.read_usercode()
-        self.logger.info("USERCODE=%s (%s)",
-                         usercode.hex(),
-                         re.sub(rb"[^\x20-\x7e]", b"?", usercode).decode("ascii"))
+        usercodes = await xc9500_iface.read_usercode()
+        if not xc9500_iface.multi:
+            usercodes = [usercodes]
+        for usercode in usercodes:
+            self.logger.info("USERCODE=%s (%s)",
+                             usercode.hex(),
+                             re.sub(rb"[^\x20-\x7e]", b"?", usercode).decode("ascii"))
 
         bytes_per_word = (xc9500_device.word_width + 7) // 8
         try:
+            if args.operation == "read-bit" and xc9500_iface.multi:
+                raise GlasgowAppletError("cannot read bitstream from more than one device")
+
             if args.operation == "read-bit":
                 await xc95xx_iface.programming_enable()
                 for word in await xc95xx_iface.read(0, xc9500_device.bitstream_words,
@@ -570,12 +673,15 @@ class ProgramXC9500XLApplet(JTAGProbeApplet, name="program-xc9500xl"):
 
             if args.operation == "verify-bit":
                 await xc95xx_iface.programming_enable()
-                device_words = await xc95xx_iface.read(0, xc9500_device.bitstream_words,
-                                                       fast=not args.slow)
-                for offset, (device_word, gold_word) in enumerate(zip(device_words, words)):
-                    if device_word != gold_word:
-                        raise GlasgowAppletError("bitstream verification failed at word %03x"
-                                                 % offset)
+                all_device_words = await xc95xx_iface.read(0, xc9500_device.bitstream_words,
+                                                           fast=not args.slow)
+                if not xc95xx_iface.multi:
+                    all_device_words = [all_device_words]
+                for index, device_words in enumerate(all_device_words):
+                    for offset, (device_word, gold_word) in enumerate(zip(device_words, words)):
+                        if device_word != gold_word:
+                            raise GlasgowAppletError("bitstream verification failed at word %03x%s"
+                                                     % (offset, xc95xx_iface._where(index)))
 
             if args.operation == "erase":
                 await xc95xx_iface.programming_enable()
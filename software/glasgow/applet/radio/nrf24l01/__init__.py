@@ -1,17 +1,36 @@
 # Reference: https://infocenter.nordicsemi.com/pdf/nRF24L01P_PS_v1.0.pdf
 # Accession: G00044
 
+# Capture
+# -------
+#
+# When receiving many packets, reading each of them from the host takes several USB round trips,
+# and packets are dropped once the 3-level RX FIFO of the nRF24L01 overflows. To avoid this,
+# in capture mode the gateware takes over the SPI bus, and whenever IRQ is asserted, it clears
+# RX_DR, and then reads payloads until the RX FIFO is empty (RX_P_NO=111 in the STATUS register,
+# which is checked with a NOP command). Clearing RX_DR first ensures that a packet received while
+# the FIFO is being drained asserts IRQ again.
+#
+# Every payload is sent to the host as a record: a 32-bit timestamp in microseconds (captured
+# when IRQ is asserted, little endian), the STATUS register, and the payload itself, which has
+# a fixed length. Captured packets are written to a pcap file without decoding them, and can be
+# decoded afterwards with `glasgow tool radio-nrf24l decode`.
+
 import math
+import time
+import struct
 import asyncio
 import logging
 import argparse
 from nmigen.compat import *
+from nmigen.compat.genlib.cdc import MultiReg
 
 from ....support.logging import *
 from ....support.bits import *
 from ....arch.nrf24l import *
 from ....arch.nrf24l.rf import *
 from ...interface.spi_master import SPIMasterSubtarget, SPIMasterInterface
+from ...interface.spi_master import CMD_SHIFT, BIT_DATA_OUT, BIT_DATA_IN, BIT_HOLD_SS
 from ... import *
 
 
@@ -19,13 +38,161 @@ class RadioNRF24L01Error(GlasgowAppletError):
     pass
 
 
+class RadioNRF24L01Subtarget(Module):
+    def __init__(self, pads, out_fifo, in_fifo, period_cyc, delay_cyc, us_cyc,
+                 capture, payload_width):
+        spi_out_fifo = Record([("readable", 1), ("re", 1), ("dout", 8)])
+        spi_in_fifo  = Record([("writable", 1), ("we", 1), ("din", 8), ("flush", 1)])
+        self.submodules.spi = SPIMasterSubtarget(
+            pads=pads,
+            out_fifo=spi_out_fifo,
+            in_fifo=spi_in_fifo,
+            period_cyc=period_cyc,
+            delay_cyc=delay_cyc,
+            sck_idle=0,
+            sck_edge="rising",
+            ss_active=0,
+        )
+
+        ###
+
+        irq = Signal()
+        self.specials += MultiReg(pads.irq_t.i, irq)
+
+        timer     = Signal(max=us_cyc)
+        timestamp = Signal(32)
+        self.sync += [
+            If(timer == 0,
+                timer.eq(us_cyc - 1),
+                timestamp.eq(timestamp + 1)
+            ).Else(
+                timer.eq(timer - 1)
+            )
+        ]
+
+        # SPI master commands issued in capture mode; see above.
+        clear_seq = [CMD_SHIFT|BIT_DATA_OUT, 2, 0,
+                     OP_W_REGISTER|ADDR_STATUS, REG_STATUS(RX_DR=1).to_int()]
+        nop_seq   = [CMD_SHIFT|BIT_DATA_IN|BIT_DATA_OUT, 1, 0,
+                     OP_NOP]
+        read_seq  = [CMD_SHIFT|BIT_DATA_OUT|BIT_HOLD_SS, 1, 0,
+                     OP_R_RX_PAYLOAD,
+                     CMD_SHIFT|BIT_DATA_IN, 0, 0]
+        seq_rom   = Array(clear_seq + nop_seq + read_seq)
+        seq_index = Signal(max=len(seq_rom))
+        nop_start   = len(clear_seq)
+        read_start  = len(clear_seq) + len(nop_seq)
+        width_index = read_start + 5
+
+        spi_idle = self.spi.fsm.ongoing("RECV-COMMAND")
+        host     = Signal()
+        stamp    = Signal(32)
+        status   = Signal(8)
+        header   = Array(Cat(stamp, status)[n * 8:(n + 1) * 8] for n in range(5))
+        header_index = Signal(max=5)
+
+        self.comb += [
+            in_fifo.flush.eq(spi_in_fifo.flush),
+            If(host,
+                spi_out_fifo.dout.eq(out_fifo.dout),
+            ).Else(
+                spi_out_fifo.dout.eq(Mux(seq_index == width_index, payload_width,
+                                         seq_rom[seq_index])),
+            ),
+        ]
+
+        def feed(last_index, next_state):
+            return [
+                spi_out_fifo.readable.eq(1),
+                spi_in_fifo.writable.eq(in_fifo.writable),
+                in_fifo.we.eq(spi_in_fifo.we),
+                in_fifo.din.eq(spi_in_fifo.din),
+                If(spi_out_fifo.re,
+                    NextValue(seq_index, seq_index + 1),
+                    If(seq_index == last_index,
+                        NextState(next_state)
+                    )
+                )
+            ]
+
+        self.submodules.fsm = FSM(reset_state="HOST")
+        self.fsm.act("HOST",
+            host.eq(1),
+            spi_out_fifo.readable.eq(out_fifo.readable),
+            out_fifo.re.eq(spi_out_fifo.re),
+            spi_in_fifo.writable.eq(in_fifo.writable),
+            in_fifo.we.eq(spi_in_fifo.we),
+            in_fifo.din.eq(spi_in_fifo.din),
+            If(capture & ~irq & spi_idle & ~out_fifo.readable,
+                NextValue(stamp, timestamp),
+                NextValue(seq_index, 0),
+                NextState("CLEAR")
+            )
+        )
+        self.fsm.act("CLEAR",
+            feed(nop_start - 1, "CLEAR-WAIT")
+        )
+        self.fsm.act("CLEAR-WAIT",
+            If(spi_idle,
+                NextValue(seq_index, nop_start),
+                NextState("NOP")
+            )
+        )
+        self.fsm.act("NOP",
+            feed(read_start - 1, "NOP-WAIT")
+        )
+        self.fsm.act("NOP-WAIT",
+            spi_in_fifo.writable.eq(1),
+            If(spi_in_fifo.we,
+                NextValue(status, spi_in_fifo.din),
+                NextState("NOP-CHECK")
+            )
+        )
+        self.fsm.act("NOP-CHECK",
+            If(spi_idle,
+                If(status[1:4] == 0b111,
+                    NextState("HOST")
+                ).Else(
+                    NextValue(header_index, 0),
+                    NextState("HEADER")
+                )
+            )
+        )
+        self.fsm.act("HEADER",
+            If(in_fifo.writable,
+                in_fifo.we.eq(1),
+                in_fifo.din.eq(header[header_index]),
+                NextValue(header_index, header_index + 1),
+                If(header_index == 4,
+                    NextValue(seq_index, read_start),
+                    NextState("READ")
+                )
+            )
+        )
+        self.fsm.act("READ",
+            feed(len(seq_rom) - 1, "READ-WAIT")
+        )
+        self.fsm.act("READ-WAIT",
+            spi_in_fifo.writable.eq(in_fifo.writable),
+            in_fifo.we.eq(spi_in_fifo.we),
+            in_fifo.din.eq(spi_in_fifo.din),
+            If(spi_idle,
+                NextValue(seq_index, nop_start),
+                NextState("NOP")
+            )
+        )
+
+
 class RadioNRF24L01Interface:
-    def __init__(self, interface, logger, device, addr_dut_ce):
+    def __init__(self, interface, logger, device, addr_dut_ce,
+                 addr_capture=None, addr_capture_width=None):
         self.lower   = interface
         self._logger = logger
         self._level  = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
         self._device = device
         self._addr_dut_ce = addr_dut_ce
+        self._addr_capture = addr_capture
+        self._addr_capture_width = addr_capture_width
 
     def _log(self, message, *args):
         self._logger.log(self._level, "nRF24L01: " + message, *args)
@@ -103,6 +270,37 @@ class RadioNRF24L01Interface:
                 break
             await self.flush_rx()
 
+    async def capture(self, length):
+        """
+        Receive packets with payloads of ``length`` bytes in gateware, and yield
+        ``(timestamp, status, payload)`` for every one of them, where ``timestamp`` is
+        in microseconds since the first packet. No other commands may be issued until
+        the capture is finished.
+        """
+        assert length in range(1, 33)
+        self._log("capture length=%d", length)
+        # Capture starts once the SPI commands issued so far are complete.
+        await self.lower.lower.flush()
+        await self._device.write_register(self._addr_capture_width, length)
+        await self._device.write_register(self._addr_capture, 1)
+        try:
+            epoch = None
+            while True:
+                record = await self.lower.lower.read(5 + length)
+                stamp, status = struct.unpack_from("<LB", record)
+                payload = bytes(record[5:])
+                if epoch is None:
+                    epoch = last_stamp = stamp
+                if stamp < last_stamp:
+                    epoch -= 1 << 32
+                last_stamp = stamp
+                self._log("capture timestamp=%d status=%02x payload=<%s>",
+                          stamp - epoch, status, dump_hex(payload))
+                yield stamp - epoch, REG_STATUS.from_int(status), payload
+        finally:
+            self._log("capture stop")
+            await self._device.write_register(self._addr_capture, 0)
+
     async def poll_tx_status(self, delay=0.010):
         # Don't clear MAX_RT, since it prevents REUSE_TX_PL and clears ARC_CNT.
         poll_bits  = REG_STATUS(TX_DS=1, MAX_RT=1).to_int()
@@ -140,6 +338,80 @@ class RadioNRF24L01Interface:
             await self.flush_tx()
 
 
+# Captures are written in the pcap format, with the link type LINKTYPE_USER0 and each packet
+# prefixed with the radio configuration: flags (bit 0: automatic transaction handling, bit 1:
+# dynamic payload length), CRC width, static payload length, address width, and then
+# the address (most significant byte first).
+LINKTYPE_USER0 = 147
+
+_PCAP_HEADER   = struct.Struct("<LHHlLLL")
+_PCAP_RECORD   = struct.Struct("<LLLL")
+_PCAP_CONFIG   = struct.Struct("<BBBB")
+
+
+def _pcap_config(en_aa, en_dpl, crc_width, length, address):
+    """Return the prefix of captured packets, where ``address`` is least significant byte first."""
+    return _PCAP_CONFIG.pack(en_aa | (en_dpl << 1), crc_width, length or 0, len(address)) + \
+        bytes(reversed(address))
+
+
+def _write_pcap_header(file):
+    file.write(_PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 0xffff, LINKTYPE_USER0))
+
+
+def _write_pcap_record(file, timestamp, config, payload):
+    """Write a record for ``payload`` received at ``timestamp`` microseconds since the epoch."""
+    seconds, microseconds = divmod(timestamp, 1000000)
+    file.write(_PCAP_RECORD.pack(seconds, microseconds,
+                                 len(config) + len(payload), len(config) + len(payload)))
+    file.write(config)
+    file.write(payload)
+
+
+def _decode_packet(payload, address, crc_width, en_aa, en_dpl, length):
+    """
+    Decode a packet received in monitor mode, where ``payload`` includes the packet control
+    field and the CRC if ``en_aa`` is set, and ``address`` is least significant byte first.
+
+    Returns ``(message, crc_ok)``, where ``crc_ok`` is ``None`` if the CRC was not checked.
+    """
+    if not en_aa:
+        return dump_hex(payload), None
+
+    dyn_length = payload[0] >> 2
+    packet_id  = payload[0] & 0b11
+    no_ack     = payload[1] >> 7
+    # The packet control field is 9 bits long, so everything after it is shifted by one bit.
+    data_crc   = (int.from_bytes(payload[1:], "big") << 1).to_bytes(len(payload), "big")[1:-1]
+
+    if dyn_length == 0:
+        data, crc = b"", data_crc
+        payload_msg = "(ACK)"
+    elif en_dpl:
+        data, crc = data_crc[:dyn_length], data_crc[dyn_length:]
+        payload_msg = data.hex()
+    else:
+        data, crc = data_crc[:length], data_crc[length:]
+        payload_msg = data.hex()
+
+    if len(crc) < crc_width:
+        crc_ok, crc_msg = None, " (CRC?)"
+    elif crc_width in (1, 2):
+        if crc_width == 1:
+            crc_func = crc8_nrf24l
+        else:
+            crc_func = crc16_nrf24l
+        crc_actual   = int.from_bytes(crc[:crc_width], "big")
+        crc_expected = crc_func(bytes(reversed(address)) + payload,
+            bits=len(address) * 8 + 9 + len(data) * 8)
+        crc_ok  = crc_actual == crc_expected
+        crc_msg = "" if crc_ok else " (CRC!)"
+    else:
+        crc_ok, crc_msg = None, ""
+
+    return "PID={:02b} {}{}".format(packet_id, payload_msg, crc_msg), crc_ok
+
+
 class RadioNRF24L01Applet(GlasgowApplet, name="radio-nrf24l"):
     logger = logging.getLogger(__name__)
     help = "transmit and receive using nRF24L01(+) RF PHY"
@@ -159,6 +431,11 @@ class RadioNRF24L01Applet(GlasgowApplet, name="radio-nrf24l"):
     started by a node with a known address without disturbing either party. It is not natively
     supported by nRF24L01(+), and is emulated in an imperfect way.
 
+    The `capture` subcommand receives packets the same way as `monitor`, but the RX FIFO is drained
+    by the gateware as soon as IRQ is asserted, so that dense traffic can be captured without
+    losing packets. Captured packets are timestamped and written to a pcap file (with link type
+    USER0), and can be decoded afterwards using `glasgow tool radio-nrf24l decode`.
+
     The pinout of a common 8-pin nRF24L01+ module is as follows (live bug view):
 
     ::
@@ -188,19 +465,21 @@ class RadioNRF24L01Applet(GlasgowApplet, name="radio-nrf24l"):
 
     def build(self, target, args):
         dut_ce, self.__addr_dut_ce = target.registers.add_rw(1)
+        capture, self.__addr_capture = target.registers.add_rw(1)
+        capture_width, self.__addr_capture_width = target.registers.add_rw(6)
 
         self.mux_interface = iface = target.multiplexer.claim_interface(self, args)
         pads = iface.get_pads(args, pins=self.__pins)
 
-        subtarget = iface.add_subtarget(SPIMasterSubtarget(
+        subtarget = iface.add_subtarget(RadioNRF24L01Subtarget(
             pads=pads,
             out_fifo=iface.get_out_fifo(),
             in_fifo=iface.get_in_fifo(),
             period_cyc=math.ceil(target.sys_clk_freq / (args.frequency * 1000)),
             delay_cyc=math.ceil(target.sys_clk_freq / 1e6),
-            sck_idle=0,
-            sck_edge="rising",
-            ss_active=0,
+            us_cyc=math.ceil(target.sys_clk_freq / 1e6),
+            capture=capture,
+            payload_width=capture_width,
         ))
         subtarget.comb += [
             pads.ce_t.o.eq(dut_ce),
@@ -213,7 +492,8 @@ class RadioNRF24L01Applet(GlasgowApplet, name="radio-nrf24l"):
         iface = await device.demultiplexer.claim_interface(self, self.mux_interface, args)
         spi_iface = SPIMasterInterface(iface, self.logger)
         nrf24l01_iface = RadioNRF24L01Interface(spi_iface, self.logger, device,
-                                                self.__addr_dut_ce)
+                                                self.__addr_dut_ce,
+                                                self.__addr_capture, self.__addr_capture_width)
         return nrf24l01_iface
 
     @classmethod
@@ -311,6 +591,22 @@ class RadioNRF24L01Applet(GlasgowApplet, name="radio-nrf24l"):
             "monitor", help="monitor packets")
         add_rx_arguments(p_monitor)
 
+        p_capture = p_operation.add_parser(
+            "capture", help="capture packets to a file")
+        p_capture.add_argument(
+            "address", metavar="ADDRESS", type=address,
+            help="capture packets with hex address ADDRESS")
+        p_capture.add_argument(
+            "file", metavar="PCAP-FILE", type=argparse.FileType("wb"),
+            help="write captured packets to PCAP-FILE")
+        p_capture.add_argument(
+            "-l", "--length", metavar="LENGTH", type=length,
+            help="capture packets with length LENGTH "
+                 "(mutually exclusive with --dynamic-length)")
+        p_capture.add_argument(
+            "-n", "--count", metavar="COUNT", type=int,
+            help="stop after capturing COUNT packets (default: capture until interrupted)")
+
     async def interact(self, device, args, nrf24l01_iface):
         if args.crc_width == 0 and not args.compat_framing:
             raise RadioNRF24L01Error("Automatic transaction handling requires CRC to be enabled")
@@ -415,7 +711,7 @@ class RadioNRF24L01Applet(GlasgowApplet, name="radio-nrf24l"):
                 await nrf24l01_iface.write_register(ADDR_STATUS,
                     REG_STATUS(MAX_RT=1).to_int())
 
-        if args.operation in ("receive", "monitor"):
+        if args.operation in ("receive", "monitor", "capture"):
             if len(args.address) != args.address_width:
                 raise RadioNRF24L01Error("Length of address does not match address width")
             if en_dpl:
@@ -474,7 +770,7 @@ class RadioNRF24L01Applet(GlasgowApplet, name="radio-nrf24l"):
             finally:
                 await nrf24l01_iface.disable()
 
-        if args.operation == "monitor":
+        if args.operation in ("monitor", "capture"):
             if en_aa:
                 overhead = 2 + args.crc_width
                 if en_dpl:
@@ -504,6 +800,7 @@ class RadioNRF24L01Applet(GlasgowApplet, name="radio-nrf24l"):
                 await nrf24l01_iface.write_register(ADDR_CONFIG,
                     REG_CONFIG(PRIM_RX=1, PWR_UP=1, CRCO=crco, EN_CRC=en_crc).to_int())
 
+        if args.operation == "monitor":
             await nrf24l01_iface.enable()
             try:
                 while True:
@@ -514,56 +811,289 @@ class RadioNRF24L01Applet(GlasgowApplet, name="radio-nrf24l"):
                         continue
 
                     payload = await nrf24l01_iface.read_rx_payload(length)
-                    if en_aa:
-                        dyn_length = payload[0] >> 2
-                        packet_id  = payload[0] & 0b11
-                        no_ack     = payload[1] >> 7
-                        data_crc   = bytes([
-                            ((payload[1 + n + 0] << 1) & 0b1111111_0) |
-                            ((payload[1 + n + 1] >> 7) & 0b0000000_1)
-                            for n in range(len(payload) - 2)
-                        ])
-
-                        if dyn_length == 0:
-                            data, crc = b"", data_crc
-                            payload_msg = "(ACK)"
-                        elif en_dpl:
-                            data, crc = data_crc[:dyn_length], data_crc[dyn_length:]
-                            payload_msg = data.hex()
-                        else:
-                            data, crc = data_crc[:args.length], data_crc[args.length:]
-                            payload_msg = data.hex()
-
-                        if len(crc) < args.crc_width:
-                            crc_msg = " (CRC?)"
-                        elif args.crc_width in (1, 2):
-                            if args.crc_width == 1:
-                                crc_func = crc8_nrf24l
-                            else:
-                                crc_func = crc16_nrf24l
-                            crc_actual   = int.from_bytes(crc[:args.crc_width], "big")
-                            crc_expected = crc_func(bytes(reversed(args.address)) + payload,
-                                bits=len(args.address) * 8 + 9 + len(data) * 8)
-                            if crc_actual != crc_expected:
-                                crc_msg = " (CRC!)"
-                            else:
-                                crc_msg = ""
-                        else:
-                            crc_msg = ""
-
-                        self.logger.info("packet received: PID=%s %s%s",
-                                         "{:02b}".format(packet_id), payload_msg, crc_msg)
-                    else:
-                        self.logger.info("packet received: %s", dump_hex(payload))
+                    packet_msg, _ = _decode_packet(payload, args.address, args.crc_width,
+                                                   en_aa, en_dpl, args.length)
+                    self.logger.info("packet received: %s", packet_msg)
 
                     if not args.repeat:
                         break
             finally:
                 await nrf24l01_iface.disable()
 
+        if args.operation == "capture":
+            _write_pcap_header(args.file)
+            config = _pcap_config(en_aa, en_dpl, args.crc_width, args.length, args.address)
+
+            await nrf24l01_iface.enable()
+            packets = nrf24l01_iface.capture(min(32, length))
+            count   = 0
+            begin   = time.time()
+            try:
+                async for timestamp, status, payload in packets:
+                    _write_pcap_record(args.file, int(begin * 1e6) + timestamp, config, payload)
+
+                    count += 1
+                    if count == args.count:
+                        break
+            finally:
+                await packets.aclose()
+                await nrf24l01_iface.disable()
+                args.file.flush()
+                self.logger.info("captured %d packets in %.3f s", count, time.time() - begin)
+
+
+class RadioNRF24L01AppletTool(GlasgowAppletTool, applet=RadioNRF24L01Applet):
+    help = "decode packets captured from nRF24L01(+) RF PHY"
+    description = """
+    Decode packets captured with `glasgow run radio-nrf24l capture`, and check their CRC.
+    """
+
+    @classmethod
+    def add_arguments(cls, parser):
+        # TODO(py3.7): add required=True
+        p_operation = parser.add_subparsers(dest="operation", metavar="OPERATION")
+
+        p_decode = p_operation.add_parser(
+            "decode", help="decode captured packets")
+        p_decode.add_argument(
+            "file", metavar="PCAP-FILE", type=argparse.FileType("rb"),
+            help="read captured packets from PCAP-FILE")
+
+    async def run(self, args):
+        if args.operation == "decode":
+            header = args.file.read(_PCAP_HEADER.size)
+            if len(header) < _PCAP_HEADER.size:
+                raise RadioNRF24L01Error("Capture file is truncated")
+            magic, *_, linktype = _PCAP_HEADER.unpack(header)
+            if magic != 0xa1b2c3d4 or linktype != LINKTYPE_USER0:
+                raise RadioNRF24L01Error("Not an nRF24L01 capture file")
+
+            epoch  = None
+            counts = {True: 0, False: 0, None: 0}
+            while True:
+                record = args.file.read(_PCAP_RECORD.size)
+                if not record:
+                    break
+                if len(record) < _PCAP_RECORD.size:
+                    raise RadioNRF24L01Error("Capture file is truncated")
+                seconds, microseconds, length, _ = _PCAP_RECORD.unpack(record)
+                packet = args.file.read(length)
+                if len(packet) < length:
+                    raise RadioNRF24L01Error("Capture file is truncated")
+
+                flags, crc_width, static_length, address_width = \
+                    _PCAP_CONFIG.unpack_from(packet)
+                address = packet[_PCAP_CONFIG.size:_PCAP_CONFIG.size + address_width]
+                payload = packet[_PCAP_CONFIG.size + address_width:]
+
+                timestamp = seconds * 1000000 + microseconds
+                if epoch is None:
+                    epoch = timestamp
+                packet_msg, crc_ok = _decode_packet(payload, bytes(reversed(address)), crc_width,
+                    en_aa=flags & 1, en_dpl=flags & 2, length=static_length)
+                self.logger.info("%12.6f s: %s", (timestamp - epoch) / 1e6, packet_msg)
+                counts[crc_ok] += 1
+
+            self.logger.info("decoded %d packets: %d with valid CRC, %d with invalid CRC",
+                             sum(counts.values()), counts[True], counts[False])
+
 # -------------------------------------------------------------------------------------------------
 
+import io
+import unittest
+
+
+class RadioNRF24L01DecodeTestCase(unittest.TestCase):
+    # Address C2C3C4C5C6, least significant byte first.
+    address = bytes.fromhex("c6c5c4c3c2")
+
+    def test_decode_crc16(self):
+        payload = bytes.fromhex("0e091a2b0cff00")
+        self.assertEqual(_decode_packet(payload, self.address, 2, en_aa=True, en_dpl=False,
+                                        length=3),
+                         ("PID=10 123456", True))
+        self.assertEqual(_decode_packet(payload, self.address, 2, en_aa=True, en_dpl=True,
+                                        length=None),
+                         ("PID=10 123456", True))
+
+    def test_decode_crc8(self):
+        payload = bytes.fromhex("09ef56f980")
+        self.assertEqual(_decode_packet(payload, self.address, 1, en_aa=True, en_dpl=True,
+                                        length=None),
+                         ("PID=01 dead", True))
+
+    def test_decode_ack(self):
+        payload = bytes.fromhex("0356d980")
+        self.assertEqual(_decode_packet(payload, self.address, 2, en_aa=True, en_dpl=True,
+                                        length=None),
+                         ("PID=11 (ACK)", True))
+
+    def test_decode_bad_crc(self):
+        payload = bytearray.fromhex("0e091a2b0cff00")
+        payload[2] ^= 0x01
+        self.assertEqual(_decode_packet(payload, self.address, 2, en_aa=True, en_dpl=False,
+                                        length=3),
+                         ("PID=10 123656 (CRC!)", False))
+        self.assertEqual(_decode_packet(payload, bytes(reversed(self.address)), 2,
+                                        en_aa=True, en_dpl=False, length=3)[1],
+                         False)
+
+    def test_decode_raw(self):
+        self.assertEqual(_decode_packet(b"\x12\x34", self.address, 2, en_aa=False, en_dpl=False,
+                                        length=2),
+                         ("1234", None))
+
+    def test_capture_file(self):
+        file = io.BytesIO()
+        _write_pcap_header(file)
+        config = _pcap_config(True, False, 2, 3, self.address)
+        _write_pcap_record(file, 1_500_000_000_000_000, config, bytes.fromhex("0e091a2b0cff00"))
+        _write_pcap_record(file, 1_500_000_001_250_000, config, bytes.fromhex("0e091a2b0cfe00"))
+        file.seek(0)
+
+        tool = RadioNRF24L01AppletTool()
+        args = argparse.Namespace(operation="decode", file=file)
+        with self.assertLogs(RadioNRF24L01Applet.logger) as logs:
+            asyncio.get_event_loop().run_until_complete(tool.run(args))
+        self.assertEqual([record.getMessage() for record in logs.records], [
+            "    0.000000 s: PID=10 123456",
+            "    1.250000 s: PID=10 123456 (CRC!)",
+            "decoded 2 packets: 1 with valid CRC, 1 with invalid CRC",
+        ])
+
+
+class RadioNRF24L01TestTarget(Module):
+    """
+    An nRF24L01 with ``packets`` payloads in its RX FIFO, where byte ``k`` of the ``n``-th payload
+    is ``(n << 4) | k``. Asserting ``inject`` receives another payload. All registers other than
+    STATUS read as 0x5A, and TX_FULL is always set, so that STATUS is told apart from other bytes.
+    """
+    def __init__(self, pads, packets):
+        self.inject    = Signal()
+        self.nop_count = Signal(8)
+
+        ###
+
+        pending = Signal(8, reset=packets)
+        popped  = Signal(4)
+        rx_dr   = Signal(reset=packets > 0)
+        status  = Signal(8)
+        self.comb += [
+            status.eq(Cat(C(1, 1), Mux(pending == 0, C(0b111, 3), C(0b000, 3)), C(0, 2), rx_dr)),
+            pads.irq_t.i.eq(~rx_dr),
+        ]
+
+        ss_r    = Signal(reset=1)
+        sck_r   = Signal()
+        rising  = Signal()
+        falling = Signal()
+        self.sync += [
+            ss_r.eq(pads.ss_t.o),
+            sck_r.eq(pads.sck_t.o),
+        ]
+        self.comb += [
+            rising.eq(~pads.ss_t.o & ~sck_r & pads.sck_t.o),
+            falling.eq(~pads.ss_t.o & sck_r & ~pads.sck_t.o),
+        ]
+
+        bitno   = Signal(3)
+        byteno  = Signal(6)
+        cmd     = Signal(8)
+        shreg_i = Signal(8)
+        data_i  = Signal(8)
+        shreg_o = Signal(8)
+        self.comb += [
+            data_i.eq(Cat(pads.mosi_t.o, shreg_i[:7])),
+            pads.miso_t.i.eq(shreg_o[7]),
+        ]
+        self.sync += [
+            If(pads.ss_t.o,
+                bitno.eq(0),
+                byteno.eq(0),
+                shreg_o.eq(status),
+                If(~ss_r & (cmd == OP_R_RX_PAYLOAD) & (byteno > 1),
+                    pending.eq(pending - 1),
+                    popped.eq(popped + 1),
+                )
+            ).Elif(rising,
+                shreg_i.eq(data_i),
+                bitno.eq(bitno + 1),
+                If(bitno == 7,
+                    byteno.eq(byteno + 1),
+                    If(byteno == 0,
+                        cmd.eq(data_i),
+                        If(data_i == OP_NOP,
+                            self.nop_count.eq(self.nop_count + 1)
+                        )
+                    ),
+                    If((byteno == 1) & (cmd == OP_W_REGISTER|ADDR_STATUS) &
+                            data_i[6],
+                        rx_dr.eq(0)
+                    )
+                )
+            ).Elif(falling,
+                If(bitno == 0,
+                    If(cmd == OP_R_RX_PAYLOAD,
+                        shreg_o.eq(Cat((byteno - 1)[:4], popped))
+                    ).Elif((cmd == OP_NOP) | (cmd == OP_W_REGISTER|ADDR_STATUS),
+                        shreg_o.eq(0)
+                    ).Else(
+                        shreg_o.eq(0x5A)
+                    )
+                ).Else(
+                    shreg_o.eq(shreg_o << 1)
+                )
+            ),
+            If(self.inject,
+                pending.eq(pending + 1),
+                rx_dr.eq(1)
+            )
+        ]
+
+
 class RadioNRF24L01AppletTestCase(GlasgowAppletTestCase, applet=RadioNRF24L01Applet):
     @synthesis_test
     def test_build(self):
         self.assertBuilds()
+
+    def setup_target(self):
+        self.build_simulated_applet()
+        mux_iface = self.applet.mux_interface
+        mux_iface.submodules.target = RadioNRF24L01TestTarget(mux_iface.pads, packets=2)
+
+    @applet_simulation_test("setup_target")
+    @asyncio.coroutine
+    def test_capture(self):
+        mux_iface = self.applet.mux_interface
+        nrf24l01_iface = yield from self.run_simulated_applet()
+        spi_iface = nrf24l01_iface.lower
+
+        # Capture is enabled, and IRQ is asserted, in the middle of a host transaction; the rest
+        # of it is already in the OUT FIFO, and must not be preempted.
+        yield from spi_iface.write([OP_R_REGISTER|ADDR_CONFIG], hold_ss=True)
+        yield from self.device.write_register(nrf24l01_iface._addr_capture_width, 3)
+        yield from self.device.write_register(nrf24l01_iface._addr_capture, 1)
+        self.assertEqual((yield from spi_iface.read(1)), b"\x5A")
+
+        # Both payloads are read after a single IRQ, so they have the same timestamp.
+        stamp_1, status_1, payload_1, stamp_2, status_2, payload_2 = \
+            struct.unpack("<LB3sLB3s", (yield from spi_iface.lower.read(2 * (5 + 3))))
+        self.assertLess(stamp_1, 1 << 16)
+        self.assertEqual(stamp_2, stamp_1)
+        self.assertEqual((status_1, payload_1), (0x01, b"\x00\x01\x02"))
+        self.assertEqual((status_2, payload_2), (0x01, b"\x10\x11\x12"))
+
+        yield mux_iface.target.inject.eq(1)
+        yield
+        yield mux_iface.target.inject.eq(0)
+        stamp_3, status_3, payload_3 = \
+            struct.unpack("<LB3s", (yield from spi_iface.lower.read(5 + 3)))
+        self.assertGreater(stamp_3, stamp_1)
+        self.assertEqual((status_3, payload_3), (0x01, b"\x20\x21\x22"))
+
+        # The RX FIFO was checked before and after every payload, but none of the STATUS bytes
+        # returned by NOP must reach the host, or they would be read instead of the register.
+        yield from self.device.write_register(nrf24l01_iface._addr_capture, 0)
+        self.assertEqual((yield from nrf24l01_iface.read_register(ADDR_CONFIG)), 0x5A)
+        self.assertEqual((yield mux_iface.target.nop_count), 5)
+        self.assertEqual((yield mux_iface.in_fifo.readable), 0)
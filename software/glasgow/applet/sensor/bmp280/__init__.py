@@ -253,8 +253,7 @@ class BMP280I2CInterface:
         await self.lower.reset()
 
     async def read(self, addr, size):
-        await self.lower.write(self._i2c_addr, [addr])
-        result = await self.lower.read(self._i2c_addr, size)
+        result, = await self.lower.transact([(self._i2c_addr, [addr], size)])
         if result is None:
             raise BMP280Error("BMP280 did not acknowledge I2C read at address {:#07b}"
                               .format(self._i2c_addr))
@@ -37,31 +37,32 @@ class INA260I2CInterface:
         self._logger   = logger
         self._level    = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
 
+    async def _read_regs16u(self, regs):
+        results = await self.lower.transact([(self._i2c_addr, [reg], 2) for reg in regs])
+        raws = []
+        for reg, result in zip(regs, results):
+            if result is None:
+                raise INA260Error("INA260 did not acknowledge I2C read at address {:#07b}"
+                                  .format(self._i2c_addr))
+            msb, lsb = result
+            raw = (msb << 8) | lsb
+            self._logger.log(self._level, "INA260: read reg=%#04x raw=%#06x", reg, raw)
+            raws.append(raw)
+        return raws
+
     async def _read_reg16u(self, reg):
-        await self.lower.write(self._i2c_addr, [reg])
-        result = await self.lower.read(self._i2c_addr, 2)
-        if result is None:
-            raise INA260Error("INA260 did not acknowledge I2C read at address {:#07b}"
-                              .format(self._i2c_addr))
-        msb, lsb = result
-        raw = (msb << 8) | lsb
-        self._logger.log(self._level, "INA260: read reg=%#04x raw=%#06x", reg, raw)
+        raw, = await self._read_regs16u([reg])
         return raw
 
-    async def _read_reg16s(self, reg):
-        await self.lower.write(self._i2c_addr, [reg])
-        result = await self.lower.read(self._i2c_addr, 2)
-        if result is None:
-            raise INA260Error("INA260 did not acknowledge I2C read at address {:#07b}"
-                              .format(self._i2c_addr))
-        msb, lsb = result
-        raw = (msb << 8) | lsb
+    @staticmethod
+    def _signed16(raw):
         if raw & (1 << 15):
-            value = -((1 << 16) - raw)
+            return -((1 << 16) - raw)
         else:
-            value = raw
-        self._logger.log(self._level, "INA260: read reg=%#04x raw=%#06x read=%+d", reg, raw, value)
-        return value
+            return raw
+
+    async def _read_reg16s(self, reg):
+        return self._signed16(await self._read_reg16u(reg))
 
     async def identify(self):
         vendor = await self._read_reg16u(REG_VENDOR_ID)
@@ -89,6 +90,18 @@ class INA260I2CInterface:
         self._logger.log(self._level, "INA260: power raw=%d watts=%f", raw, watts)
         return watts
 
+    async def get_measurements(self):
+        """
+        Read voltage, current and power at once. Returns ``(volts, amps, watts)``.
+        """
+        raw_voltage, raw_current, raw_power = \
+            await self._read_regs16u([REG_VOLTAGE, REG_CURRENT, REG_POWER])
+        volts = raw_voltage * VOLTS_FACTOR
+        amps  = self._signed16(raw_current) * AMPERE_FACTOR
+        watts = raw_power * WATTS_FACTOR
+        self._logger.log(self._level, "INA260: volts=%f amps=%+f watts=%f", volts, amps, watts)
+        return volts, amps, watts
+
 
 class SensorINA260Applet(I2CInitiatorApplet, name="sensor-ina260"):
     logger = logging.getLogger(__name__)
@@ -132,9 +145,7 @@ class SensorINA260Applet(I2CInitiatorApplet, name="sensor-ina260"):
         await ina260.identify()
 
         if args.operation == "measure":
-            volts = await ina260.get_voltage()
-            amps  = await ina260.get_current()
-            watts = await ina260.get_power()
+            volts, amps, watts = await ina260.get_measurements()
             print("bus voltage : {:7.03f} V".format(volts))
             print("current     : {:+7.03f} A".format(amps))
             print("power       : {:7.03f} W".format(watts))
@@ -144,9 +155,8 @@ class SensorINA260Applet(I2CInitiatorApplet, name="sensor-ina260"):
             data_logger = await DataLogger(self.logger, args, field_names=field_names)
             while True:
                 async def report():
-                    fields = dict(u=await ina260.get_voltage(),
-                                  i=await ina260.get_current(),
-                                  p=await ina260.get_power())
+                    volts, amps, watts = await ina260.get_measurements()
+                    fields = dict(u=volts, i=amps, p=watts)
                     await data_logger.report_data(fields)
                 try:
                     await asyncio.wait_for(report(), args.interval * 2)
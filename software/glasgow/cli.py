@@ -1,5 +1,8 @@
 import os
+import io
 import sys
+import copy
+import time
 import logging
 import argparse
 import textwrap
@@ -7,6 +10,7 @@ import re
 import asyncio
 import signal
 import unittest
+import weakref
 from vcd import VCDWriter
 from datetime import datetime
 
@@ -17,6 +21,7 @@ from . import __version__
 from .support.logging import *
 from .support.asignal import *
 from .support.pyrepl import *
+from .support.rpc import RPCServer
 from .device import GlasgowDeviceError
 from .device.config import GlasgowConfig
 from .target.hardware import GlasgowHardwareTarget
@@ -136,16 +141,16 @@ def get_argparser():
                     "tests", metavar="TEST", nargs="*",
                     help="test cases to run")
 
-            if mode in ("build", "run", "run-repl"):
+            if mode in ("build", "run", "run-repl", "run-daemon"):
                 access_args = DirectArguments(applet_name=applet_name,
                                               default_port="AB",
                                               pin_count=16)
-                if mode in ("run", "run-repl"):
+                if mode in ("run", "run-repl", "run-daemon"):
                     g_applet_build = p_applet.add_argument_group("build arguments")
                     applet.add_build_arguments(g_applet_build, access_args)
                     g_applet_run = p_applet.add_argument_group("run arguments")
                     applet.add_run_arguments(g_applet_run, access_args)
-                    if mode != "run-repl":
+                    if mode == "run":
                         # FIXME: this makes it impossible to add subparsers in applets
                         # g_applet_interact = p_applet.add_argument_group("interact arguments")
                         # applet.add_interact_arguments(g_applet_interact)
@@ -239,6 +244,36 @@ def get_argparser():
     add_run_args(p_run_repl)
     add_applet_arg(p_run_repl, mode="run-repl")
 
+    p_run_daemon = subparsers.add_parser(
+        "run-daemon", formatter_class=TextHelpFormatter,
+        help="run an applet and serve its low-level interface over a Unix socket",
+        description="""
+    Run an applet and keep the device configured, serving the low-level interface of
+    the applet (the same one as `iface` in `run-repl`) over a Unix socket until Ctrl+C is
+    pressed. Scripts connect to it using `glasgow.support.rpc.RPCClient`, and call methods of
+    the interface through `client.root`.
+
+    Every call is sent immediately and returns a future, so that many calls can be issued
+    without waiting for each of them to complete.
+    """)
+    add_run_args(p_run_daemon)
+    p_run_daemon.add_argument(
+        "--socket", metavar="PATH", type=str, default="glasgow.sock",
+        help="listen at Unix socket PATH (default: %(default)s)")
+    add_applet_arg(p_run_daemon, mode="run-daemon")
+
+    def serials(arg):
+        return [serial(item) for item in arg.split(",")]
+
+    p_run_gang = subparsers.add_parser(
+        "run-gang", formatter_class=TextHelpFormatter,
+        help="run an applet on several devices at once and report results for each of them")
+    add_run_args(p_run_gang)
+    p_run_gang.add_argument(
+        "--serials", metavar="SERIAL,...", type=serials, default=None,
+        help="use devices with serial numbers SERIAL,... (default: all attached devices)")
+    add_applet_arg(p_run_gang, mode="run")
+
     p_run_prebuilt = subparsers.add_parser(
         "run-prebuilt", formatter_class=TextHelpFormatter,
         help="(advanced) load a prebuilt applet bitstream and run applet code")
@@ -344,6 +379,153 @@ def _applet(revision, args):
     return target, applet
 
 
+# Gang mode
+# ---------
+#
+# In gang mode, the same applet operation runs on several devices concurrently, in one event loop.
+# The applet is built once per device revision, and each bitstream is built at most once; every
+# device then gets its own copy of the applet, and its own handles for the files the applet reads.
+# Files cannot be written in gang mode, since every device would write to the same file.
+#
+# Log messages are tagged with the serial number of the device the task that emitted them
+# operates on. (Tasks that an applet starts by itself are not tagged.)
+
+_gang_serials = weakref.WeakKeyDictionary()
+
+
+def _current_task():
+    # TODO(py3.7): use asyncio.current_task()
+    try:
+        if sys.version_info >= (3, 7):
+            return asyncio.current_task()
+        else:
+            return asyncio.Task.current_task()
+    except RuntimeError:
+        return None # no running event loop
+
+
+def _gang_log_record_factory(factory):
+    def make_record(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        task   = _current_task()
+        serial = None if task is None else _gang_serials.get(task)
+        if serial is not None:
+            record.name = "{}[{}]".format(record.name, serial)
+        return record
+    return make_record
+
+
+def _gang_args(args):
+    gang_args = argparse.Namespace(**vars(args))
+    for name, value in vars(args).items():
+        if isinstance(value, io.IOBase):
+            if value.writable() or not hasattr(value, "name") or value.name == "<stdin>":
+                raise GlasgowAppletError("argument {} cannot be used in gang mode"
+                                         .format(name))
+            setattr(gang_args, name, open(value.name, value.mode))
+    return gang_args
+
+
+async def _run_gang(args, firmware_filename):
+    if args.serials is not None:
+        serials = args.serials
+    elif args.serial is not None:
+        serials = [args.serial]
+    else:
+        serials = GlasgowHardwareDevice.enumerate_serials(firmware_filename)
+    logger.info("running applet %r on %d devices: %s",
+                args.applet, len(serials), ", ".join(serials))
+
+    devices = []
+    try:
+        for serial in serials:
+            devices.append(GlasgowHardwareDevice(serial, firmware_filename))
+
+        try:
+            all_args = [_gang_args(args) for _ in devices]
+        except GlasgowAppletError as e:
+            logger.error(e)
+            return 1
+
+        builds = {}
+        for device in devices:
+            if device.revision not in builds:
+                target, applet = _applet(device.revision, args)
+                builds[device.revision] = target, applet, target.build_plan()
+
+        bitstreams = {}
+        async def download(serial, device):
+            _gang_serials[_current_task()] = serial
+            target, applet, plan = builds[device.revision]
+            if await device.bitstream_id() == plan.bitstream_id and not args.rebuild:
+                logger.info("device already has bitstream ID %s", plan.bitstream_id.hex())
+            else:
+                if plan.bitstream_id not in bitstreams:
+                    logger.info("building bitstream ID %s", plan.bitstream_id.hex())
+                    bitstreams[plan.bitstream_id] = plan.execute()
+                await device.download_bitstream(bitstreams[plan.bitstream_id],
+                                                plan.bitstream_id)
+        await asyncio.gather(*[download(serial, device)
+                               for serial, device in zip(serials, devices)])
+
+        async def run_applet(serial, device, args):
+            _gang_serials[_current_task()] = serial
+            target, applet, plan = builds[device.revision]
+            applet = copy.copy(applet)
+            device.demultiplexer = DirectDemultiplexer(device, target.multiplexer.pipe_count)
+            begin = time.time()
+            logger.info("running handler for applet %r", args.applet)
+            try:
+                iface = await applet.run(device, args)
+                await applet.interact(device, args, iface)
+                error = None
+            except (GlasgowAppletError, GlasgowDeviceError) as e:
+                applet.logger.error(str(e))
+                error = str(e)
+            except asyncio.CancelledError:
+                error = "cancelled"
+            finally:
+                await device.demultiplexer.flush()
+                await device.demultiplexer.cancel()
+            return error, time.time() - begin
+
+        async def wait_for_sigint():
+            await wait_for_signal(signal.SIGINT)
+            logger.debug("Ctrl+C pressed, terminating")
+
+        if builds[devices[0].revision][1].preview:
+            logger.warn("applet %r is PREVIEW QUALITY and may CORRUPT DATA", args.applet)
+
+        old_factory = logging.getLogRecordFactory()
+        logging.setLogRecordFactory(_gang_log_record_factory(old_factory))
+        try:
+            applet_tasks = [asyncio.ensure_future(run_applet(serial, device, device_args))
+                            for serial, device, device_args in zip(serials, devices, all_args)]
+            sigint_task = asyncio.ensure_future(wait_for_sigint())
+            gang_task = asyncio.ensure_future(asyncio.gather(*applet_tasks))
+            await asyncio.wait([gang_task, sigint_task], return_when=asyncio.FIRST_COMPLETED)
+            sigint_task.cancel()
+            for task in applet_tasks:
+                task.cancel()
+            results = await gang_task
+        finally:
+            logging.setLogRecordFactory(old_factory)
+
+        failed = 0
+        for serial, (error, duration) in zip(serials, results):
+            if error is None:
+                logger.info("%s: PASS in %.3f s", serial, duration)
+            else:
+                logger.error("%s: FAIL in %.3f s (%s)", serial, duration, error)
+                failed += 1
+        logger.info("%d of %d devices passed", len(serials) - failed, len(serials))
+        return 1 if failed else 0
+
+    finally:
+        for device in devices:
+            device.close()
+
+
 class TerminalFormatter(logging.Formatter):
     DEFAULT_COLORS = {
         "TRACE"   : "\033[0m",
@@ -429,6 +611,8 @@ async def _main():
         firmware_filename = os.path.join(os.path.dirname(__file__), "glasgow.ihex")
         if args.action in ("build", "test", "tool"):
             pass
+        elif args.action == "run-gang":
+            return await _run_gang(args, firmware_filename)
         elif args.action == "factory":
             device = GlasgowHardwareDevice(args.serial, firmware_filename,
                                            _factory_rev=args.factory_rev)
@@ -479,12 +663,12 @@ async def _main():
                 print("{}\t{:.2}\t{:.2}"
                       .format(port, vio, vlimit))
 
-        if args.action in ("run", "run-repl", "run-prebuilt"):
+        if args.action in ("run", "run-repl", "run-daemon", "run-prebuilt"):
             target, applet = _applet(device.revision, args)
             device.demultiplexer = DirectDemultiplexer(device, target.multiplexer.pipe_count)
             plan = target.build_plan()
 
-            if args.action in ("run", "run-repl"):
+            if args.action in ("run", "run-repl", "run-daemon"):
                 await device.download_target(plan, rebuild=args.rebuild)
             if args.action == "run-prebuilt":
                 bitstream_file = args.bitstream or open("{}.bin".format(args.applet), "rb")
@@ -572,6 +756,12 @@ async def _main():
                                         "{} ...-repl` subcommands".format(applet.name))
                         logger.info("dropping to REPL; use 'help(iface)' to see available APIs")
                         await AsyncInteractiveConsole(locals={"iface":iface}).interact()
+                    if args.action == "run-daemon":
+                        server = await RPCServer(logger, args.socket, iface)
+                        try:
+                            await server.serve_forever()
+                        finally:
+                            os.unlink(args.socket)
                 except GlasgowAppletError as e:
                     applet.logger.error(str(e))
                 except asyncio.CancelledError:
@@ -795,6 +985,58 @@ def main():
     register_wakeup_fd(loop)
     exit(loop.run_until_complete(_main()))
 
+# -------------------------------------------------------------------------------------------------
+
+import tempfile
+
+
+class GangArgumentsTestCase(unittest.TestCase):
+    def test_read_file(self):
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(b"data")
+            file.flush()
+            args = argparse.Namespace(count=1, file=open(file.name, "rb"))
+            gang_args = [_gang_args(args), _gang_args(args)]
+            self.assertEqual(gang_args[0].count, 1)
+            self.assertIsNot(gang_args[0].file, gang_args[1].file)
+            self.assertEqual(gang_args[0].file.read(), b"data")
+            self.assertEqual(gang_args[1].file.read(), b"data")
+            for namespace in [args, *gang_args]:
+                namespace.file.close()
+
+    def test_write_file(self):
+        with tempfile.NamedTemporaryFile() as file:
+            args = argparse.Namespace(file=open(file.name, "wb"))
+            with self.assertRaisesRegex(GlasgowAppletError,
+                    r"^argument file cannot be used in gang mode$"):
+                _gang_args(args)
+            args.file.close()
+
+    def test_stdin(self):
+        args = argparse.Namespace(file=sys.stdin)
+        with self.assertRaisesRegex(GlasgowAppletError,
+                r"^argument file cannot be used in gang mode$"):
+            _gang_args(args)
+
+
+class GangLogRecordFactoryTestCase(unittest.TestCase):
+    def make_record(self):
+        return _gang_log_record_factory(logging.LogRecord)(
+            "glasgow.applet", logging.INFO, __file__, 0, "message", (), None)
+
+    def test_untagged(self):
+        self.assertEqual(self.make_record().name, "glasgow.applet")
+
+    def test_tagged(self):
+        async def task(serial):
+            if serial is not None:
+                _gang_serials[_current_task()] = serial
+            await asyncio.sleep(0)
+            return self.make_record().name
+        names = asyncio.get_event_loop().run_until_complete(
+            asyncio.gather(task("C3-1"), task(None), task("C3-2")))
+        self.assertEqual(names, ["glasgow.applet[C3-1]", "glasgow.applet", "glasgow.applet[C3-2]"])
+
 
 if __name__ == "__main__":
     main()
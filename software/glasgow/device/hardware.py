@@ -54,9 +54,8 @@ class _PollerThread(threading.Thread):
 
 
 class GlasgowHardwareDevice:
-    def __init__(self, serial=None, firmware_filename=None, *, _factory_rev=None):
-        usb_context = usb1.USBContext()
-
+    @staticmethod
+    def _enumerate_handles(usb_context, firmware_filename, _factory_rev):
         firmware = None
         handles  = {}
         discover = True
@@ -113,6 +112,29 @@ class GlasgowHardwareDevice:
                 # Give every device we loaded firmware onto a bit of time to reenumerate.
                 time.sleep(1.0)
 
+        return handles
+
+    @classmethod
+    def enumerate_serials(cls, firmware_filename=None):
+        """
+        Return the serial numbers of all attached devices, loading firmware onto the devices
+        that do not have it.
+        """
+        usb_context = usb1.USBContext()
+        try:
+            handles = cls._enumerate_handles(usb_context, firmware_filename, _factory_rev=None)
+            for revision, handle in handles.values():
+                handle.close()
+        finally:
+            usb_context.close()
+        if len(handles) == 0:
+            raise GlasgowDeviceError("device not found")
+        return sorted(handles)
+
+    def __init__(self, serial=None, firmware_filename=None, *, _factory_rev=None):
+        usb_context = usb1.USBContext()
+        handles = self._enumerate_handles(usb_context, firmware_filename, _factory_rev)
+
         if len(handles) == 0:
             raise GlasgowDeviceError("device not found")
         if serial is None:
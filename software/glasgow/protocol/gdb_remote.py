@@ -9,7 +9,31 @@ from ..applet import GlasgowAppletError
 __all__ = ["GDBRemote"]
 
 
+# Caching
+# -------
+#
+# Every memory or register access may cost many JTAG scans, and GDB issues lots of small and
+# overlapping reads when it unwinds the stack or disassembles code. While the target is stopped,
+# nothing but the debugger changes its state, so registers are cached, and so are the contents
+# of RAM and ROM regions declared in the memory map of the target; writes to these regions go
+# both to the cache and to the target. Registers are invalidated whenever the target runs.
+# Memory is invalidated when the target runs as well, except for ROM regions.
+#
+# Memory is cached in blocks with a mask of valid bytes, and reads are widened to whole blocks
+# (within their region). All other memory (including all memory when the target does not provide
+# a memory map) may be I/O, where accesses have side effects and contents change regardless of
+# whether the target is stopped; reads and writes there are passed through as they are. Since
+# such a write might also affect any other memory (e.g. by starting a DMA transfer, or through
+# an alias of a RAM region), it invalidates all cached memory.
+
+
 class GDBRemote(metaclass=ABCMeta):
+    # Maximum packet size advertised to the debugger; it limits the size of memory transfers.
+    gdb_packet_size = 0x4000
+
+    # Size of the blocks memory is cached in.
+    gdb_cache_block = 0x40
+
     @abstractmethod
     def gdb_log(self, level, message, *args):
         pass
@@ -90,9 +114,117 @@ class GDBRemote(metaclass=ABCMeta):
     async def target_clear_instr_breakpt(self, address):
         pass
 
+    def target_memory_map(self):
+        """
+        Return the memory map of the target as a list of ``(kind, start, length)`` tuples, where
+        ``kind`` is ``"ram"``, ``"rom"``, or ``"io"`` (memory that is never cached), or ``None``
+        if the memory map is not known.
+
+        Note that if the memory map is provided, the debugger will not access any memory outside
+        of it.
+        """
+        return None
+
+    def _gdb_memory_region(self, address):
+        for kind, start, length in self.target_memory_map() or []:
+            if address in range(start, start + length):
+                return kind, start, length
+
+    def _gdb_cacheable_region(self, address, length):
+        region = self._gdb_memory_region(address)
+        if region is not None:
+            kind, start, region_length = region
+            if kind in ("ram", "rom") and address + length <= start + region_length:
+                return region
+
+    def _gdb_cache_invalidate(self, address=None, length=None):
+        if address is None:
+            # The target has been running; only the ROM contents can still be valid.
+            self.__registers = None
+            for block in list(self.__memory):
+                region = self._gdb_memory_region(block * self.gdb_cache_block)
+                if region is None or region[0] != "rom":
+                    del self.__memory[block]
+        else:
+            for block in range(address // self.gdb_cache_block,
+                               (address + length - 1) // self.gdb_cache_block + 1):
+                self.__memory.pop(block, None)
+
+    def _gdb_cache_fill(self, address, data):
+        offset = 0
+        while offset < len(data):
+            block, block_offset = divmod(address + offset, self.gdb_cache_block)
+            chunk = data[offset:offset + self.gdb_cache_block - block_offset]
+            block_data, block_mask = self.__memory.get(block, (bytearray(self.gdb_cache_block), 0))
+            block_data[block_offset:block_offset + len(chunk)] = chunk
+            block_mask |= ((1 << len(chunk)) - 1) << block_offset
+            self.__memory[block] = (block_data, block_mask)
+            offset += len(chunk)
+
+    def _gdb_cache_lookup(self, address, length):
+        data = bytearray()
+        while len(data) < length:
+            block, block_offset = divmod(address + len(data), self.gdb_cache_block)
+            chunk_length = min(length - len(data), self.gdb_cache_block - block_offset)
+            chunk_mask   = ((1 << chunk_length) - 1) << block_offset
+            if block not in self.__memory:
+                return None
+            block_data, block_mask = self.__memory[block]
+            if block_mask & chunk_mask != chunk_mask:
+                return None
+            data += block_data[block_offset:block_offset + chunk_length]
+        return bytes(data)
+
+    async def _gdb_read_memory(self, address, length):
+        region = self._gdb_cacheable_region(address, length)
+        if region is None:
+            return await self.target_read_memory(address, length)
+
+        data = self._gdb_cache_lookup(address, length)
+        if data is not None:
+            return data
+
+        _, start, region_length = region
+        fetch_start = max(start, address - address % self.gdb_cache_block)
+        fetch_end   = min(start + region_length,
+                          -(-(address + length) // self.gdb_cache_block) * self.gdb_cache_block)
+        data = await self.target_read_memory(fetch_start, fetch_end - fetch_start)
+        self._gdb_cache_fill(fetch_start, data)
+        return data[address - fetch_start:address - fetch_start + length]
+
+    async def _gdb_write_memory(self, address, data):
+        if not data:
+            return
+        await self.target_write_memory(address, data)
+        if self._gdb_cacheable_region(address, len(data)) is not None:
+            self._gdb_cache_fill(address, data)
+        else:
+            self.__memory.clear()
+
+    async def _gdb_get_registers(self):
+        if self.__registers is None:
+            self.__registers = list(await self.target_get_registers())
+        return self.__registers
+
+    def _gdb_memory_map_xml(self):
+        regions = "".join(
+            """<memory type="{}" start="{:#x}" length="{:#x}"/>"""
+                .format("rom" if kind == "rom" else "ram", start, length)
+            for kind, start, length in self.target_memory_map())
+        return ("""<?xml version="1.0"?>"""
+                """<!DOCTYPE memory-map PUBLIC "+//IDN gnu.org//DTD GDB Memory Map V1.0//EN" """
+                """"http://sourceware.org/gdb/gdb-memory-map.dtd">"""
+                """<memory-map>{}</memory-map>""".format(regions)).encode("ascii")
+
+    @staticmethod
+    def _gdb_unescape(data):
+        return re.sub(rb"}(.)", lambda m: bytes([m[1][0] ^ 0x20]), data, flags=re.S)
+
     async def gdb_run(self, endpoint):
         self.__non_stop = False
         self.__error_strings = False
+        self.__registers = None
+        self.__memory = {}
 
         try:
             no_ack_mode = False
@@ -176,6 +308,24 @@ class GDBRemote(metaclass=ABCMeta):
             pass
 
     async def _gdb_process(self, command, make_recv_fut):
+        # "What features do you support?"
+        if command.startswith(b"qSupported"):
+            features = [b"PacketSize=%x" % self.gdb_packet_size, b"QStartNoAckMode+"]
+            if self.target_memory_map() is not None:
+                features.append(b"qXfer:memory-map:read+")
+            return b";".join(features)
+
+        # "Read the memory map of the target."
+        if command.startswith(b"qXfer:memory-map:read::"):
+            if self.target_memory_map() is None:
+                return b""
+            offset, length = map(lambda x: int(x, 16), command[23:].split(b","))
+            data = self._gdb_memory_map_xml()[offset:offset + length]
+            if offset + length < len(self._gdb_memory_map_xml()):
+                return b"m" + data
+            else:
+                return b"l" + data
+
         # (lldb) "Send me human-readable error messages."
         if command == b"QEnableErrorStrings":
             self.__error_strings = True
@@ -215,6 +365,7 @@ class GDBRemote(metaclass=ABCMeta):
 
         # "Resume target."
         if command == b"c":
+            self._gdb_cache_invalidate()
             continue_fut  = asyncio.ensure_future(self.target_continue())
             interrupt_fut = asyncio.ensure_future(make_recv_fut())
             await asyncio.wait([continue_fut, interrupt_fut], return_when=asyncio.FIRST_COMPLETED)
@@ -231,18 +382,20 @@ class GDBRemote(metaclass=ABCMeta):
 
         # "Single-step target [but first jump to this address]."
         if command == b"s":
+            self._gdb_cache_invalidate()
             await self.target_single_step()
             return b"S05"
 
         # "Detach from target."
         if command == b"D":
+            self._gdb_cache_invalidate()
             await self.target_detach()
             return b"OK"
 
         # "Get all registers of the target."
         if command == b"g":
             values = bytearray()
-            for register in await self.target_get_registers():
+            for register in await self._gdb_get_registers():
                 if register is None:
                     values += b"xx" * self.target_word_size()
                 else:
@@ -253,7 +406,10 @@ class GDBRemote(metaclass=ABCMeta):
         if command.startswith(b"p"):
             number = int(command[1:], 16)
             if number < len(self.target_register_names()):
-                value  = await self.target_get_register(number)
+                if self.__registers is not None and self.__registers[number] is not None:
+                    value = self.__registers[number]
+                else:
+                    value = await self.target_get_register(number)
                 return b"%.*x" % (self.target_word_size() * 2, value)
             else:
                 return (0, "unrecognized register")
@@ -263,15 +419,19 @@ class GDBRemote(metaclass=ABCMeta):
             values = command[1:]
             registers = []
             while values:
-                registers.append(int(values[:self.target_word_size() * 2]))
+                registers.append(int(values[:self.target_word_size() * 2], 16))
                 values = values[self.target_word_size() * 2:]
             await self.target_set_registers(registers)
+            self.__registers = registers
+            return b"OK"
 
         # "Set specific register of the target."
         if command.startswith(b"P"):
             number, value = map(lambda x: int(x, 16), command[1:].split(b"="))
             if number < len(self.target_register_names()):
                 await self.target_set_register(number, value)
+                if self.__registers is not None:
+                    self.__registers[number] = value
                 return b"OK"
             else:
                 return (0, "unrecognized register")
@@ -279,19 +439,28 @@ class GDBRemote(metaclass=ABCMeta):
         # "Read specified memory range of the target."
         if command.startswith(b"m"):
             address, length = map(lambda x: int(x, 16), command[1:].split(b","))
-            data = await self.target_read_memory(address, length)
+            data = await self._gdb_read_memory(address, length)
             return data.hex().encode("ascii")
 
         # "Write specified memory range of the target."
         if command.startswith(b"M"):
             location, data = command[1:].split(b":")
             address, _length = map(lambda x: int(x, 16), location.split(b","))
-            await self.target_write_memory(address, bytes.fromhex(data.decode("ascii")))
+            await self._gdb_write_memory(address, bytes.fromhex(data.decode("ascii")))
+            return b"OK"
+
+        # "Write specified memory range of the target, in binary."
+        if command.startswith(b"X"):
+            location, data = command[1:].split(b":", 1)
+            address, _length = map(lambda x: int(x, 16), location.split(b","))
+            await self._gdb_write_memory(address, self._gdb_unescape(data))
             return b"OK"
 
         # "Set software breakpoint."
         if command.startswith(b"Z0"):
             address, _kind = map(lambda x: int(x, 16), command[3:].split(b","))
+            # The breakpoint instruction is written to memory.
+            self._gdb_cache_invalidate(address, self.target_word_size())
             if await self.target_set_software_breakpt(address):
                 return b"OK"
             else:
@@ -300,6 +469,8 @@ class GDBRemote(metaclass=ABCMeta):
         # "Clear software breakpoint."
         if command.startswith(b"z0"):
             address, _kind = map(lambda x: int(x, 16), command[3:].split(b","))
+            # The breakpoint instruction is written to memory.
+            self._gdb_cache_invalidate(address, self.target_word_size())
             if await self.target_clear_software_breakpt(address):
                 return b"OK"
             else:
@@ -322,3 +493,76 @@ class GDBRemote(metaclass=ABCMeta):
                 return (0, "hardware breakpoint not set")
 
         return b""
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+
+
+class GDBRemoteCacheTestCase(unittest.TestCase):
+    class Target(GDBRemote):
+        def __init__(self, memory_map):
+            self.memory_map = memory_map
+            self.memory     = bytearray(range(256)) * 4
+            self.reads      = []
+
+        def target_memory_map(self):
+            return self.memory_map
+
+        async def target_read_memory(self, address, length):
+            self.reads.append((address, length))
+            return bytes(self.memory[address:address + length])
+
+        async def target_write_memory(self, address, data):
+            self.memory[address:address + len(data)] = data
+
+    # Only the memory accesses are exercised.
+    Target.__abstractmethods__ = frozenset()
+
+    def setUp(self):
+        self.target = self.Target([("ram", 0x000, 0x100), ("rom", 0x100, 0x100),
+                                   ("io",  0x200, 0x200)])
+        self.target._GDBRemote__registers = None
+        self.target._GDBRemote__memory    = {}
+
+    def run_command(self, command):
+        return asyncio.get_event_loop().run_until_complete(
+            self.target._gdb_process(command, None))
+
+    def test_ram_cached(self):
+        self.assertEqual(self.run_command(b"m44,4"), b"44454647")
+        self.assertEqual(self.run_command(b"m48,4"), b"48494a4b")
+        self.assertEqual(self.target.reads, [(0x40, 0x40)])
+
+    def test_io_uncached(self):
+        self.assertEqual(self.run_command(b"m244,4"), b"44454647")
+        self.target.memory[0x244] = 0xaa
+        self.assertEqual(self.run_command(b"m244,4"), b"aa454647")
+        self.assertEqual(self.target.reads, [(0x244, 4), (0x244, 4)])
+
+    def test_no_memory_map(self):
+        self.target.memory_map = None
+        self.run_command(b"m44,4")
+        self.run_command(b"m44,4")
+        self.assertEqual(self.target.reads, [(0x44, 4), (0x44, 4)])
+
+    def test_io_write_invalidates(self):
+        self.run_command(b"m44,4")
+        self.run_command(b"m144,4")
+        self.target.memory[0x44] = 0xaa
+        self.assertEqual(self.run_command(b"M244,1:00"), b"OK")
+        self.assertEqual(self.run_command(b"m44,4"), b"aa454647")
+
+    def test_continue_keeps_rom(self):
+        self.run_command(b"m44,4")
+        self.run_command(b"m144,4")
+        self.target._gdb_cache_invalidate()
+        self.target.memory[0x44] = 0xaa
+        self.target.memory[0x144] = 0xaa
+        self.assertEqual(self.run_command(b"m44,4"), b"aa454647")
+        self.assertEqual(self.run_command(b"m144,4"), b"44454647")
+
+    def test_memory_map_xml(self):
+        self.assertIn(b"qXfer:memory-map:read+", self.run_command(b"qSupported"))
+        self.assertIn(b'<memory type="ram" start="0x200" length="0x200"/>',
+                      self.run_command(b"qXfer:memory-map:read::0,1000"))
@@ -54,7 +54,10 @@ class SVFLexer:
         * Literal (``(HLUDXZHHLL)``, ``(IN FOO)``, ...), returned as Python ``tuple(str,)``;
         * End of file, returned as Python ``None``.
 
-    :type buffer: str
+    The input is lexed lazily, one token at a time, so it may be a memory-mapped file (or any
+    other bytes-like object), in which case the input is never read into memory as a whole.
+
+    :type buffer: str or bytes-like
     :attr buffer:
         Input buffer.
 
@@ -64,45 +67,65 @@ class SVFLexer:
     """
 
     _keywords = _commands + _parameters + _trst_modes + _tap_states + (";",)
-    _scanner  = tuple((re.compile(src, re.A|re.I|re.M), act) for src, act in (
+    _patterns = (
         (r"\s+",
          None),
         (r"(?:!|//)([^\n]*)(?:\n|\Z)",
          None),
         (r"({})(?=\s+|[;()]|\Z)".format("|".join(_keywords)),
-         lambda m: m[1]),
+         lambda t: t),
         (r"(\d+)(?=[^0-9\.E])",
-         lambda m: int(m[1])),
+         lambda t: int(t)),
         (r"(\d+(?:\.\d+)?(?:E[+-]?\d+)?)",
-         lambda m: float(m[1])),
+         lambda t: float(t)),
         (r"\(\s*([0-9A-F\s]+)\s*\)",
-         lambda m: _hex_to_bits(re.sub(r"\s+", "", m[1]))),
+         lambda t: _hex_to_bits(re.sub(r"\s+", "", t))),
         (r"\(\s*(.+?)\s*\)",
-         lambda m: (m[1],)),
+         lambda t: (t,)),
         (r"\Z",
-         lambda m: None),
-    ))
+         lambda t: None),
+    )
+    _scanner       = tuple((re.compile(src, re.A|re.I|re.M), act)
+                           for src, act in _patterns)
+    _scanner_bytes = tuple((re.compile(src.encode("ascii"), re.A|re.I|re.M), act)
+                           for src, act in _patterns)
 
     def __init__(self, buffer):
         self.buffer   = buffer
         self.position = 0
 
+        if isinstance(buffer, str):
+            self._scanner_re = self._scanner
+            self._newline    = "\n"
+        else:
+            self._scanner_re = self._scanner_bytes
+            self._newline    = b"\n"
+
+    def text(self, start, end):
+        """Return the input between ``start`` and ``end`` as ``str``."""
+        text = self.buffer[start:end]
+        if isinstance(text, str):
+            return text
+        return bytes(text).decode("ascii", errors="replace")
+
     def line_column(self, position=None):
         """
         Return a ``(line, column)`` tuple for the given or, if not specified, current position.
 
         Both the line and the column start at 1.
         """
-        line = len(re.compile(r"\n").findall(self.buffer, endpos=self.position))
-        if line > 1:
-            column = self.position - self.buffer.rindex("\n", 0, self.position)
+        if position is None:
+            position = self.position
+        line = len(re.compile(self._newline).findall(self.buffer, 0, position))
+        if line > 0:
+            column = position - self.buffer.rfind(self._newline, 0, position) - 1
         else:
-            column = self.position
+            column = position
         return line + 1, column + 1
 
     def _lex(self):
         while True:
-            for token_re, action in self._scanner:
+            for token_re, action in self._scanner_re:
                 match = token_re.match(self.buffer, self.position)
                 # print(token_re, match)
                 if match:
@@ -110,11 +133,14 @@ class SVFLexer:
                         self.position = match.end()
                         break
                     else:
-                        return action(match), match.end()
+                        text = match.group(1) if token_re.groups else None
+                        if isinstance(text, (bytes, bytearray)):
+                            text = text.decode("ascii")
+                        return action(text), match.end()
             else:
                 raise SVFParsingError("unrecognized SVF data at line %d, column %d (%s...)"
                                     % (*self.line_column(),
-                                       self.buffer[self.position:self.position + 16]))
+                                       self.text(self.position, self.position + 16)))
 
     def peek(self):
         """Return the next token without advancing the position."""
@@ -151,6 +177,7 @@ class SVFParser:
         self._position  = 0
         self._token     = None
         self._cmd_pos   = 0
+        self._cmd_start = 0
 
         self._param_tdi   = \
             {"HIR": None, "HDR": None, "SIR": None, "SDR": None, "TIR": None, "TDR": None}
@@ -256,13 +283,13 @@ class SVFParser:
             self._parse_error("scan data length %d exceeds command length %d"
                               % (len(value), length))
 
-        if length > len(value):
-            return value + bits(0, length - len(value))
-        else:
-            return value[:length]
+        # Pad or truncate without concatenating, which would copy the data once more.
+        return bits(value, length)
 
     def parse_command(self):
         self._cmd_pos = self._lexer.position
+        self._lexer.peek() # skip whitespace and comments preceding the command
+        self._cmd_start = self._lexer.position
 
         command = self._parse_token()
         if command is None:
@@ -441,7 +468,13 @@ class SVFParser:
         return result or True
 
     def last_command(self):
-        return self._lexer.buffer[self._cmd_pos:self._lexer.position]
+        return self._lexer.text(self._cmd_pos, self._lexer.position)
+
+    def last_command_offset(self):
+        return self._cmd_start
+
+    def line_column(self, offset):
+        return self._lexer.line_column(offset)
 
     def parse_file(self):
         while self.parse_command(): pass
@@ -571,6 +604,19 @@ class SVFLexerTestCase(unittest.TestCase):
         self.assertLexes("(HHZZL)",     [("HHZZL",)])
         self.assertLexes("(IN FOO)",    [("IN FOO",)])
 
+    def test_bytes(self):
+        self.assertLexes(b"TRST OFF;",  ["TRST", "OFF", ";"])
+        self.assertLexes(b"8 1E6",      [8, 1e6])
+        self.assertLexes(b"(A\n5)",     [bits("10100101")])
+        self.assertLexes(b"(IN FOO)",   [("IN FOO",)])
+
+    def test_line_column(self):
+        lexer = SVFLexer("TRST\n  OFF;")
+        self.assertEqual(lexer.line_column(0), (1, 1))
+        self.assertEqual(lexer.line_column(7), (2, 3))
+        lexer = SVFLexer(b"TRST\n  OFF;")
+        self.assertEqual(lexer.line_column(7), (2, 3))
+
     def test_error(self):
         with self.assertRaises(SVFParsingError):
             SVFLexer("XXX").next()
@@ -873,6 +919,14 @@ class SVFParserTestCase(unittest.TestCase):
         parser.parse_command()
         self.assertEqual(parser.last_command(), " SIR 8 TDI (aa);")
 
+    def test_last_command_offset(self):
+        handler = SVFMockEventHandler()
+        parser = SVFParser("TRST OFF;\n! comment\n  SIR 8 TDI (aa);", handler)
+        parser.parse_command()
+        self.assertEqual(parser.line_column(parser.last_command_offset()), (1, 1))
+        parser.parse_command()
+        self.assertEqual(parser.line_column(parser.last_command_offset()), (3, 3))
+
 # -------------------------------------------------------------------------------------------------
 
 class SVFPrintingEventHandler:
@@ -0,0 +1,415 @@
+# Ref: Linux drivers/mtd/nand/raw/nand_ecc.c
+# Ref: Lin, Costello, "Error Control Coding", 2nd ed., chapter 6
+#
+# Layout
+# ------
+#
+# NAND controllers divide the data area of a page into steps (usually of 256 or 512 bytes),
+# compute an ECC for every step, and store the ECCs in the spare area. The data area is
+# corrected one step at a time, using the ECC stored at ``offset + index * ecc_size`` in the
+# spare area for step ``index``. This matches the default software ECC layout used by Linux for
+# large page memories if the ECCs are placed at the end of the spare area.
+#
+# Codes
+# -----
+#
+# The Hamming code is the one used by Linux (and SmartMedia), with 3 bytes of ECC per 256 bytes
+# of data, correcting one bit error and detecting two.
+#
+# The BCH code is a binary BCH code over GF(2^m), with m chosen such that the codeword fits, and
+# a generator polynomial of degree (at most) m*t for a code correcting t bit errors. The data
+# bits are taken most significant bit of the first byte first, and the remainder is stored most
+# significant bit first, padded with ones. The remainder is XORed with the remainder of an erased
+# step (all bytes FFh) and inverted, so that an erased step with its ECC is a valid codeword, and
+# bit flips in erased pages are corrected like any others.
+
+__all__ = ["NANDECCError", "HammingCode", "BCHCode", "ECCLayout", "correct_pages"]
+
+
+class NANDECCError(Exception):
+    pass
+
+
+def _popcount(value):
+    return bin(value).count("1")
+
+
+class HammingCode:
+    """
+    Hamming code with 3 bytes of ECC for every 256 bytes of data.
+    """
+    step_size = 256
+    ecc_size  = 3
+    strength  = 1
+
+    # For line parity bit ``k``, a mask of the bytes whose index has bit ``k`` set.
+    _line_masks = [sum(1 << index for index in range(256) if index & (1 << bit))
+                   for bit in range(8)]
+
+    def __repr__(self):
+        return "HammingCode()"
+
+    def encode(self, data):
+        assert len(data) == self.step_size
+        line_parity = 0
+        column_parity = 0
+        for index, byte in enumerate(data):
+            column_parity ^= byte
+            if _popcount(byte) & 1:
+                line_parity |= 1 << index
+        total = _popcount(line_parity) & 1
+
+        # Parity bits are stored inverted, so that the ECC of an erased step is all ones.
+        code = [0, 0, 0b11]
+        for bit in range(8):
+            odd  = _popcount(line_parity & self._line_masks[bit]) & 1
+            even = odd ^ total
+            code[bit // 4] |= ((even ^ 1) << (2 * (bit % 4))) | ((odd ^ 1) << (2 * (bit % 4) + 1))
+        for bit, mask in enumerate((0x55, 0xaa, 0x33, 0xcc, 0x0f, 0xf0)):
+            code[2] |= ((_popcount(column_parity & mask) & 1) ^ 1) << (bit + 2)
+        return bytes(code)
+
+    def decode(self, data, ecc):
+        """
+        Correct ``data`` using ``ecc``. Returns ``(data, flips)``, where ``flips`` is the number of
+        corrected bit errors, or raises ``NANDECCError`` if the errors cannot be corrected.
+        """
+        syndrome = int.from_bytes(bytes(a ^ b for a, b in zip(self.encode(data), ecc)), "little")
+        if syndrome == 0:
+            return data, 0
+
+        # A single bit error in the data flips exactly one of every pair of parity bits; the odd
+        # bits of every pair then are the position of the flipped bit.
+        if (syndrome ^ (syndrome >> 1)) & 0x545555 == 0x545555:
+            position = 0
+            for bit in range(11):
+                position |= ((syndrome >> (2 * bit + 1 + (bit >= 8) * 2)) & 1) << bit
+            byte, bit = position & 0xff, position >> 8
+            data = bytearray(data)
+            data[byte] ^= 1 << bit
+            return bytes(data), 1
+
+        # A single bit error in the ECC flips exactly one parity bit.
+        if _popcount(syndrome) == 1:
+            return data, 1
+
+        raise NANDECCError("uncorrectable error")
+
+
+class _GaloisField:
+    # Primitive polynomials, as used by Linux.
+    _polynomials = {
+        5: 0x25, 6: 0x43, 7: 0x83, 8: 0x11d, 9: 0x211, 10: 0x409, 11: 0x805, 12: 0x1053,
+        13: 0x201b, 14: 0x402b, 15: 0x8003, 16: 0x1002d,
+    }
+
+    def __init__(self, m):
+        self.m   = m
+        self.n   = (1 << m) - 1
+        self.exp = [0] * (2 * self.n)
+        self.log = [0] * (self.n + 1)
+        value = 1
+        for power in range(self.n):
+            self.exp[power] = self.exp[power + self.n] = value
+            self.log[value] = power
+            value <<= 1
+            if value & (1 << m):
+                value ^= self._polynomials[m]
+
+    def mul(self, a, b):
+        if a == 0 or b == 0:
+            return 0
+        return self.exp[self.log[a] + self.log[b]]
+
+    def div(self, a, b):
+        if a == 0:
+            return 0
+        return self.exp[self.log[a] - self.log[b] + self.n]
+
+    def minimal_polynomial(self, power):
+        # Product of (x - a^k) for every conjugate a^k of a^power; its coefficients are binary.
+        conjugates = set()
+        while power not in conjugates:
+            conjugates.add(power)
+            power = power * 2 % self.n
+        coeffs = [1]
+        for conjugate in conjugates:
+            root = self.exp[conjugate]
+            coeffs = [(coeffs[index - 1] if index > 0 else 0) ^
+                      (self.mul(coeffs[index], root) if index < len(coeffs) else 0)
+                      for index in range(len(coeffs) + 1)]
+        return sum(coeff << index for index, coeff in enumerate(coeffs)), conjugates
+
+
+class BCHCode:
+    """
+    Binary BCH code correcting ``strength`` bit errors in every ``step_size`` bytes of data.
+    """
+    def __init__(self, step_size, strength):
+        self.step_size = step_size
+        self.strength  = strength
+
+        data_bits = step_size * 8
+        m = 5
+        while (1 << m) - 1 < data_bits + m * strength:
+            m += 1
+        self._field = _GaloisField(m)
+
+        generator = 1
+        roots = set()
+        for power in range(1, 2 * strength + 1):
+            if power in roots:
+                continue
+            polynomial, conjugates = self._field.minimal_polynomial(power)
+            roots |= conjugates
+            generator = self._clmul(generator, polynomial)
+        self._generator  = generator
+        self._ecc_bits   = generator.bit_length() - 1
+        assert self._ecc_bits >= 8
+        self.ecc_size    = (self._ecc_bits + 7) // 8
+        self._ecc_pad    = self.ecc_size * 8 - self._ecc_bits
+        self._ecc_mask   = (1 << self._ecc_bits) - 1
+
+        self._table = []
+        for byte in range(256):
+            remainder = byte << self._ecc_bits
+            for bit in reversed(range(8)):
+                if remainder & (1 << (self._ecc_bits + bit)):
+                    remainder ^= generator << bit
+            self._table.append(remainder)
+
+        self._erased = self._remainder(b"\xff" * step_size) ^ self._ecc_mask
+
+    def __repr__(self):
+        return "BCHCode(step_size={}, strength={})".format(self.step_size, self.strength)
+
+    @staticmethod
+    def _clmul(a, b):
+        result = 0
+        while b:
+            if b & 1:
+                result ^= a
+            a <<= 1
+            b >>= 1
+        return result
+
+    def _remainder(self, data):
+        remainder = 0
+        shift = self._ecc_bits - 8
+        for byte in data:
+            remainder = (((remainder << 8) & self._ecc_mask) ^
+                         self._table[((remainder >> shift) ^ byte) & 0xff])
+        return remainder
+
+    def encode(self, data):
+        assert len(data) == self.step_size
+        remainder = self._remainder(data) ^ self._erased
+        return ((remainder << self._ecc_pad) | ((1 << self._ecc_pad) - 1)) \
+            .to_bytes(self.ecc_size, "big")
+
+    def decode(self, data, ecc):
+        """
+        Correct ``data`` using ``ecc``. Returns ``(data, flips)``, where ``flips`` is the number of
+        corrected bit errors, or raises ``NANDECCError`` if the errors cannot be corrected.
+        """
+        field = self._field
+        stored = (int.from_bytes(ecc, "big") >> self._ecc_pad) ^ self._erased
+        error  = self._remainder(data) ^ stored
+        if error == 0:
+            return data, 0
+
+        # The received codeword and its remainder have the same value at every root of
+        # the generator polynomial.
+        syndromes = []
+        error_powers = [power for power in range(self._ecc_bits) if error & (1 << power)]
+        for root in range(1, 2 * self.strength + 1):
+            syndrome = 0
+            for power in error_powers:
+                syndrome ^= field.exp[root * power % field.n]
+            syndromes.append(syndrome)
+
+        # Berlekamp-Massey: find the error locator polynomial.
+        locator, previous = [1], [1]
+        length, shift, discrepancy_prev = 0, 1, 1
+        for index in range(len(syndromes)):
+            discrepancy = syndromes[index]
+            for coeff_index in range(1, length + 1):
+                if coeff_index < len(locator):
+                    discrepancy ^= field.mul(locator[coeff_index], syndromes[index - coeff_index])
+            if discrepancy == 0:
+                shift += 1
+                continue
+            scale = field.div(discrepancy, discrepancy_prev)
+            updated = locator + [0] * max(0, len(previous) + shift - len(locator))
+            for coeff_index, coeff in enumerate(previous):
+                updated[coeff_index + shift] ^= field.mul(scale, coeff)
+            if 2 * length <= index:
+                length, previous, discrepancy_prev, shift = \
+                    index + 1 - length, locator, discrepancy, 1
+            else:
+                shift += 1
+            locator = updated
+        while len(locator) > 1 and locator[-1] == 0:
+            locator.pop()
+        if length > self.strength or len(locator) - 1 != length:
+            raise NANDECCError("uncorrectable error")
+
+        # Chien search: the error at codeword bit ``power`` is a root at a^-power.
+        data_bits = self.step_size * 8
+        positions = []
+        for power in range(data_bits + self._ecc_bits):
+            value = 0
+            for coeff_index, coeff in enumerate(locator):
+                if coeff:
+                    value ^= field.exp[(field.log[coeff] - power * coeff_index) % field.n]
+            if value == 0:
+                positions.append(power)
+        if len(positions) != length:
+            raise NANDECCError("uncorrectable error")
+
+        data = bytearray(data)
+        for power in positions:
+            if power >= self._ecc_bits:
+                index = data_bits - 1 - (power - self._ecc_bits)
+                data[index // 8] ^= 0x80 >> (index % 8)
+        return bytes(data), length
+
+
+class ECCLayout:
+    """
+    Layout of ECCs for ``code`` in pages with a data area of ``page_size`` bytes, where the ECCs
+    start at ``offset`` within the spare area.
+    """
+    def __init__(self, code, page_size, offset):
+        if page_size % code.step_size != 0:
+            raise ValueError("page size {} is not a multiple of ECC step size {}"
+                             .format(page_size, code.step_size))
+        self.code      = code
+        self.page_size = page_size
+        self.offset    = offset
+        self.steps     = page_size // code.step_size
+
+    @property
+    def spare_size(self):
+        """Minimum spare area size."""
+        return self.offset + self.steps * self.code.ecc_size
+
+    def correct(self, page):
+        """
+        Correct the data area of ``page``. Returns ``(page, flips)``, where ``flips`` is
+        the number of corrected bit errors, or ``None`` if some of them cannot be corrected.
+        """
+        step_size, ecc_size = self.code.step_size, self.code.ecc_size
+        data  = bytearray(page)
+        flips = 0
+        for step in range(self.steps):
+            step_data = bytes(data[step * step_size:(step + 1) * step_size])
+            ecc_offset = self.page_size + self.offset + step * ecc_size
+            try:
+                step_data, step_flips = self.code.decode(step_data,
+                                                         data[ecc_offset:ecc_offset + ecc_size])
+            except NANDECCError:
+                flips = None
+                continue
+            data[step * step_size:(step + 1) * step_size] = step_data
+            if flips is not None:
+                flips += step_flips
+        return bytes(data), flips
+
+
+def correct_pages(layout, pages):
+    """
+    Correct every page in ``pages`` with ``layout``. Returns a list of ``(page, flips)``.
+    """
+    return [layout.correct(page) for page in pages]
+
+# -------------------------------------------------------------------------------------------------
+
+import random
+import unittest
+
+
+class HammingCodeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.code = HammingCode()
+        self.data = bytes(random.Random(0).getrandbits(8) for _ in range(256))
+
+    def test_erased(self):
+        self.assertEqual(self.code.encode(b"\xff" * 256), b"\xff\xff\xff")
+
+    def test_known(self):
+        # Byte 0 bit 0 set: every parity pair has its even bit flipped, and column bit 0.
+        self.assertEqual(self.code.encode(b"\x01" + b"\x00" * 255), b"\xaa\xaa\xab")
+
+    def test_correct_data(self):
+        ecc = self.code.encode(self.data)
+        for index in (0, 1, 77, 255):
+            for bit in (0, 5, 7):
+                data = bytearray(self.data)
+                data[index] ^= 1 << bit
+                self.assertEqual(self.code.decode(bytes(data), ecc), (self.data, 1))
+
+    def test_correct_ecc(self):
+        ecc = bytearray(self.code.encode(self.data))
+        ecc[1] ^= 0x10
+        self.assertEqual(self.code.decode(self.data, ecc), (self.data, 1))
+
+    def test_detect(self):
+        ecc = self.code.encode(self.data)
+        data = bytearray(self.data)
+        data[3] ^= 0x01
+        data[9] ^= 0x01
+        with self.assertRaises(NANDECCError):
+            self.code.decode(bytes(data), ecc)
+
+
+class BCHCodeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.code = BCHCode(step_size=512, strength=4)
+        self.data = bytes(random.Random(0).getrandbits(8) for _ in range(512))
+
+    def test_size(self):
+        self.assertEqual(self.code.ecc_size, 7)
+
+    def test_erased(self):
+        self.assertEqual(self.code.encode(b"\xff" * 512), b"\xff" * 7)
+        data = bytearray(b"\xff" * 512)
+        data[100] = 0xfe
+        self.assertEqual(self.code.decode(bytes(data), b"\xff" * 7), (b"\xff" * 512, 1))
+
+    def test_correct(self):
+        ecc = self.code.encode(self.data)
+        for count in range(5):
+            data = bytearray(self.data)
+            for index in random.Random(count).sample(range(512 * 8), count):
+                data[index // 8] ^= 1 << (index % 8)
+            self.assertEqual(self.code.decode(bytes(data), ecc), (self.data, count))
+
+    def test_correct_ecc(self):
+        ecc = bytearray(self.code.encode(self.data))
+        ecc[0] ^= 0x80
+        ecc[6] ^= 0x10
+        data = bytearray(self.data)
+        data[0] ^= 0x01
+        self.assertEqual(self.code.decode(bytes(data), ecc), (self.data, 3))
+
+    def test_detect(self):
+        ecc = self.code.encode(self.data)
+        data = bytearray(self.data)
+        for index in range(0, 8 * 12, 8):
+            data[index // 8] ^= 1
+        with self.assertRaises(NANDECCError):
+            self.code.decode(bytes(data), ecc)
+
+
+class ECCLayoutTestCase(unittest.TestCase):
+    def test_correct(self):
+        layout = ECCLayout(HammingCode(), page_size=512, offset=2)
+        self.assertEqual(layout.spare_size, 8)
+        data  = bytes(random.Random(0).getrandbits(8) for _ in range(512))
+        spare = b"\xff\xff" + layout.code.encode(data[:256]) + layout.code.encode(data[256:])
+        page  = bytearray(data + spare)
+        page[300] ^= 0x40
+        self.assertEqual(layout.correct(bytes(page)), (data + spare, 1))
+        page[301] ^= 0x40
+        self.assertEqual(layout.correct(bytes(page))[1], None)
@@ -4,7 +4,7 @@ from functools import reduce
 import collections.abc
 
 
-__all__ = ["bits"]
+__all__ = ["bits", "bitbuilder"]
 
 
 class bits:
@@ -65,6 +65,11 @@ class bits:
                 return value
             else:
                 return cls.from_int(value._int_, length)
+        if isinstance(value, bitbuilder):
+            if length is None:
+                return value.to_bits()
+            else:
+                return cls.from_bytes(value._buf_, length)
         if isinstance(value, int):
             return cls.from_int(value, length)
         if isinstance(value, str):
@@ -189,6 +194,119 @@ class bits:
                 value |= 1
         return self.__class__(value, self._len_)
 
+
+class bitbuilder:
+    """A mutable bit sequence builder, like ``bytearray`` but for bits.
+
+    This bit sequence is ordered from LSB to MSB, like ``bits``. It is stored in a ``bytearray``,
+    so appending to it takes amortized constant time per appended bit (or per appended byte,
+    if the appended data is byte-aligned), unlike concatenating ``bits``, which takes time
+    proportional to the length of the result. Once complete, the sequence is converted to ``bits``
+    with ``to_bits``, or its bytes are accessed without copying with ``to_memoryview``.
+    """
+    __slots__ = ["_buf_", "_len_"]
+
+    @classmethod
+    def from_bytes(cls, value, length):
+        inst = cls()
+        inst.extend_bytes(value, length)
+        return inst
+
+    def __init__(self, value=None):
+        self._buf_ = bytearray()
+        self._len_ = 0
+        if value is not None:
+            self.extend(value)
+
+    def __len__(self):
+        return self._len_
+
+    def __bool__(self):
+        return bool(self._len_)
+
+    def _extend_int(self, value, length):
+        value &= ~(-1 << length)
+        offset = self._len_ % 8
+        if offset:
+            value = (value << offset) | self._buf_.pop()
+        self._buf_ += value.to_bytes((offset + length + 7) // 8, "little")
+        self._len_ += length
+
+    def append(self, bit):
+        if self._len_ % 8 == 0:
+            self._buf_.append(0)
+        if bit:
+            self._buf_[-1] |= 1 << (self._len_ % 8)
+        self._len_ += 1
+
+    def extend_bytes(self, value, length=None):
+        value = memoryview(value).cast("B")
+        if length is None:
+            length = len(value) * 8
+        elif not 0 <= length <= len(value) * 8:
+            raise ValueError("invalid length for bitbuilder.extend_bytes(): {} bits requested "
+                             "from {} bytes".format(length, len(value)))
+        value = value[:(length + 7) // 8]
+        if self._len_ % 8:
+            self._extend_int(int.from_bytes(value, "little"), length)
+        else:
+            self._buf_ += value
+            self._len_ += length
+            if length % 8:
+                self._buf_[-1] &= ~(-1 << (length % 8))
+
+    def extend(self, value):
+        if isinstance(value, bitbuilder):
+            self.extend_bytes(value._buf_, value._len_)
+        else:
+            value = bits(value)
+            self._extend_int(value._int_, value._len_)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def clear(self):
+        self._buf_.clear()
+        self._len_ = 0
+
+    def to_bits(self):
+        return bits.from_bytes(self._buf_, self._len_)
+
+    def to_bytes(self):
+        return bytes(self._buf_)
+
+    __bytes__ = to_bytes
+
+    def to_memoryview(self):
+        """Return a view of the underlying bytes without copying them.
+
+        The builder cannot be extended while the view is alive; release it first.
+        """
+        return memoryview(self._buf_)
+
+    def __repr__(self):
+        return "bitbuilder('{}')".format(self.to_bits())
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            if key < 0:
+                key += self._len_
+            if not 0 <= key < self._len_:
+                raise IndexError("bitbuilder index out of range")
+            return (self._buf_[key // 8] >> (key % 8)) & 1
+        raise TypeError("bitbuilder indices must be integers, not {}"
+                        .format(key.__class__.__name__))
+
+    def __iter__(self):
+        for bit in range(self._len_):
+            yield (self._buf_[bit // 8] >> (bit % 8)) & 1
+
+    def __eq__(self, other):
+        if isinstance(other, bitbuilder):
+            return self._len_ == other._len_ and self._buf_ == other._buf_
+        return self.to_bits() == other
+
 # -------------------------------------------------------------------------------------------------
 
 import unittest
@@ -353,3 +471,68 @@ class BitsTestCase(unittest.TestCase):
 
     def test_reversed(self):
         self.assertBits(bits("1010").reversed(), 4, 0b0101)
+
+
+class BitbuilderTestCase(unittest.TestCase):
+    def assertBuilder(self, value, bit_length, bit_value):
+        self.assertIsInstance(value, bitbuilder)
+        self.assertEqual(len(value), bit_length)
+        self.assertEqual(value.to_bits(), bits(bit_value, bit_length))
+
+    def test_new(self):
+        self.assertBuilder(bitbuilder(), 0, 0b0)
+        self.assertBuilder(bitbuilder("1001"), 4, 0b1001)
+        self.assertBuilder(bitbuilder.from_bytes(b"\xa5\xff", 9), 9, 0b110100101)
+
+    def test_append(self):
+        some = bitbuilder()
+        for bit in (1,1,0,1,0,0,1,0,0,0,1):
+            some.append(bit)
+        self.assertBuilder(some, 11, 0b10001001011)
+
+    def test_extend(self):
+        some = bitbuilder("101")
+        some.extend(bits("11110000"))
+        some += "01"
+        some += bitbuilder("111")
+        self.assertBuilder(some, 16, 0b1110111110000101)
+
+    def test_extend_bytes(self):
+        some = bitbuilder()
+        some.extend_bytes(b"\xa5\xff", 9)
+        self.assertBuilder(some, 9, 0b110100101)
+        some.extend_bytes(b"\x0f")
+        self.assertBuilder(some, 17, 0b00001111110100101)
+        some = bitbuilder("1")
+        some.extend_bytes(b"\xa5")
+        self.assertBuilder(some, 9, 0b101001011)
+
+    def test_extend_bytes_wrong(self):
+        with self.assertRaisesRegex(ValueError,
+                r"invalid length for bitbuilder\.extend_bytes\(\): 9 bits requested "
+                r"from 1 bytes"):
+            bitbuilder().extend_bytes(b"\x00", 9)
+
+    def test_bits(self):
+        self.assertEqual(bits(bitbuilder("1010")), bits("1010"))
+        self.assertEqual(bits(bitbuilder("1010"), 2), bits("10"))
+
+    def test_bytes(self):
+        self.assertEqual(bytes(bitbuilder("110100101")), b"\xa5\x01")
+        self.assertEqual(bitbuilder("10100101").to_memoryview(), b"\xa5")
+
+    def test_getitem(self):
+        some = bitbuilder("10001001011")
+        self.assertEqual(some[0], 1)
+        self.assertEqual(some[2], 0)
+        self.assertEqual(some[-1], 1)
+        with self.assertRaises(IndexError):
+            some[11]
+
+    def test_iter(self):
+        self.assertEqual(list(bitbuilder("10001001011")), [1,1,0,1,0,0,1,0,0,0,1])
+
+    def test_eq(self):
+        self.assertEqual(bitbuilder("1010"), bitbuilder("1010"))
+        self.assertEqual(bitbuilder("1010"), "1010")
+        self.assertNotEqual(bitbuilder("1010"), bitbuilder("01010"))
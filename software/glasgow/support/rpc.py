@@ -0,0 +1,353 @@
+import os
+import json
+import asyncio
+import logging
+
+from .aobject import *
+from .bits import *
+
+
+__all__ = ["RPCError", "RPCServer", "RPCClient"]
+
+
+# Protocol
+# --------
+#
+# The RPC protocol is line-delimited JSON over a Unix socket. A request is an object
+# ``{"id": ID, "object": OBJECT, "method": NAME, "args": [...], "kwargs": {...}}``, and a reply
+# is either ``{"id": ID, "result": VALUE}`` or ``{"id": ID, "error": [TYPE, MESSAGE]}``.
+# Values that JSON cannot represent are tagged: bytes-like values as ``{"$bytes": HEX}``,
+# ``bits`` as ``{"$bits": [VALUE, LENGTH]}``, tuples as ``{"$tuple": [...]}``, and dicts as
+# ``{"$dict": {...}}``. Any other object returned by a method is kept by the server, and is
+# represented as ``{"$object": OBJECT}``; its methods can then be called by that number, where
+# object 0 is the interface the server was created with.
+#
+# Pipelining
+# ----------
+#
+# The client sends each request as soon as the method is called, and returns a future for its
+# result, so many calls can be issued without waiting for any of them to complete. The server
+# handles every batch of requests it receives at once in order, and replies to each of them
+# as soon as it completes. Methods may return an awaitable instead of a result (for example,
+# a deferred JTAG scan); such results are only awaited once the whole batch has been handled,
+# so that pipelined deferred operations stay batched on the device as well.
+#
+# Only one client is served at a time, since interleaving calls from several clients would
+# confuse most interfaces; other clients wait until it disconnects. A request that cannot be
+# decoded, or has no integer id, cannot be replied to; the server closes the connection instead,
+# after replying to the requests preceding it.
+
+
+class RPCError(Exception):
+    def __init__(self, type, message):
+        super().__init__("{}: {}".format(type, message))
+        self.type    = type
+        self.message = message
+
+
+def _encode(value, objects):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, bits):
+        return {"$bits": [int(value), len(value)]}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$bytes": bytes(value).hex()}
+    if isinstance(value, list):
+        return [_encode(item, objects) for item in value]
+    if isinstance(value, tuple):
+        return {"$tuple": [_encode(item, objects) for item in value]}
+    if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        return {"$dict": {key: _encode(item, objects) for key, item in value.items()}}
+    return {"$object": objects(value)}
+
+
+def _decode(value, objects):
+    if isinstance(value, list):
+        return [_decode(item, objects) for item in value]
+    if isinstance(value, dict):
+        (tag, item), = value.items()
+        if tag == "$bits":
+            return bits(*item)
+        if tag == "$bytes":
+            return bytes.fromhex(item)
+        if tag == "$tuple":
+            return tuple(_decode(item, objects) for item in item)
+        if tag == "$dict":
+            return {key: _decode(item, objects) for key, item in item.items()}
+        if tag == "$object":
+            return objects(item)
+        raise ValueError("unknown tag {}".format(tag))
+    return value
+
+
+class RPCServer(aobject):
+    """
+    Serve the methods of ``root`` (and of any objects they return) at Unix socket ``path``.
+    """
+    async def __init__(self, logger, path, root):
+        self._logger  = logger
+        self._level   = logging.DEBUG if self._logger.name == __name__ else logging.TRACE
+        self._lock    = asyncio.Lock()
+        self._objects = {0: root}
+        self._ids     = {id(root): 0}
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self._serve, path)
+        # The server gives access to the device to anyone who can connect.
+        os.chmod(path, 0o600)
+        self._logger.info("RPC: listening at unix:%s", path)
+
+    def _log(self, message, *args):
+        self._logger.log(self._level, "RPC: " + message, *args)
+
+    def _object_id(self, value):
+        if id(value) not in self._ids:
+            self._ids[id(value)] = len(self._objects)
+            self._objects[len(self._objects)] = value
+        return self._ids[id(value)]
+
+    def _object(self, object_id):
+        return self._objects[object_id]
+
+    @staticmethod
+    def _parse(line):
+        request = json.loads(line)
+        if not isinstance(request, dict) or not isinstance(request.get("id"), int):
+            raise ValueError("request is not an object with an integer id")
+        return request
+
+    async def _call(self, request):
+        target = self._objects[request.get("object", 0)]
+        method = request["method"]
+        if method.startswith("_"):
+            raise AttributeError("method {} is private".format(method))
+        args   = _decode(request.get("args", []), self._object)
+        kwargs = _decode({"$dict": request.get("kwargs", {})}, self._object)
+        self._log("call #%d %s.%s", request["id"], type(target).__name__, method)
+        result = getattr(target, method)(*args, **kwargs)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    def _reply(self, writer, request_id, result=None, error=None):
+        if error is None:
+            reply = {"id": request_id, "result": _encode(result, self._object_id)}
+        else:
+            self._log("call #%d failed: %s", request_id, error)
+            reply = {"id": request_id, "error": [type(error).__name__, str(error)]}
+        writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+    async def _serve(self, reader, writer):
+        async with self._lock:
+            self._logger.info("RPC: new connection")
+            try:
+                buffer  = b""
+                closing = False
+                while not closing:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+
+                    buffer += data
+                    *lines, buffer = buffer.split(b"\n")
+                    pending = []
+                    for line in lines:
+                        try:
+                            request = self._parse(line)
+                        except ValueError as error:
+                            self._logger.error("RPC: malformed request: %s", error)
+                            closing = True
+                            break
+                        try:
+                            result = await self._call(request)
+                        except Exception as error:
+                            self._reply(writer, request["id"], error=error)
+                            continue
+                        if hasattr(result, "__await__"):
+                            pending.append((request["id"], result))
+                        else:
+                            self._reply(writer, request["id"], result)
+
+                    for request_id, awaitable in pending:
+                        try:
+                            self._reply(writer, request_id, await awaitable)
+                        except Exception as error:
+                            self._reply(writer, request_id, error=error)
+                    await writer.drain()
+            finally:
+                writer.close()
+                self._logger.info("RPC: connection closed")
+
+    async def serve_forever(self):
+        # TODO(py3.7): use `async with self.server: await self.server.serve_forever()`
+        try:
+            await asyncio.get_event_loop().create_future()
+        finally:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def close(self):
+        self.server.close()
+
+
+class _RPCProxy:
+    def __init__(self, client, object_id):
+        self._client    = client
+        self._object_id = object_id
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        def call(*args, **kwargs):
+            return self._client.call(self._object_id, method, *args, **kwargs)
+        return call
+
+
+class RPCClient(aobject):
+    """
+    Connect to an RPC server at Unix socket ``path``. The interface it serves is available
+    as ``root``; calling any of its methods sends a request immediately and returns a future.
+    """
+    async def __init__(self, path):
+        self._reader, self._writer = await asyncio.open_unix_connection(path)
+        self._next_id = 0
+        self._futures = {}
+        self._task    = asyncio.ensure_future(self._receive())
+        self.root     = _RPCProxy(self, 0)
+
+    def _object_id(self, value):
+        assert isinstance(value, _RPCProxy) and value._client is self
+        return value._object_id
+
+    def _object(self, object_id):
+        return _RPCProxy(self, object_id)
+
+    def call(self, object_id, method, *args, **kwargs):
+        request_id, self._next_id = self._next_id, self._next_id + 1
+        request = {"id": request_id, "object": object_id, "method": method,
+                   "args": _encode(list(args), self._object_id),
+                   "kwargs": _encode(kwargs, self._object_id)["$dict"]}
+        self._writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        self._futures[request_id] = future = asyncio.get_event_loop().create_future()
+        return future
+
+    async def _receive(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                reply  = json.loads(line)
+                future = self._futures.pop(reply["id"])
+                if "error" in reply:
+                    future.set_exception(RPCError(*reply["error"]))
+                else:
+                    future.set_result(_decode(reply["result"], self._object))
+        finally:
+            for future in self._futures.values():
+                future.set_exception(RPCError("ConnectionError", "connection closed"))
+            self._futures.clear()
+
+    async def close(self):
+        self._writer.close()
+        await self._task
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+import tempfile
+
+
+class RPCEncodingTestCase(unittest.TestCase):
+    def test_roundtrip(self):
+        value = [None, True, 1, 1.5, "x", bits("0101"), b"\x01\x02", (1, [2]), {"a": (3,)}]
+        encoded = json.loads(json.dumps(_encode(value, None)))
+        self.assertEqual(_decode(encoded, None), value)
+
+    def test_object(self):
+        objects = []
+        def object_id(value):
+            objects.append(value)
+            return len(objects) - 1
+        value = object()
+        self.assertEqual(_encode([value], object_id), [{"$object": 0}])
+        self.assertEqual(_decode([{"$object": 0}], objects.__getitem__), [value])
+
+
+class RPCTestCase(unittest.TestCase):
+    class Interface:
+        async def echo(self, value, *, suffix=b""):
+            return value + suffix
+
+        async def fail(self):
+            raise ValueError("failed")
+
+        async def deferred(self, value):
+            async def resolve():
+                return value
+            return resolve()
+
+        def child(self):
+            return RPCTestCase.Interface()
+
+    async def do_test_rpc(self):
+        path   = "{}/test_rpc_sock".format(tempfile.gettempdir())
+        iface  = self.Interface()
+        server = await RPCServer(logging.getLogger(__name__), path, iface)
+        client = await RPCClient(path)
+
+        self.assertEqual(await client.root.echo(bits("101"), suffix=bits("1")), bits("1101"))
+        with self.assertRaisesRegex(RPCError, r"^ValueError: failed$"):
+            await client.root.fail()
+
+        child = await client.root.child()
+        self.assertEqual(await child.echo(b"a"), b"a")
+
+        results = [client.root.deferred(1), client.root.echo(1, suffix=1),
+                   client.root.deferred(2)]
+        self.assertEqual([await result for result in results], [1, 2, 2])
+
+        await client.close()
+        server.close()
+
+    def test_rpc(self):
+        asyncio.get_event_loop().run_until_complete(self.do_test_rpc())
+
+    async def do_test_serve_forever(self):
+        path   = "{}/test_rpc_sock".format(tempfile.gettempdir())
+        server = await RPCServer(logging.getLogger(__name__), path, self.Interface())
+        task   = asyncio.ensure_future(server.serve_forever())
+
+        client = await RPCClient(path)
+        self.assertEqual(await client.root.echo(1, suffix=2), 3)
+        await client.close()
+
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        with self.assertRaises(OSError):
+            await asyncio.open_unix_connection(path)
+
+    def test_serve_forever(self):
+        asyncio.get_event_loop().run_until_complete(self.do_test_serve_forever())
+
+    async def do_test_malformed(self):
+        path   = "{}/test_rpc_sock".format(tempfile.gettempdir())
+        server = await RPCServer(logging.getLogger(__name__), path, self.Interface())
+
+        for malformed in (b"{", b"[]", b'{"method": "echo"}'):
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(b'{"id": 0, "method": "deferred", "args": [1]}\n' + malformed + b"\n" +
+                         b'{"id": 1, "method": "echo", "args": [2]}\n')
+            self.assertEqual(json.loads(await reader.readline()), {"id": 0, "result": 1})
+            self.assertEqual(await reader.readline(), b"")
+            writer.close()
+
+        client = await RPCClient(path)
+        self.assertEqual(await client.root.echo(1, suffix=2), 3)
+        await client.close()
+        server.close()
+
+    def test_malformed(self):
+        asyncio.get_event_loop().run_until_complete(self.do_test_malformed())